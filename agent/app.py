@@ -5,11 +5,29 @@ import logging
 import sys
 import subprocess
 import traceback
+import threading
+import uuid
 import ping3
 import json
 from pathlib import Path
 from libs.TransferTools import TransferTools, TransferTimeout
 from libs.Schemes import NumaScheme
+from libs.listing import scan_tree, file_info, summarize_tree, format_summary
+from libs.file_index import FileIndex
+from libs.hashing import DEFAULT_CHUNK_SIZE, DEFAULT_ALGORITHM, new_hasher
+from libs.checksum_pool import get_scheduler, DEFAULT_TREE_CHUNK
+from libs.checksum_cache import open_cache
+from libs.units import parse_size
+from libs.jobs import JobManager
+from libs.iostats import parse_fio_json, record_fio_output, fio_metrics
+from libs.telemetry import transfer_monitors
+from libs.reaper import get_reaper
+from libs.supervisor import get_supervisor
+from libs.ports import DEFAULT_LEASE_TTL
+from libs.cores import get_core_allocator
+from libs.topology import auto_numa_node, interface_for_address, topology
+from libs.provision import Provisioner, parse_spec, has_contents
+from concurrent.futures import ThreadPoolExecutor
 import argparse
 import hashlib
 import socket
@@ -26,20 +44,43 @@ app = Flask(__name__)
 from prometheus_flask_exporter import PrometheusMetrics, Counter
 metrics = PrometheusMetrics(app, export_defaults=False)
 metrics.info('app_info', 'Agent service for StarLight DTN-as-a-Service')
+checksum_cache_hits = Counter('daas_agent_checksum_cache_hits', 'Number of files whose checksum came from the cache')
+checksum_cache_misses = Counter('daas_agent_checksum_cache_misses', 'Number of files hashed because the cache had no valid entry')
+# bandwidth, iops and latency of every fio run (fio, stress and /create_file/)
+metrics.registry.register(fio_metrics)
+# per second throughput of running transfers
+metrics.registry.register(transfer_monitors)
 
 import importlib
 import pkgutil
+import itertools
 
 # import Diskmanager.py for NVMEoF functions
 sys.path.append("/DTN_Testing_Framework/lib")
 from DiskManager import disk_manager
 
 MAX_FIO_JOBS=400
+FIO_SCRIPT_DIR = 'agent/scripts/'
 nuttcp_port = 30001
+port_lease_ttl = DEFAULT_LEASE_TTL
 
 ORCHESTRATOR_REGISTRATION_PATH = "/orchestrator_registered"
 orchestrator_registered = False
 
+# optional in-memory metadata index of FILE_LOC, see FILE_INDEX in config.py.sample
+file_index = None
+# checksum cache, opened on first use; False once opening it failed
+checksum_cache = None
+# fio shards running per device, see FIO_SHARDS_PER_DEVICE
+device_limits = {}
+device_limits_lock = threading.Lock()
+# writer threads for the non-fio /create_file/ modes, started on first use
+provisioner = None
+# background jobs (checksums) polled through their own endpoints
+jobs = JobManager(max_workers=4)
+# provisioning jobs run apart so long writes don't hold up checksum jobs
+provision_jobs = JobManager(max_workers=2)
+
 def import_submodules(package, recursive=True):
     """ Import all submodules of a module, recursively, including subpackages
 
@@ -58,7 +99,51 @@ def import_submodules(package, recursive=True):
     return results
 
 loaded_modules = import_submodules('libs', False)
-tools = [x.__name__ for x in TransferTools.__subclasses__()]
+# transfer tool classes by name
+tool_classes = {x.__name__: x for x in TransferTools.__subclasses__()}
+tools = list(tool_classes)
+
+class RequestError(Exception):
+    """ A transfer request that can't be served, answered with message and status """
+
+    def __init__(self, message, status=400, **fields):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+        self.fields = fields
+
+    def response(self):
+        return make_response(jsonify(message=self.message, **self.fields), self.status)
+
+    def to_dict(self):
+        return dict(self.fields, message=self.message, code=self.status)
+
+def exception_message():
+    # first line of the exception being handled, e.g. 'Exception: ...'
+    return traceback.format_exc(limit=0).splitlines()[-1]
+
+def get_tool_class(tool):
+    if tool not in tool_classes:
+        raise RequestError("transfer tool {} not found".format(tool), 404)
+    return tool_classes[tool]
+
+def new_tool(tool, data, instances=None):
+    """ Tool instance for a request body
+
+    With instances (a dict kept for one batch) requests with the same
+    numa_scheme share one instance.
+    """
+    scheme = data.get('numa_scheme')
+    if instances is not None and scheme in instances:
+        return instances[scheme]
+    target_tool_cls = get_tool_class(tool)
+    if 'numa_scheme' in data:
+        tool_obj = target_tool_cls(numa_scheme = data['numa_scheme'], nuttcp_port = nuttcp_port, port_lease_ttl = port_lease_ttl)
+    else:
+        tool_obj = target_tool_cls(nuttcp_port = nuttcp_port, port_lease_ttl = port_lease_ttl)
+    if instances is not None:
+        instances[scheme] = tool_obj
+    return tool_obj
 
 def load_config():
     try: 
@@ -73,6 +158,8 @@ def load_config():
             app.config['SKIP_TOKEN_AUTH'] = False
         if 'SINGLE_ORCHESTRATOR' not in app.config:
             app.config["SINGLE_ORCHESTRATOR"] = False
+        if 'FILE_INDEX' not in app.config:
+            app.config['FILE_INDEX'] = False
 
     # also check for a orchestrator_registered file
     global orchestrator_registered
@@ -85,36 +172,77 @@ def load_config():
     except:
         orchestrator_registered = False
 
-    global nuttcp_port
+    global nuttcp_port, port_lease_ttl
     if app.config.get("NUTTCP_PORT"):
         nuttcp_port = app.config["NUTTCP_PORT"]
+    port_lease_ttl = app.config.get('PORT_LEASE_TTL', DEFAULT_LEASE_TTL)
+    get_core_allocator().avoid_siblings = app.config.get('CORE_AVOID_SIBLINGS', False)
 
-def get_type(mode):
-    if stat.S_ISDIR(mode) or stat.S_ISLNK(mode):
-        type = 'dir'
+    # leftovers of fio shards that were running when the agent stopped
+    for fn in glob.glob(os.path.join(FIO_SCRIPT_DIR, '*.fio')):
+        os.remove(fn)
+
+    # start the hashing workers now rather than on the first checksum request
+    get_checksum_scheduler().warm()
+
+    global jobs, provision_jobs
+    if app.config.get('JOB_WORKERS'):
+        jobs = JobManager(max_workers=app.config['JOB_WORKERS'])
+    if app.config.get('PROVISION_JOB_WORKERS'):
+        provision_jobs = JobManager(max_workers=app.config['PROVISION_JOB_WORKERS'])
+
+    global file_index
+    if app.config.get('FILE_INDEX') and file_index is None:
+        file_index = FileIndex(app.config['FILE_LOC'],
+            rescan_interval=app.config.get('FILE_INDEX_RESCAN_INTERVAL', 300))
+        file_index.start()
+
+def get_files(dirname, cursor=None):
+    # entries are generated lazily, the root is checked before the first one
+    if file_index is not None and file_index.covers(dirname):
+        entries = file_index.scan_tree(dirname, cursor)
     else:
-        type = 'file'
-    return type
-
-def get_files(dirname):
-    contents = []
-    total = {'size': 0, 'dir': 0, 'file': 0}
-
-    for filename in list(Path(dirname).glob('**/*')):
-        filepath = os.path.join(dirname, filename)
-        stat_res = os.stat(filepath)
-        info = {}
-        info['name'] = os.path.relpath(filename, dirname)
-        info['mtime'] = stat_res.st_mtime
-        ft = get_type(stat_res.st_mode)
-        info['type'] = ft
-        total[ft] += 1
-        sz = stat_res.st_size
-        info['size'] = sz
-        total['size'] += sz
-        contents.append(info)
-
-    return contents
+        entries = scan_tree(dirname, cursor)
+    return (file_info(relpath, stat_res) for relpath, stat_res in entries)
+
+def get_summary(dirname):
+    if file_index is not None and file_index.covers(dirname):
+        summary = file_index.summarize(dirname)
+    else:
+        summary = summarize_tree(dirname, app.config.get('SUMMARY_WORKERS'))
+    return format_summary(summary)
+
+def get_flag(name):
+    """ Boolean query argument, true/1/yes or false/0/no; 400 for anything else """
+    value = request.args.get(name, '').lower()
+    if value in ('', '0', 'false', 'no'):
+        return False
+    if value in ('1', 'true', 'yes'):
+        return True
+    abort(make_response(jsonify(message='{} has to be true or false'.format(name)), 400))
+
+def stream_json_list(items):
+    yield '['
+    for idx, item in enumerate(items):
+        yield (',' if idx else '') + json.dumps(item)
+    yield ']\n'
+
+def stream_ndjson(items):
+    for item in items:
+        yield json.dumps(item) + '\n'
+
+def get_checksum_scheduler():
+    return get_scheduler(workers=app.config.get('CHECKSUM_WORKERS'),
+        numa_node=app.config.get('CHECKSUM_NUMA_NODE'))
+
+def get_checksum_cache():
+    global checksum_cache
+    if checksum_cache is None:
+        if app.config.get('CHECKSUM_CACHE', False):
+            path = os.path.join(app.config.get('STATE_DIR', '/var/lib/dtnaas'), 'checksums.sqlite')
+            checksum_cache = open_cache(path, hit_counter=checksum_cache_hits, miss_counter=checksum_cache_misses)
+        checksum_cache = checksum_cache or False
+    return checksum_cache or None
 
 def prepare_file(jobname, filename, size):
     write_global=not os.path.exists(jobname)
@@ -125,14 +253,210 @@ def prepare_file(jobname, filename, size):
         option = '[{0}]\nsize={1}\nfilename={0}\n\n'.format(filename, size)
         fh.writelines(option)
 
-def commit_write(jobs):
-    for job in jobs:
-        with open(job) as fh:
-            logging.debug('Writing file using FIO job')
-            logging.debug(''.join(fh.readlines()))
-        ret_code = subprocess.run(['fio', job], stderr=subprocess.PIPE, stdout=subprocess.PIPE)    
-        os.remove(job)
-    return ret_code
+def get_provisioner():
+    global provisioner
+    if provisioner is None:
+        provisioner = Provisioner(workers=app.config.get('PROVISION_WORKERS'))
+    return provisioner
+
+def parse_file_specs(param):
+    """ Split a /create_file/ request into fio and native specs
+
+    Returns (fio specs {path: size}, native specs {path: (bytes, mode)},
+    {path: bytes} of fio files that already hold the requested data).
+    Raises ValueError for an invalid spec.
+    """
+    fio_specs = {}
+    native_specs = {}
+    skipped = {}
+
+    for file_spec in param:
+        if 'size' not in param[file_spec]:
+            raise ValueError('filename and size are required')
+        size, mode = parse_spec(param[file_spec])
+        filepath = os.path.join(app.config['FILE_LOC'] , file_spec)
+        if mode == 'fio':
+            # fio writes data, so a sparse or fallocated file doesn't count
+            if size is not None and has_contents(filepath, size, 'random'):
+                skipped[filepath] = size
+                continue
+            fio_specs[filepath] = param[file_spec]['size']
+        else:
+            native_specs[filepath] = (size, mode)
+    return fio_specs, native_specs, skipped
+
+def provision_files(fio_specs, native_specs, skipped, job=None):
+    progress = None
+    if job is not None:
+        sizes = [size for size, _ in native_specs.values()] + list(skipped.values())
+        for size in fio_specs.values():
+            try:
+                sizes.append(parse_size(size))
+            except ValueError:
+                pass
+        job.update(files_total=len(fio_specs) + len(native_specs) + len(skipped),
+            bytes_total=sum(sizes), files_done=len(skipped), bytes_written=0,
+            bytes_skipped=sum(skipped.values()))
+        job.track_rate('bytes_written')
+        def progress(files_done, bytes_written, bytes_skipped=0):
+            job.add(files_done=files_done, bytes_written=bytes_written, bytes_skipped=bytes_skipped)
+
+    native = get_provisioner().create_files(native_specs, progress)
+    results = commit_write(plan_fio_shards(fio_specs), progress)
+    returncode = next((res['returncode'] for res in results if res['returncode'] != 0), 0)
+    return {'returncode': returncode, 'shards': results,
+        'skipped': len(skipped) + sum(1 for res in native.values() if res['skipped']),
+        'files': {os.path.relpath(path, app.config['FILE_LOC']): res for path, res in native.items()}}
+
+def create_file_job_status(job):
+    """ Job status with write throughput and ETA
+
+    While running throughput_MBps is the rate of the last few seconds
+    (jobs.RATE_WINDOW), afterwards the average. Skipped, fallocated and
+    sparse files count towards progress but not towards throughput.
+    """
+    status = job.to_dict()
+    elapsed = status['elapsed']
+    written = status.get('bytes_written', 0)
+    running = job.status == 'running'
+    rate = (job.rate('bytes_written') or 0) if running else (written / elapsed if elapsed else 0)
+    status['throughput_MBps'] = rate / (1 << 20)
+    remaining = status.get('bytes_total', 0) - written - status.get('bytes_skipped', 0)
+    status['eta_seconds'] = remaining / rate if rate and running else None
+    if job.result is not None:
+        status.update(status.pop('result'))
+    return status
+
+def get_device(path):
+    dev = os.stat(path).st_dev
+    return '{}:{}'.format(os.major(dev), os.minor(dev))
+
+def plan_fio_shards(file_specs):
+    """ Write fio job files for {filepath: size}, one shard per MAX_FIO_JOBS files of a device
+
+    Files are grouped by the device their directory lives on so that shards
+    of different devices can run side by side without competing.
+    """
+    by_device = {}
+    for filepath, size in file_specs.items():
+        Path(os.path.dirname(filepath)).mkdir(parents=True, exist_ok=True)
+        by_device.setdefault(get_device(os.path.dirname(filepath)), []).append((filepath, size))
+
+    shards = []
+    os.makedirs(FIO_SCRIPT_DIR, exist_ok=True)
+    for device, files in by_device.items():
+        for idx in range(0, len(files), MAX_FIO_JOBS):
+            # unique names, several requests may be writing at the same time
+            job_file = os.path.join(FIO_SCRIPT_DIR, 'files{}.fio'.format(uuid.uuid4().hex))
+            shard_files = files[idx:idx + MAX_FIO_JOBS]
+            for filepath, size in shard_files:
+                prepare_file(job_file, filepath, size)
+            shards.append({'device': device, 'job': job_file, 'files': len(shard_files)})
+    return shards
+
+def run_fio_shard(shard, progress=None):
+    """ Run one fio job file and summarise its json+ output
+
+    With progress, fio reports its status every second and progress is
+    called with the bytes written since the previous report.
+    """
+    with open(shard['job']) as fh:
+        logging.debug('Writing file using FIO job')
+        logging.debug(''.join(fh.readlines()))
+    cmd = ['fio', '--output-format=json+', shard['job']]
+    if progress is not None:
+        cmd.insert(1, '--status-interval=1')
+    try:
+        proc = subprocess.Popen(cmd, stderr=subprocess.PIPE, stdout=subprocess.PIPE, universal_newlines=True)
+        stderr = []
+        stderr_reader = threading.Thread(target=lambda: stderr.append(proc.stderr.read()), daemon=True)
+        stderr_reader.start()
+        # every status report is a complete JSON document ending with a lone '}'
+        output, last_report, reported = [], '', 0
+        for line in proc.stdout:
+            output.append(line)
+            if line.rstrip('\n') == '}' and progress is not None:
+                try:
+                    io_bytes = parse_fio_json(''.join(output)).get('write', {}).get('io_bytes', 0)
+                except ValueError:
+                    continue
+                progress(io_bytes - reported)
+                reported = io_bytes
+                last_report, output = ''.join(output), []
+        proc.wait()
+        stderr_reader.join()
+    finally:
+        os.remove(shard['job'])
+    res = {'device': shard['device'], 'files': shard['files'], 'returncode': proc.returncode}
+    stats = record_fio_output('create_file', ''.join(output) if '{' in ''.join(output) else last_report)
+    if stats is not None:
+        write = stats.get('write', {})
+        res['bw_bytes'] = write.get('bw_bytes', 0)
+        res['iops'] = write.get('iops', 0)
+        res['io_bytes'] = write.get('io_bytes', 0)
+        res['clat_ns'] = write.get('clat_ns', {})
+        res['errors'] = stats['errors']
+    else:
+        res['errors'] = []
+    if proc.returncode != 0:
+        res['errors'].append({'job': os.path.basename(shard['job']), 'error': ''.join(stderr).strip()})
+    return res
+
+def get_device_limit(device):
+    with device_limits_lock:
+        if device not in device_limits:
+            device_limits[device] = threading.Semaphore(app.config.get('FIO_SHARDS_PER_DEVICE', 1))
+        return device_limits[device]
+
+def commit_write(shards, progress=None):
+    """ Run fio shards concurrently, at most FIO_SHARDS_PER_DEVICE at once per device
+
+    The limit is shared by every request and job writing to the device.
+    progress, if given, is called with (files done, bytes written).
+    """
+    def run_limited(shard):
+        with get_device_limit(shard['device']):
+            if progress is None:
+                return run_fio_shard(shard)
+            res = run_fio_shard(shard, lambda n: progress(0, n))
+            progress(shard['files'], 0)
+            return res
+
+    if not shards:
+        return []
+    with ThreadPoolExecutor(max_workers=len(shards)) as executor:
+        return list(executor.map(run_limited, shards))
+
+def fastest_interface():
+    interfaces = psutil.net_if_stats()
+    interfaces = sorted([(interf, interfaces[interf].speed) for interf in interfaces 
+            if interfaces[interf].isup and interf != 'lo'], key=lambda k: k[1])
+    return interfaces[-1][0] if interfaces else None
+
+def place_transfer(data, filename, address=None):
+    """ Resolve numa_node 'auto' and default the memory policy of a transfer
+
+    'auto' is the numa node of the interface towards address (the data
+    interface for senders) and of the disk under filename, see
+    libs.topology.auto_numa_node. It implies numa_scheme 2 (BIND_TO_NUMA)
+    unless another scheme is asked for.
+    """
+    if data.get('numa_node') == 'auto':
+        interface = interface_for_address(address) if address else None
+        if interface is None and app.config.get('DATA_ADDR'):
+            interface = interface_for_address(app.config['DATA_ADDR'])
+        if interface is None:
+            interface = app.config.get('DATA_INTERFACE') or fastest_interface()
+        node = auto_numa_node(interface, filename)
+        logging.debug('numa node {} for {} over {}'.format(node, filename, interface))
+        if node is None:
+            data.pop('numa_node')
+        else:
+            data['numa_node'] = node
+            data.setdefault('numa_scheme', NumaScheme.BIND_TO_NUMA.value)
+    mem_policy = app.config.get('NUMA_MEM_POLICY', 'preferred')
+    if data.get('numa_node') is not None and mem_policy:
+        data.setdefault('mem_policy', mem_policy)
 
 def get_registration_data(given_addr, default_data_addr=None, default_interface=None):
     # we need hostname, management IP, dataplane IP, dataplane interface
@@ -142,12 +466,9 @@ def get_registration_data(given_addr, default_data_addr=None, default_interface=
     all_addrs = psutil.net_if_addrs()
     if not data_addr and not data_int:
         # figure out dataplane interface by fastest interface
-        interfaces = psutil.net_if_stats()
-        interfaces = sorted([(interf, interfaces[interf].speed) for interf in interfaces 
-                if interfaces[interf].isup and interf != 'lo'], key=lambda k: k[1])
-        if not interfaces:
+        data_int = fastest_interface()
+        if not data_int:
             raise ValueError("No valid interfaces found for dataplane")
-        data_int = interfaces[-1][0] # fastest
     if not data_int and data_addr:
         # figure out dataplane interface from given address
         for name, sniclist in all_addrs.items():
@@ -225,65 +546,218 @@ def authorize(f):
 @metrics.do_not_track()
 @authorize
 def list_files(path):
+    if get_flag('summary'):
+        try:
+            return jsonify(get_summary(os.path.join(app.config['FILE_LOC'], path)))
+        except PermissionError:
+            abort(403)
+        except FileNotFoundError:
+            abort(404)
+
+    cursor = request.args.get('cursor')
+    limit = request.args.get('limit', type=int)
+    ndjson = request.args.get('format') == 'ndjson'
     try:
-        contents = get_files(os.path.join(app.config['FILE_LOC'], path))
+        contents = get_files(os.path.join(app.config['FILE_LOC'], path), cursor)
     except PermissionError:
         abort(403)
     except FileNotFoundError:
         abort(404)
-    return jsonify(contents)
+
+    if limit is not None:
+        if limit < 1:
+            abort(make_response(jsonify(message='limit has to be a positive number'), 400))
+        page = list(itertools.islice(contents, limit + 1))
+        next_cursor = page[limit - 1]['name'] if len(page) > limit else None
+        page = page[:limit]
+        if ndjson:
+            response = app.response_class(stream_ndjson(page), mimetype='application/x-ndjson')
+            if next_cursor is not None:
+                response.headers['X-Next-Cursor'] = next_cursor
+            return response
+        return jsonify({'files': page, 'next_cursor': next_cursor})
+
+    if ndjson:
+        return app.response_class(stream_ndjson(contents), mimetype='application/x-ndjson')
+    return app.response_class(stream_json_list(contents), mimetype='application/json')
 
 @app.route('/create_file/', methods=['POST'])
 @metrics.counter('daas_agent_file_create', 'Number of files created')
 @authorize
 def create_file():
+    param = request.get_json()
+    detail = get_flag('detail')
+    try:
+        specs = parse_file_specs(param)
+    except ValueError as e:
+        abort(make_response(jsonify(message=str(e)), 400))
 
-    fio_job_files = glob.glob("agent/scripts/*.fio")
-    for fn in fio_job_files:
-        os.remove(fn)
-
+    try:
+        res = provision_files(*specs)
+    except OSError as e:
+        abort(make_response(jsonify(message=str(e)), 400))
+    if detail:
+        return jsonify(res)
+    return jsonify(res['returncode'])
+
+@app.route('/create_file_job/', methods=['POST'])
+@metrics.counter('daas_agent_file_create_job', 'Number of file provisioning jobs started')
+@authorize
+def start_create_file_job():
     param = request.get_json()
-    file_cnt = 0
-    fio_job_num = 0
-    jobs = []
+    try:
+        specs = parse_file_specs(param)
+    except ValueError as e:
+        abort(make_response(jsonify(message=str(e)), 400))
 
-    for file_spec in param:
-        job_file = os.path.join('agent/scripts/' , 'files{}.fio'.format(fio_job_num))
-        if 'size' not in param[file_spec]:
-            abort(make_response(jsonify(message='filename and size are required'), 400))
-        filepath = os.path.join(app.config['FILE_LOC'] , file_spec)
-        prepare_file(job_file, filepath, param[file_spec]['size'])
+    job = provision_jobs.submit('create_file', provision_files, *specs)
+    return jsonify({'id': job.id})
 
-        file_cnt += 1
-        if file_cnt > MAX_FIO_JOBS:
-            fio_job_num += 1
-            file_cnt = 0
-            jobs.append(job_file)
+@app.route('/create_file_job/', methods=['GET'])
+@metrics.do_not_track()
+@authorize
+def list_create_file_jobs():
+    return jsonify([create_file_job_status(job) for job in provision_jobs.list('create_file')])
 
-    if job_file not in jobs:
-        jobs.append(job_file)
+@app.route('/create_file_job/<string:job_id>', methods=['GET'])
+@metrics.do_not_track()
+@authorize
+def get_create_file_job(job_id):
+    job = provision_jobs.get(job_id)
+    if job is None or job.kind != 'create_file':
+        abort(make_response(jsonify(message='create_file job {} not found'.format(job_id)), 404))
+    return jsonify(create_file_job_status(job))
 
-    ret = commit_write(jobs)
-    return jsonify(ret.returncode)
+@app.route('/create_file_job/<string:job_id>', methods=['DELETE'])
+@authorize
+def delete_create_file_job(job_id):
+    job = provision_jobs.get(job_id)
+    if job is None or job.kind != 'create_file':
+        abort(make_response(jsonify(message='create_file job {} not found'.format(job_id)), 404))
+    provision_jobs.remove(job_id)
+    return jsonify(create_file_job_status(job))
+
+def get_checksum_algorithm(algorithm):
+    if algorithm is None:
+        algorithm = app.config.get('CHECKSUM_ALGORITHM', DEFAULT_ALGORITHM)
+    try:
+        new_hasher(algorithm)
+    except ValueError as e:
+        abort(make_response(jsonify(message=str(e)), 400))
+    return algorithm
+
+def get_tree_chunk(args):
+    """ Leaf size for tree mode from request args, None for whole-file hashes """
+    if args.get('mode', 'file') == 'file':
+        return None
+    elif args.get('mode') != 'tree':
+        abort(make_response(jsonify(message='mode has to be file or tree'), 400))
+    try:
+        tree_chunk = parse_size(args.get('tree_chunk', app.config.get('CHECKSUM_TREE_CHUNK', DEFAULT_TREE_CHUNK)))
+    except ValueError as e:
+        abort(make_response(jsonify(message=str(e)), 400))
+    if tree_chunk < 1:
+        abort(make_response(jsonify(message='tree_chunk has to be a positive size'), 400))
+    return tree_chunk
+
+def compute_checksum(path, algorithm, tree_chunk=None, with_leaves=False, job=None):
+    dirname = os.path.join(app.config['FILE_LOC'], path)
+    filelist = [(os.path.join(dirname, f['name']), f['size']) for f in get_files(dirname) if f['type'] == 'file']
+    chunk_size = parse_size(app.config.get('CHECKSUM_CHUNK_SIZE', DEFAULT_CHUNK_SIZE))
+
+    callback = None
+    if job is not None:
+        job.update(files_total=len(filelist), bytes_total=sum(size for _, size in filelist),
+            files_done=0, bytes_hashed=0)
+        def callback(files_done, bytes_done):
+            job.add(files_done=files_done, bytes_hashed=bytes_done)
+
+    scheduler = get_checksum_scheduler()
+    if tree_chunk is None:
+        digests = scheduler.hash_files(filelist, algorithm, chunk_size,
+            callback=callback, cache=get_checksum_cache())
+    else:
+        leaves = {} if with_leaves else None
+        digests = scheduler.tree_hash_files(filelist, algorithm, tree_chunk, chunk_size,
+            callback=callback, cache=get_checksum_cache(), leaves=leaves)
+    # keep the listing order so the result matches the serial implementation
+    checksum = ''.join(digests[chkfile] for chkfile, _ in filelist)
+    res = {'checksum': checksum, 'num_files': len(filelist), 'algorithm': algorithm}
+    if tree_chunk is not None:
+        res['mode'] = 'tree'
+        res['tree_chunk'] = tree_chunk
+        if with_leaves:
+            res['chunks'] = {os.path.relpath(chkfile, dirname): [
+                {'offset': offset, 'length': length, 'digest': digest} for offset, length, digest in file_leaves]
+                for chkfile, file_leaves in leaves.items()}
+    return res
+
+def checksum_job_status(job):
+    status = job.to_dict()
+    elapsed = status['elapsed']
+    status['throughput_MBps'] = status.get('bytes_hashed', 0) / elapsed / (1 << 20) if elapsed else 0
+    if job.result is not None:
+        status.update(status.pop('result'))
+    return status
 
 @app.route('/checksum/<path:path>')
 @metrics.do_not_track()
 @authorize
 def generate_checksum(path):
+    algorithm = get_checksum_algorithm(request.args.get('algorithm'))
+    tree_chunk = get_tree_chunk(request.args)
+    with_leaves = get_flag('chunks')
     try:
-        contents = get_files(os.path.join(app.config['FILE_LOC'], path))
-        filelist = [f['name'] for f in contents if f['type'] == 'file']
-        checksum = ''
-        for chkfile in filelist:
-            chkfile = os.path.join(app.config['FILE_LOC'], path, chkfile)
-            checksum += hashlib.md5(open(chkfile, 'rb').read()).hexdigest()
-        return jsonify({'checksum': checksum, 'num_files': len(filelist)})
+        return jsonify(compute_checksum(path, algorithm, tree_chunk, with_leaves))
     except PermissionError:
         abort(403)
     except FileNotFoundError as e:
 
         abort(404)
 
+@app.route('/checksum_job/', methods=['POST'])
+@metrics.counter('daas_agent_checksum_job', 'Number of checksum jobs started')
+@authorize
+def start_checksum_job():
+    data = request.get_json()
+    if not data or 'path' not in data:
+        abort(make_response(jsonify(message='path is required'), 400))
+    algorithm = get_checksum_algorithm(data.get('algorithm'))
+    if not os.path.exists(os.path.join(app.config['FILE_LOC'], data['path'])):
+        abort(make_response(jsonify(message='Cannot find the specified path {}'.format(data['path'])), 404))
+
+    tree_chunk = get_tree_chunk(data)
+    params = {'path': data['path'], 'algorithm': algorithm}
+    if tree_chunk is not None:
+        params.update({'mode': 'tree', 'tree_chunk': tree_chunk})
+    job = jobs.submit('checksum', compute_checksum, data['path'], algorithm,
+        tree_chunk, bool(data.get('chunks')), params=params)
+    return jsonify({'id': job.id})
+
+@app.route('/checksum_job/', methods=['GET'])
+@metrics.do_not_track()
+@authorize
+def list_checksum_jobs():
+    return jsonify([checksum_job_status(job) for job in jobs.list('checksum')])
+
+@app.route('/checksum_job/<string:job_id>', methods=['GET'])
+@metrics.do_not_track()
+@authorize
+def get_checksum_job(job_id):
+    job = jobs.get(job_id)
+    if job is None or job.kind != 'checksum':
+        abort(make_response(jsonify(message='checksum job {} not found'.format(job_id)), 404))
+    return jsonify(checksum_job_status(job))
+
+@app.route('/checksum_job/<string:job_id>', methods=['DELETE'])
+@authorize
+def delete_checksum_job(job_id):
+    job = jobs.get(job_id)
+    if job is None or job.kind != 'checksum':
+        abort(make_response(jsonify(message='checksum job {} not found'.format(job_id)), 404))
+    jobs.remove(job_id)
+    return jsonify(checksum_job_status(job))
+
 @app.route('/create_dir/', methods=['POST'])
 @metrics.counter('daas_agent_dir_create', 'Number of dir created')
 @authorize
@@ -328,7 +802,7 @@ def delete_file(path):
             else:
                 shutil.rmtree(filepath)
         except Exception as e:
-            abort(make_response(jsonify(message=traceback.format_exc(limit=0).splitlines()[1]), 400))
+            abort(make_response(jsonify(message=exception_message()), 400))
         return ""
 
 @app.route('/trim', methods=['GET'])
@@ -359,13 +833,32 @@ def ping_host(dst_ip):
 def get_transfer_tools():    
     return jsonify(tools)
 
-@app.route('/<string:tool>/poll')
-@metrics.counter('daas_agent_polling', 'Number of polling for transfer',
-labels={'status': lambda r: r.status_code})
-@metrics.gauge('daas_agent_num_transfers', 'Number of transfers waiting to be finished')
-@authorize
-def poll(tool):
-    data = request.get_json()
+def process_status(proc):
+    if proc is None:
+        return {'status': 'exited', 'returncode': 0}
+    transfer = get_supervisor().find_proc(proc)
+    if transfer is not None and transfer.running():
+        return {'status': 'running'}
+    elif transfer is None and proc.poll() is None:
+        return {'status': 'running'}
+    res = {'status': 'exited', 'returncode': proc.returncode}
+    if transfer is not None:
+        res['transfer_id'] = transfer.id
+        res['usage'] = transfer.usage
+    return res
+
+def get_poll_wait(wait):
+    """ Seconds a long poll may block, at most POLL_MAX_WAIT """
+    max_wait = app.config.get('POLL_MAX_WAIT', 30)
+    if wait is None:
+        return max_wait
+    return max(0, min(float(wait), max_wait))
+
+def poll_transfer(tool, data):
+    """ Poll a transfer per the /<tool>/poll body, returns (result, status code) """
+    target_tool_cls = get_tool_class(tool)
+    mode = data.pop('mode', 'block')
+    wait = data.pop('wait', None)
 
     if 'dstfile' in data and data['dstfile'] != None:
         data['dstfile'] = os.path.join(app.config['FILE_LOC'], data['dstfile'])
@@ -374,27 +867,79 @@ def poll(tool):
         logging.debug('polling {} {}'.format(data['node'], tool))
     else:
         logging.debug('polling {}'.format(tool))
-    target_module = [x for x in loaded_modules if tool in x]    
-    target_tool_cls = getattr(loaded_modules[target_module[0]], tool)    
     try:        
-        retcode = target_tool_cls.poll_progress(**data)
-        return jsonify(retcode)
+        if mode == 'status':
+            return process_status(target_tool_cls.get_process(**data)), 200
+        elif mode == 'wait':
+            proc = target_tool_cls.get_process(**data)
+            if proc is not None and not get_reaper().watch(proc).wait(get_poll_wait(wait)):
+                return {'status': 'running'}, 202
+        elif mode != 'block':
+            raise Exception('mode has to be block, status or wait')
+        return target_tool_cls.poll_progress(**data), 200
     except TransferTimeout as e:        
-            filepath = os.path.relpath(e.file, app.config['FILE_LOC'])
-            abort(make_response(jsonify(message=traceback.format_exc(limit=0).splitlines()[1], file = filepath), 400))
+        raise RequestError(exception_message(), file = os.path.relpath(e.file, app.config['FILE_LOC']))
     except Exception:
-            abort(make_response(jsonify(message=traceback.format_exc(limit=0).splitlines()[1]), 400))
+        raise RequestError(exception_message())
 
-@app.route('/sender/<string:tool>', methods=['POST'])
-@metrics.counter('daas_agent_sender', 'Number of sender created',
+@app.route('/<string:tool>/poll')
+@metrics.counter('daas_agent_polling', 'Number of polling for transfer',
 labels={'status': lambda r: r.status_code})
+@metrics.gauge('daas_agent_num_transfers', 'Number of transfers waiting to be finished')
 @authorize
-def run_sender(tool):
-    if tool not in tools: abort(make_response(jsonify(message="transfer tool {} not found".format(tool)), 404))
+def poll(tool):
+    """ Wait for a transfer and return its result
 
-    data = request.get_json()
+    mode=block (default) waits until the transfer ends. mode=status returns
+    {'status': 'running'} or {'status': 'exited', 'returncode': ..} at once.
+    mode=wait waits at most wait seconds (capped by POLL_MAX_WAIT) and then
+    answers like block, or with 202 {'status': 'running'} if it's still
+    running. Only block and wait collect the result and release the transfer.
+    """
+    try:
+        result, status = poll_transfer(tool, request.get_json())
+    except RequestError as e:
+        abort(e.response())
+    return make_response(jsonify(result), status)
+
+@app.route('/<string:tool>/poll/batch', methods=['GET', 'POST'])
+@metrics.counter('daas_agent_polling_batch', 'Number of batch polling for transfers',
+labels={'status': lambda r: r.status_code})
+@authorize
+def poll_batch(tool):
+    """ Poll a list of transfers of tool at once
+
+    Items are /<tool>/poll bodies; their mode defaults to status here. The
+    answer lists {'code': .., 'result': ..} per item, failed items get
+    {'code': .., 'message': ..} instead.
+    """
+    results = []
+    for data in get_batch():
+        data.setdefault('mode', 'status')
+        try:
+            result, status = poll_transfer(tool, data)
+            results.append({'code': status, 'result': result})
+        except RequestError as e:
+            results.append(e.to_dict())
+    return jsonify(results)
+
+@app.route('/<string:tool>/progress/<int:cport>')
+@metrics.do_not_track()
+@authorize
+def transfer_progress(tool, cport):
+    """ Interval reports of a transfer; since=<timestamp> returns only newer ones """
+    monitor = transfer_monitors.get(tool, cport)
+    if monitor is None:
+        abort(make_response(jsonify(message='no progress for {} transfer on port {}'.format(tool, cport)), 404))
+    res = monitor.to_dict(request.args.get('since', None, type=float))
+    res['cport'] = cport
+    return jsonify(res)
+
+def start_sender(tool, data, instances=None):
+    """ Start a sender from a /sender/<tool> body and return its result """
+    get_tool_class(tool)
     if not 'file' in data:
-        abort(make_response(jsonify(message="file path is not found from request"), 400))
+        raise RequestError("file path is not found from request")
 
     if data['file'] == None:
         filename = None       
@@ -403,98 +948,171 @@ def run_sender(tool):
         filename = os.path.join(app.config['FILE_LOC'], data.get('file'))
 
         if not os.path.exists(filename): 
-            abort(make_response(jsonify(message="file is not found"), 404))    
+            raise RequestError("file is not found", 404)
 
-    # find the module for a tool and instantiate it
-    target_module = [x for x in loaded_modules if 'libs.' + tool == x]
-    if len(target_module) > 1 :
-        abort(make_response(jsonify(message="Duplicated transfer tool name" + tool), 400))
-    target_tool_cls = getattr(loaded_modules[target_module[0]], tool)
-    
-    if 'numa_scheme' in data:
-        tool_obj = target_tool_cls(numa_scheme = data['numa_scheme'], nuttcp_port = nuttcp_port)
-    else:
-        tool_obj = target_tool_cls(nuttcp_port = nuttcp_port)
+    place_transfer(data, filename)
+    tool_obj = new_tool(tool, data, instances)
 
     ret = tool_obj.run_sender(filename, **data)
     if not ret['result']:
-        abort(make_response(jsonify(message="failed to run" + tool), 400))
-    
-    return jsonify(ret)
-
-@app.route('/receiver/<string:tool>', methods=['POST'])
-@metrics.counter('daas_agent_receiver', 'Number of receiver created',
-labels={'status': lambda r: r.status_code})
-@authorize
-def run_receiver(tool):
-    if tool not in tools: abort(404)
-
-    data = request.get_json()    
+        raise RequestError("failed to run" + tool)
+    return ret
 
+def start_receiver(tool, data, instances=None):
+    """ Start a receiver from a /receiver/<tool> body and return its result """
+    get_tool_class(tool)
     if data['file'] == None:
         filename = None
         if 'duration' not in data:
             # TODO : check if server is mem-to-mem
-            abort(make_response(jsonify(message="Mem-to-mem transfer requires duration"), 404))
+            raise RequestError("Mem-to-mem transfer requires duration", 404)
     else:
         filename = os.path.join(app.config['FILE_LOC'], data.pop('file'))    
         
     address = data.pop('address')    
+    place_transfer(data, filename, address)
+    tool_obj = new_tool(tool, data, instances)
 
-    # find the module for a tool and instantiate it
-    target_module = [x for x in loaded_modules if 'libs.' + tool == x]
-    if len(target_module) > 1 :
-        abort(make_response(jsonify(message="Duplicated transfer tool name" + tool), 400))
-    target_tool_cls = getattr(loaded_modules[target_module[0]], tool)
-    tool_obj = target_tool_cls()
+    try:
+        return tool_obj.run_receiver(address, filename, **data)
+    except Exception:
+        raise RequestError(exception_message())
 
-    if 'numa_scheme' in data:
-        tool_obj = target_tool_cls(numa_scheme = data['numa_scheme'], nuttcp_port = nuttcp_port)
-    else:
-        tool_obj = target_tool_cls(nuttcp_port = nuttcp_port)
+def get_batch():
+    data = request.get_json()
+    if not isinstance(data, list) or not all(isinstance(item, dict) for item in data):
+        abort(make_response(jsonify(message="a batch has to be a list of objects"), 400))
+    return data
+
+def run_batch(start, tool):
+    """ start(tool, item) for every item of the batch; errors stay per item """
+    results = []
+    # one tool instance per numa_scheme for the whole batch
+    instances = {}
+    for data in get_batch():
+        try:
+            results.append(start(tool, data, instances))
+        except RequestError as e:
+            results.append(dict(e.to_dict(), result=False))
+        except Exception:
+            results.append({'result': False, 'message': exception_message(), 'code': 400})
+    return jsonify(results)
 
+@app.route('/sender/<string:tool>', methods=['POST'])
+@metrics.counter('daas_agent_sender', 'Number of sender created',
+labels={'status': lambda r: r.status_code})
+@authorize
+def run_sender(tool):
     try:
-        ret = tool_obj.run_receiver(address, filename, **data)
-    except Exception:
-        abort(make_response(jsonify(message=traceback.format_exc(limit=0).splitlines()[1]), 400))
-    
-    return jsonify(ret)
+        return jsonify(start_sender(tool, request.get_json()))
+    except RequestError as e:
+        abort(e.response())
+
+@app.route('/sender/<string:tool>/batch', methods=['POST'])
+@metrics.counter('daas_agent_sender_batch', 'Number of sender batches',
+labels={'status': lambda r: r.status_code})
+@authorize
+def run_sender_batch(tool):
+    """ Start a list of senders, answers their results in order """
+    return run_batch(start_sender, tool)
+
+@app.route('/receiver/<string:tool>', methods=['POST'])
+@metrics.counter('daas_agent_receiver', 'Number of receiver created',
+labels={'status': lambda r: r.status_code})
+@authorize
+def run_receiver(tool):
+    try:
+        return jsonify(start_receiver(tool, request.get_json()))
+    except RequestError as e:
+        abort(e.response())
+
+@app.route('/receiver/<string:tool>/batch', methods=['POST'])
+@metrics.counter('daas_agent_receiver_batch', 'Number of receiver batches',
+labels={'status': lambda r: r.status_code})
+@authorize
+def run_receiver_batch(tool):
+    """ Start a list of receivers, answers their results in order """
+    return run_batch(start_receiver, tool)
 
 @app.route('/cleanup/<string:tool>', methods=['GET'])
 @metrics.counter('daas_agent_cleanup', 'Number of cleanup',
 labels={'status': lambda r: r.status_code})
 @authorize
 def cleanup(tool):
-    if tool not in tools: abort(make_response(jsonify(message="transfer tool {} not found".format(tool)), 404))
-
-    target_module = [x for x in loaded_modules if 'libs.' + tool == x]
-    if len(target_module) > 1 :
-        abort(make_response(jsonify(message="Duplicated transfer tool name" + tool), 400))
-    target_tool_cls = getattr(loaded_modules[target_module[0]], tool)
+    try:
+        target_tool_cls = get_tool_class(tool)
+    except RequestError as e:
+        abort(e.response())
 
     try:        
         retcode = target_tool_cls.cleanup(nuttcp_port=nuttcp_port)
         return jsonify(retcode)
     except Exception:
-        abort(make_response(jsonify(message=traceback.format_exc(limit=0).splitlines()[1]), 400))
+        abort(make_response(jsonify(message=exception_message()), 400))
 
 @app.route('/free_port/<string:tool>/<int:port>', methods=['GET'])
 @metrics.counter('daas_agent_free_port', 'Number of freeing port',
 labels={'status': lambda r: r.status_code})
 @authorize
 def free_port(tool, port):
-    if tool not in tools: abort(make_response(jsonify(message="transfer tool {} not found".format(tool)), 404))
-
-    target_module = [x for x in loaded_modules if 'libs.' + tool == x]
-    if len(target_module) > 1 :
-        abort(make_response(jsonify(message="Duplicated transfer tool name" + tool), 400))
-    target_tool_cls = getattr(loaded_modules[target_module[0]], tool)
+    try:
+        target_tool_cls = get_tool_class(tool)
+    except RequestError as e:
+        abort(e.response())
 
     try:        
         retcode = target_tool_cls.free_port(port)
         return jsonify(retcode)
     except Exception:
-        abort(make_response(jsonify(message=traceback.format_exc(limit=0).splitlines()[1]), 400))
+        abort(make_response(jsonify(message=exception_message()), 400))
+
+@app.route('/transfers', methods=['GET'])
+@metrics.do_not_track()
+@authorize
+def list_transfers():
+    """ Running and recently finished transfers with their resource usage, ?tool= filters """
+    return jsonify([transfer.to_dict() for transfer in get_supervisor().list(request.args.get('tool'))])
+
+@app.route('/transfers/<string:transfer_id>', methods=['GET'])
+@metrics.do_not_track()
+@authorize
+def get_transfer(transfer_id):
+    """ A transfer, or the aggregate of the stripes of a striped transfer """
+    transfer = get_supervisor().get(transfer_id)
+    if transfer is not None:
+        return jsonify(transfer.to_dict())
+    stripes = [stripe.to_dict() for stripe in get_supervisor().children(transfer_id)]
+    if not stripes:
+        abort(make_response(jsonify(message='transfer {} not found'.format(transfer_id)), 404))
+    running = any(stripe['status'] == 'running' for stripe in stripes)
+    return jsonify({'id': transfer_id, 'tool': stripes[0]['tool'], 'role': stripes[0]['role'],
+                    'status': 'running' if running else 'exited',
+                    'returncode': None if running else next((s['returncode'] for s in stripes if s['returncode']), 0),
+                    'stripes': stripes})
+
+@app.route('/ports', methods=['GET'])
+@metrics.do_not_track()
+@authorize
+def port_stats():
+    """ nuttcp port pair leases """
+    target_tool_cls = tool_classes['nuttcp']
+    if target_tool_cls.ports is None:
+        target_tool_cls.reset_ports(nuttcp_port = nuttcp_port)
+    return jsonify(target_tool_cls.ports.stats())
+
+@app.route('/cores', methods=['GET'])
+@metrics.do_not_track()
+@authorize
+def core_stats():
+    """ cores handed out to transfers with numa_scheme 3 (BIND_TO_CORE) """
+    return jsonify(get_core_allocator().stats())
+
+@app.route('/topology', methods=['GET'])
+@metrics.do_not_track()
+@authorize
+def get_topology():
+    """ numa nodes of the network interfaces and NVMe disks """
+    return jsonify(topology())
 
 @app.route('/nvme/setup', methods=['POST'])
 @authorize
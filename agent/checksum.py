@@ -1,73 +1,44 @@
 import argparse
-import multiprocessing
-import hashlib
-import stat
-import pathlib
 import os
-
-NUM_THREADS = 12
-
-def get_type(mode):
-    if stat.S_ISDIR(mode) or stat.S_ISLNK(mode):
-        type = 'dir'
-    else:
-        type = 'file'
-    return type
+from libs.hashing import DEFAULT_CHUNK_SIZE, DEFAULT_ALGORITHM, hash_string, available_algorithms
+from libs.listing import scan_tree, get_type
+from libs.checksum_pool import get_scheduler, DEFAULT_TREE_CHUNK
+from libs.checksum_cache import open_cache
+from libs.units import parse_size
 
 def list_files(path):
     contents = []
 
-    for filename in list(pathlib.Path(path).glob('**/*')):
-        filepath = os.path.join(path, filename)
-        try:
-            stat_res = os.stat(filename)
-            ft = get_type(stat_res.st_mode)
-            if ft == 'file':
-                contents.append(str(filename))
-        except FileNotFoundError:
-            continue # skip files we can't read
+    for relpath, stat_res in scan_tree(path):
+        if get_type(stat_res.st_mode) == 'file':
+            contents.append((os.path.join(path, relpath), stat_res.st_size))
     return contents
 
-def split(pathlist, num_threads):
-    i, mod = divmod(len(pathlist), num_threads)
-    return (pathlist[j*i + min(j, mod):(j+1)*i + min(j+1, mod)] for j in range(num_threads))
-
-def checksum_list(pathlist, id, shared):
-    checksums = set()
-    for path in pathlist[id]:
-        checksums.add(hashlib.md5(open(path, 'rb').read()).hexdigest())
-    shared[id] = checksums
-
-def checksum(path):
+def checksum(path, chunk_size=DEFAULT_CHUNK_SIZE, workers=None, cache_path=None,
+             algorithm=DEFAULT_ALGORITHM, tree_chunk=None):
     filelist = list_files(path)
-    checksums = set()
-    if len(filelist) > 100:
-        manager = multiprocessing.Manager()
-        # split into processes
-        processes = []
-        split_filelists = list(split(filelist, NUM_THREADS))
-        shared_sums = manager.dict()
-
-        # start threads
-        for proc in range(NUM_THREADS):
-            processes.append(multiprocessing.Process(target=checksum_list, args=(split_filelists, proc, shared_sums)))
-            processes[-1].start()
-        
-        # join later
-        for proc in processes:
-            proc.join()
-
-        # put values together
-        for id in shared_sums:
-            checksums.update(shared_sums[id])
+    scheduler = get_scheduler(workers=workers)
+    cache = open_cache(cache_path) if cache_path else None
+    if tree_chunk is None:
+        digests = scheduler.hash_files(filelist, algorithm, chunk_size, cache=cache)
     else:
-        for chkfile in filelist:
-            checksums.add(hashlib.md5(open(chkfile, 'rb').read()).hexdigest())
-    
-    return hashlib.md5(''.join(sorted(list(checksums))).encode('utf8')).hexdigest()
+        digests = scheduler.tree_hash_files(filelist, algorithm, tree_chunk, chunk_size, cache=cache)
+    checksums = set(digests.values())
+
+    return hash_string(''.join(sorted(list(checksums))), algorithm)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()    
     parser.add_argument("path", help="Directory path", type=str)
+    parser.add_argument("--chunk-size", help="Read buffer size per worker, e.g. 4M", default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument("--workers", help="Number of hashing processes, defaults to the usable cores", type=int)
+    parser.add_argument("--algorithm", help="Hash algorithm", default=DEFAULT_ALGORITHM, choices=available_algorithms())
+    parser.add_argument("--tree", help="Hash files as Merkle trees of TREE_CHUNK sized leaves so a single "
+                        "large file is hashed by all workers", action='store_true')
+    parser.add_argument("--tree-chunk", help="Leaf size for --tree, e.g. 64M", default=DEFAULT_TREE_CHUNK)
+    parser.add_argument("--cache", help="Checksum cache database; only files changed since they were "
+                        "cached are hashed, e.g. /var/lib/dtnaas/checksums.sqlite")
     args = parser.parse_args()    
-    print(checksum(args.path))
+    print(checksum(args.path, parse_size(args.chunk_size), args.workers,
+                   args.cache, args.algorithm,
+                   parse_size(args.tree_chunk) if args.tree else None))
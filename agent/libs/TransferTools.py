@@ -1,7 +1,9 @@
 from abc import ABC, abstractmethod
 import numa
 from libs.Schemes import NumaScheme
-import itertools
+from libs.spawn import spawn, MEM_POLICIES
+from libs.cores import get_core_allocator
+from libs.reaper import get_reaper
 import os
 import psutil
 import signal
@@ -15,8 +17,6 @@ class TransferTimeout(Exception):
         return self.msg
 
 class TransferTools(ABC):    
- 
-    local_cpu_iterator = None
 
     def __init__(self, numa_scheme = 1):
         super().__init__()
@@ -44,8 +44,63 @@ class TransferTools(ABC):
     def cleanup(cls, **optional_args):
         pass
 
+    @classmethod
+    @abstractmethod
+    def get_process(cls, **optional_args):
+        """ Return the Popen that poll_progress would wait for
+
+        None means there is nothing to wait for (poll_progress returns at
+        once). Used by the non-blocking poll modes.
+        """
+        pass
+
+    def spawn(self, args, numa_node=None, mem_policy=None, cores=1, **popen_args):
+        """ Popen args bound to numa_node per the numa scheme before exec
+
+        mem_policy ('preferred', 'bind' or 'interleave') also sets the
+        child's memory policy to numa_node. With BIND_TO_CORE the child gets
+        cores exclusive cores, released once it is reaped.
+        """
+        if mem_policy is not None and mem_policy not in MEM_POLICIES:
+            raise Exception('Unknown memory policy {}'.format(mem_policy))
+        if numa_node is None or self.numa_scheme == NumaScheme.OS_CONTROLLED or not numa.available():
+            return spawn(args, **popen_args)
+        if self.numa_scheme != NumaScheme.BIND_TO_CORE:
+            return spawn(args, cpus=self.get_cpu(numa_node), mem_policy=mem_policy, mem_nodes=(numa_node,), **popen_args)
+        allocator = get_core_allocator()
+        # placeholder owner until the pid is known
+        token = object()
+        cpus = allocator.allocate(numa_node, cores, owner=token)
+        try:
+            proc = spawn(args, cpus=cpus, mem_policy=mem_policy, mem_nodes=(numa_node,), **popen_args)
+        except Exception:
+            allocator.release(cpus, token)
+            raise
+        self.hold_cores(proc, cpus, token)
+        return proc
+
+    @staticmethod
+    def placement(optional_args):
+        """ spawn() keywords from the numa_node, mem_policy and cores request args """
+        cores = optional_args.get('cores', 1)
+        if type(cores) != int or cores < 1:
+            raise Exception('cores has to be a positive integer')
+        return {'numa_node': optional_args.get('numa_node'), 'mem_policy': optional_args.get('mem_policy'), 'cores': cores}
+
+    @staticmethod
+    def hold_cores(proc, cpus, owner):
+        """ Assign allocated cpus to proc until the reaper reaps it """
+        allocator = get_core_allocator()
+        allocator.set_owner(cpus, proc.pid, owner)
+        get_reaper().watch(proc, on_exit=lambda proc, _: allocator.release(cpus, proc.pid))
+
     def bind_proc_to_numa(self, proc, numa_num):
         if self.numa_scheme == NumaScheme.OS_CONTROLLED or not numa.available(): return
+        elif self.numa_scheme == NumaScheme.BIND_TO_CORE:
+            token = object()
+            cores_to_bind = get_core_allocator().allocate(numa_num, owner=token)
+            os.sched_setaffinity(proc.pid, cores_to_bind)
+            self.hold_cores(proc, cores_to_bind, token)
         else: 
             cores_to_bind = self.get_cpu(numa_num)
             os.sched_setaffinity(proc.pid, cores_to_bind)
@@ -54,9 +109,8 @@ class TransferTools(ABC):
         if self.numa_scheme == NumaScheme.BIND_TO_NUMA:
             return numa.node_to_cpus(numa_num)
         elif self.numa_scheme == NumaScheme.BIND_TO_CORE:
-            if TransferTools.local_cpu_iterator == None:
-                TransferTools.local_cpu_iterator = itertools.cycle(numa.node_to_cpus(numa_num))
-            return TransferTools.local_cpu_iterator.next()
+            # cores are handed out (and released) by spawn()
+            raise Exception('BIND_TO_CORE cpus come from the core allocator')
         else: raise Exception('Incorrect Numa Affinity Scheme')
         
     def kill_proc_tree(pid, sig=signal.SIGTERM, include_parent=True,
@@ -0,0 +1,78 @@
+import logging
+import os
+import sqlite3
+import threading
+
+DEFAULT_CACHE_PATH = '/var/lib/dtnaas/checksums.sqlite'
+
+class ChecksumCache:
+    """ Persistent file digests keyed by (device, inode, size, mtime_ns, algorithm)
+
+    A row is only returned when the file still has the size and mtime_ns it
+    had when it was hashed, so a changed file is always rehashed. There is
+    one row per (device, inode, algorithm); rehashing a file replaces it.
+
+    hit_counter and miss_counter can be any objects with an inc(amount)
+    method, e.g. prometheus Counters.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, hit_counter=None, miss_counter=None):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.hit_counter = hit_counter
+        self.miss_counter = miss_counter
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.db:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS checksums (dev INTEGER, ino INTEGER, '
+                            'size INTEGER, mtime_ns INTEGER, algorithm TEXT, digest TEXT, '
+                            'PRIMARY KEY (dev, ino, algorithm))')
+
+    @staticmethod
+    def file_key(path):
+        st = os.stat(path)
+        return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def lookup(self, paths, algorithm):
+        """ Split paths into ({path: digest} cache hits, {path: key} misses) """
+        hits, misses = {}, {}
+        with self.lock:
+            for path in paths:
+                key = self.file_key(path)
+                row = self.db.execute('SELECT digest FROM checksums WHERE dev=? AND ino=? AND size=? '
+                                      'AND mtime_ns=? AND algorithm=?', key + (algorithm,)).fetchone()
+                if row is None:
+                    misses[path] = key
+                else:
+                    hits[path] = row[0]
+            self.hits += len(hits)
+            self.misses += len(misses)
+        if self.hit_counter is not None:
+            self.hit_counter.inc(len(hits))
+        if self.miss_counter is not None:
+            self.miss_counter.inc(len(misses))
+        return hits, misses
+
+    def store(self, keyed_digests, algorithm):
+        """ Save an iterable of (key, digest) pairs, key as returned by lookup """
+        rows = [key + (algorithm, digest) for key, digest in keyed_digests]
+        with self.lock, self.db:
+            self.db.executemany('INSERT OR REPLACE INTO checksums VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+    def stats(self):
+        return {'path': self.path, 'hits': self.hits, 'misses': self.misses}
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+def open_cache(path=DEFAULT_CACHE_PATH, **kwargs):
+    """ Open the cache, or return None (and hash everything) if it can't be """
+    try:
+        return ChecksumCache(path, **kwargs)
+    except (OSError, sqlite3.Error) as e:
+        logging.warning('checksum cache at {} disabled: {}'.format(path, e))
+        return None
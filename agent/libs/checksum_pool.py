@@ -0,0 +1,224 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from libs.hashing import hash_file, hash_range, tree_ranges, merkle_root, DEFAULT_CHUNK_SIZE, LEAF_PREFIX
+
+# files are grouped into tasks of roughly this many bytes so that small files
+# don't cost one IPC round trip each
+DEFAULT_BATCH_BYTES = 256 << 20
+MAX_BATCH_FILES = 512
+# leaf size of tree (Merkle) hashes
+DEFAULT_TREE_CHUNK = 64 << 20
+
+# workers are forked from a single threaded server process rather than from
+# the agent, which has the file index, reaper and sampler threads running
+if 'forkserver' in multiprocessing.get_all_start_methods():
+    POOL_CONTEXT = multiprocessing.get_context('forkserver')
+    # the server has the hashing code imported already; workers still import
+    # the main module (guarded by __name__) like with spawn
+    POOL_CONTEXT.set_forkserver_preload([__name__])
+else:
+    POOL_CONTEXT = multiprocessing.get_context('spawn')
+
+def parse_cpulist(cpulist):
+    """ Parse a sysfs cpulist such as '0-7,16-23' into a set of cpu ids """
+    cpus = set()
+    for part in cpulist.strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-')
+            cpus.update(range(int(first), int(last) + 1))
+        else:
+            cpus.add(int(part))
+    return cpus
+
+def node_cpus(numa_node):
+    with open('/sys/devices/system/node/node{}/cpulist'.format(numa_node)) as fh:
+        return parse_cpulist(fh.read())
+
+def _init_worker(cpus):
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+
+def _noop(_):
+    return os.getpid()
+
+def hash_batch(paths, algorithm, chunk_size):
+    return [(path, hash_file(path, algorithm, chunk_size)) for path in paths]
+
+def hash_ranges(units, algorithm, chunk_size):
+    return [(path, offset, hash_range(path, offset, length, algorithm, chunk_size, LEAF_PREFIX))
+            for path, offset, length in units]
+
+def make_batches(files, batch_bytes=DEFAULT_BATCH_BYTES, max_files=MAX_BATCH_FILES):
+    """ Group (item, size) pairs into batches of items, largest first
+
+    Files at least batch_bytes big get a batch of their own. Smaller ones are
+    packed in descending size order until a batch reaches batch_bytes or
+    max_files. Handing batches out in this order to whichever worker is idle
+    (longest processing time first) keeps a single huge file from being
+    queued behind many small ones.
+    """
+    batches = []
+    current, current_bytes = [], 0
+    for item, size in sorted(files, key=lambda f: f[1], reverse=True):
+        if size >= batch_bytes:
+            batches.append([item])
+            continue
+        current.append(item)
+        current_bytes += size
+        if current_bytes >= batch_bytes or len(current) >= max_files:
+            batches.append(current)
+            current, current_bytes = [], 0
+    if current:
+        batches.append(current)
+    return batches
+
+class ChecksumScheduler:
+    """ Warm process pool that hashes file sets balanced by bytes """
+
+    def __init__(self, workers=None, numa_node=None, batch_bytes=DEFAULT_BATCH_BYTES):
+        cpus = None
+        if numa_node is not None:
+            cpus = node_cpus(numa_node)
+        if workers is None:
+            workers = len(cpus or os.sched_getaffinity(0))
+        self.workers = workers
+        self.cpus = cpus
+        self.batch_bytes = batch_bytes
+        self.lock = threading.Lock()
+        self.pool = self._new_pool()
+
+    def _new_pool(self):
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=POOL_CONTEXT,
+                                   initializer=_init_worker, initargs=(self.cpus,))
+
+    def _replace_pool(self, broken):
+        """ Swap in a new pool once a worker died, unless another thread already did """
+        with self.lock:
+            if self.pool is broken:
+                self.pool = self._new_pool()
+                broken.shutdown(wait=False, cancel_futures=True)
+
+    def _submit(self, fn, batches, *args):
+        """ Submit fn(batch, *args) for every batch, returns (pool, futures) """
+        pool = self.pool
+        try:
+            return pool, [pool.submit(fn, batch, *args) for batch in batches]
+        except BrokenProcessPool:
+            self._replace_pool(pool)
+        pool = self.pool
+        return pool, [pool.submit(fn, batch, *args) for batch in batches]
+
+    def warm(self):
+        """ Start every worker process now rather than on first use """
+        for _ in self._completed(*self._submit(_noop, range(self.workers))):
+            pass
+
+    def hash_files(self, files, algorithm='md5', chunk_size=DEFAULT_CHUNK_SIZE, callback=None, cache=None):
+        """ Hash (path, size) pairs and return {path: hexdigest}
+
+        With a ChecksumCache only files whose (device, inode, size, mtime_ns)
+        changed since they were last hashed are sent to the workers.
+        callback, if given, is called with (files done, bytes done) every
+        time a batch completes (cache hits are reported as one batch).
+        """
+        sizes = dict(files)
+        results, keys = self._lookup(files, algorithm, callback, cache)
+        files = [(path, size) for path, size in files if path not in results]
+
+        pool, futures = self._submit(hash_batch, make_batches(files, self.batch_bytes), algorithm, chunk_size)
+        for batch_result in self._completed(pool, futures):
+            results.update(batch_result)
+            if cache is not None:
+                cache.store([(keys[path], digest) for path, digest in batch_result], algorithm)
+            if callback is not None:
+                callback(len(batch_result), sum(sizes[path] for path, _ in batch_result))
+        return results
+
+    def tree_hash_files(self, files, algorithm='md5', tree_chunk=DEFAULT_TREE_CHUNK,
+                        chunk_size=DEFAULT_CHUNK_SIZE, callback=None, cache=None, leaves=None):
+        """ Hash (path, size) pairs as Merkle trees and return {path: root}
+
+        Every file is cut into tree_chunk sized leaves that are hashed in
+        parallel across the pool, so a single large file uses every worker.
+        If leaves is a dict it is filled with {path: [(offset, length, digest)]}
+        (the cache only holds roots, so it is not used in that case).
+        """
+        cache_algorithm = 'merkle:{}:{}'.format(algorithm, tree_chunk)
+        if leaves is not None:
+            cache = None
+        results, keys = self._lookup(files, cache_algorithm, callback, cache)
+
+        units = []
+        # {path: {offset: (length, digest)}} and {path: leaves not hashed yet}
+        pending = {}
+        remaining = {}
+        for path, size in files:
+            if path in results:
+                continue
+            ranges = tree_ranges(size, tree_chunk)
+            pending[path] = {offset: (length, None) for offset, length in ranges}
+            remaining[path] = len(ranges)
+            units.extend(((path, offset, length), length) for offset, length in ranges)
+
+        pool, futures = self._submit(hash_ranges, make_batches(units, self.batch_bytes), algorithm, chunk_size)
+        for batch_result in self._completed(pool, futures):
+            files_done = 0
+            bytes_done = 0
+            for path, offset, digest in batch_result:
+                length, _ = pending[path][offset]
+                pending[path][offset] = (length, digest)
+                bytes_done += length
+                remaining[path] -= 1
+                if not remaining[path]:
+                    del remaining[path]
+                    file_leaves = sorted((offset, length, digest) for offset, (length, digest) in pending.pop(path).items())
+                    results[path] = merkle_root([leaf[2] for leaf in file_leaves], algorithm)
+                    files_done += 1
+                    if cache is not None:
+                        cache.store([(keys[path], results[path])], cache_algorithm)
+                    if leaves is not None:
+                        leaves[path] = file_leaves
+            if callback is not None:
+                callback(files_done, bytes_done)
+        return results
+
+    def _lookup(self, files, algorithm, callback, cache):
+        if cache is None:
+            return {}, {}
+        sizes = dict(files)
+        hits, keys = cache.lookup(list(sizes), algorithm)
+        if hits and callback is not None:
+            callback(len(hits), sum(sizes[path] for path in hits))
+        return hits, keys
+
+    def _completed(self, pool, futures):
+        try:
+            for future in as_completed(futures):
+                yield future.result()
+        except BrokenProcessPool:
+            # this request fails, the next one gets fresh workers
+            self._replace_pool(pool)
+            raise
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+    def shutdown(self):
+        self.pool.shutdown(wait=True, cancel_futures=True)
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+def get_scheduler(workers=None, numa_node=None):
+    """ Return the process wide scheduler, creating it on first use """
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = ChecksumScheduler(workers=workers, numa_node=numa_node)
+        return _scheduler
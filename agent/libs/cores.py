@@ -0,0 +1,107 @@
+import logging
+import os
+import threading
+import numa
+from libs.checksum_pool import parse_cpulist
+
+def thread_siblings(cpu):
+    """ SMT siblings of cpu (including cpu itself) """
+    try:
+        with open('/sys/devices/system/cpu/cpu{}/topology/thread_siblings_list'.format(cpu)) as fh:
+            return parse_cpulist(fh.read())
+    except OSError:
+        return {cpu}
+
+class CoreAllocator:
+    """ Hands out cores of a NUMA node exclusively, one set per transfer
+
+    Every node has a pool of free cores (the node's cpus the agent may run
+    on). allocate() takes cores out of the pool and release() puts them
+    back; tools release them once the transfer's process is reaped. With
+    avoid_siblings a core is only handed out while none of its SMT siblings
+    is in use, as long as the node has such cores left. When the pool runs
+    dry the whole node is returned instead, shared, and counted as
+    oversubscribed.
+    """
+
+    def __init__(self, node_to_cpus=None, avoid_siblings=False):
+        self.node_to_cpus = node_to_cpus or numa.node_to_cpus
+        self.avoid_siblings = avoid_siblings
+        self.lock = threading.Lock()
+        # node -> sorted cpus of the node
+        self.nodes = {}
+        # cpu -> owner, the pid of the transfer once it is spawned
+        self.assigned = {}
+        self.siblings = {}
+        self.oversubscribed = 0
+
+    def _node(self, node):
+        if node not in self.nodes:
+            cpus = set(self.node_to_cpus(node)) & os.sched_getaffinity(0)
+            if not cpus:
+                raise Exception('No usable cpu on numa node {}'.format(node))
+            self.nodes[node] = sorted(cpus)
+            for cpu in cpus:
+                self.siblings[cpu] = thread_siblings(cpu) - {cpu}
+        return self.nodes[node]
+
+    def allocate(self, node, count=1, owner=None):
+        """ Take count free cores of node and return them as a set """
+        with self.lock:
+            cpus = self._node(node)
+            free = [cpu for cpu in cpus if cpu not in self.assigned]
+            chosen = []
+            if self.avoid_siblings:
+                for cpu in free:
+                    if len(chosen) == count:
+                        break
+                    if not any(sibling in self.assigned or sibling in chosen for sibling in self.siblings[cpu]):
+                        chosen.append(cpu)
+            # not enough whole cores left, use free siblings as well
+            for cpu in free:
+                if len(chosen) == count:
+                    break
+                if cpu not in chosen:
+                    chosen.append(cpu)
+            if len(chosen) < count:
+                self.oversubscribed += 1
+                logging.warning('numa node {} has {} free cores, {} wanted; sharing the node'.format(
+                    node, len(free), count))
+                return set(cpus)
+            for cpu in chosen:
+                self.assigned[cpu] = owner
+            return set(chosen)
+
+    def set_owner(self, cpus, owner, previous=None):
+        """ Hand the cpus previous holds over to owner """
+        with self.lock:
+            for cpu in cpus:
+                if cpu in self.assigned and self.assigned[cpu] == previous:
+                    self.assigned[cpu] = owner
+
+    def release(self, cpus, owner=None):
+        """ Return the cpus owner holds to their pools """
+        with self.lock:
+            for cpu in cpus:
+                if cpu in self.assigned and self.assigned[cpu] == owner:
+                    del self.assigned[cpu]
+
+    def stats(self):
+        with self.lock:
+            return {'avoid_siblings': self.avoid_siblings, 'oversubscribed': self.oversubscribed,
+                    'nodes': {node: {'cpus': cpus,
+                                     'free': [cpu for cpu in cpus if cpu not in self.assigned],
+                                     'assigned': {cpu: self.assigned[cpu] if isinstance(self.assigned[cpu], int) else None
+                                                  for cpu in cpus if cpu in self.assigned}}
+                              for node, cpus in sorted(self.nodes.items())}}
+
+_allocator = None
+_allocator_lock = threading.Lock()
+
+def get_core_allocator():
+    """ Return the process wide core allocator, creating it on first use """
+    global _allocator
+    with _allocator_lock:
+        if _allocator is None:
+            _allocator = CoreAllocator()
+        return _allocator
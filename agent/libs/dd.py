@@ -1,10 +1,11 @@
 from libs.TransferTools import TransferTools, TransferTimeout
+from libs.supervisor import get_supervisor
 import subprocess
 import logging
 import sys, os, time
 
 class dd(TransferTools):
-    running_cli_threads = {}
+    # receivers are supervised keyed by pid
     
     def __init__(self, numa_scheme = 1, **optional_args) -> None:        
         super().__init__(numa_scheme = numa_scheme)         
@@ -25,31 +26,40 @@ class dd(TransferTools):
             return {'result' : False, 'error' : 'No file Specified'}
 
         else:
-            iflags = 'direct'
-            oflags = 'direct'
-            if 'direct' in optional_args and optional_args['direct'] == False:
-                iflags = iflags.replace('direct', '')
-                oflags = oflags.replace('direct', '')
+            cmd = ['dd', 'if={}'.format(srcfile), 'of={}'.format(dstfile)]
+            if optional_args.get('direct', True) != False:
+                cmd += ['iflag=direct', 'oflag=direct']
             
             if 'blocksize' in optional_args and type(optional_args['blocksize']) == int:
                 blocksize = optional_args['blocksize']
             else:
                 blocksize = '128M'
-            
-            cmd = 'dd if={} iflag={} of={} oflag={} bs={}'.format(srcfile, iflags, dstfile, oflags, blocksize)
+            cmd.append('bs={}'.format(blocksize))
         logging.debug(cmd)
-        proc = subprocess.Popen('exec ' + cmd, shell=True, stdout = sys.stdout, stderr = sys.stderr)
-        if 'numa_node' in optional_args:
-            super().bind_proc_to_numa(proc, optional_args['numa_node'])
-        dd.running_cli_threads[proc.pid] = proc
-        return {'pid' : proc.pid, 'result': True, 'cport' : proc.pid}
+        proc = self.spawn(cmd, **self.placement(optional_args),
+                          stdout = sys.stdout, stderr = sys.stderr)
+        transfer = get_supervisor().add('dd', proc, key=proc.pid)
+        return {'pid' : proc.pid, 'result': True, 'cport' : proc.pid, 'transfer_id': transfer.id}
+
+    @staticmethod
+    def find_transfer(pid):
+        transfer = get_supervisor().find('dd', key=pid)
+        if transfer is None:
+            raise Exception('dd is not running with pid {}'.format(pid))
+        return transfer
 
     @classmethod
     def free_port(cls, pid, **optional_args):        
-        err_thread = dd.running_cli_threads[pid]
-        err_thread[0].kill()
-        err_thread[0].kill()
-        err_thread[0].communicate()             
+        supervisor = get_supervisor()
+        transfer = dd.find_transfer(pid)
+        supervisor.kill(transfer)
+        supervisor.release(transfer)
+
+    @classmethod
+    def get_process(cls, **optional_args):
+        if optional_args.get('node') == 'sender':
+            return None
+        return dd.find_transfer(optional_args.get('pid')).proc
 
     @classmethod
     def poll_progress(cls, **optional_args):
@@ -68,21 +78,18 @@ class dd(TransferTools):
             logging.debug('sender not supported')
             return 0
         elif optional_args['node'] == 'receiver':
-            threads = dd.running_cli_threads
-            # logging.debug('threads: ' + str(threads))
+            supervisor = get_supervisor()
+            transfer = dd.find_transfer(pid)
             try:                
-                proc = dd.running_cli_threads[pid]
-                proc.communicate(timeout=timeout)
-                threads.pop(pid)
+                supervisor.wait(transfer, timeout)
+                supervisor.release(transfer)
                 if optional_args['dstfile'] == None:
-                    return proc.returncode, None
+                    return transfer.returncode, None
                 else:    
-                    return proc.returncode, os.path.getsize(optional_args.pop('dstfile'))
+                    return transfer.returncode, os.path.getsize(optional_args.pop('dstfile'))
             except subprocess.TimeoutExpired:
-                err_thread = threads.pop(pid)
-                err_thread[0].kill()
-                err_thread[0].kill()
-                err_thread[0].communicate()                
+                supervisor.kill(transfer)
+                supervisor.release(transfer)
                 logging.error('receiver timed out on port %s' % pid)
                 raise Exception('receiver timed out on port %s' % pid)
             
@@ -92,12 +99,7 @@ class dd(TransferTools):
 
     @classmethod
     def cleanup(cls, **optional_args):        
-        for i in dd.running_cli_threads.items():
-            i[1].kill()
-            i[1].kill()
-            i[1].communicate()
-
-        dd.running_cli_threads = {}        
-
-        # nuttcp.cports = list(range(nuttcp_port, nuttcp_port+ 999))
-        # nuttcp.dports = list(range(nuttcp_port + 1000, nuttcp_port + 1999))
\ No newline at end of file
+        supervisor = get_supervisor()
+        for transfer in supervisor.active('dd'):
+            supervisor.kill(transfer)
+            supervisor.release(transfer)
\ No newline at end of file
@@ -0,0 +1,287 @@
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import threading
+import time
+from collections import namedtuple
+from libs.listing import scan_tree, new_summary, add_to_summary
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+# events that change the directory itself, not just a file in it
+DIR_CHANGED = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO
+EVENT_HEADER = struct.Struct('iIII')
+
+# the subset of os.stat_result that listings need
+IndexStat = namedtuple('IndexStat', ['st_size', 'st_mtime', 'st_mode'])
+
+class IndexEntry:
+    """ os.DirEntry look-alike served from the index """
+    __slots__ = ('name', 'path', '_stat', '_is_dir')
+
+    def __init__(self, name, path, stat_res, is_dir):
+        self.name = name
+        self.path = path
+        self._stat = stat_res
+        self._is_dir = is_dir
+
+    def stat(self):
+        return self._stat
+
+    def is_dir(self, follow_symlinks=True):
+        return self._is_dir
+
+class Inotify:
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._rm_watch = libc.inotify_rm_watch
+        self.fd = libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        wd = self._add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def rm_watch(self, wd):
+        self._rm_watch(self.fd, wd)
+
+    def read_events(self):
+        try:
+            buf = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(buf):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(buf, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(buf[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            yield wd, mask, name
+
+    def close(self):
+        os.close(self.fd)
+
+class FileIndex:
+    """ In-memory metadata index (size, mtime, type) of a directory tree
+
+    The index is built with a full scan and kept current with inotify
+    watches on every directory. When the watch limit is hit (or inotify is
+    unavailable) it falls back to rescanning the tree every rescan_interval
+    seconds. Listings are answered from memory in the same order and with
+    the same cursor semantics as libs.listing.scan_tree.
+    """
+
+    def __init__(self, root, rescan_interval=300):
+        self.root = os.path.abspath(root)
+        self.rescan_interval = rescan_interval
+        # directory path -> {name: IndexStat}
+        self.dirs = {}
+        self.lock = threading.Lock()
+        self.inotify = None
+        self.watches = {}
+        self.watching = False
+        self.ready = False
+        self.last_scan = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        try:
+            self.inotify = Inotify()
+            self.watching = True
+        except (OSError, AttributeError) as e:
+            logging.warning('inotify unavailable, falling back to periodic rescans: {}'.format(e))
+        self.rescan()
+        self._thread = threading.Thread(target=self._run, name='file-index', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+
+    def covers(self, path):
+        path = os.path.abspath(path)
+        return self.ready and (path == self.root or path.startswith(self.root + os.sep))
+
+    def stats(self):
+        with self.lock:
+            num_entries = sum(len(children) for children in self.dirs.values())
+            return {'root': self.root, 'ready': self.ready, 'watching': self.watching,
+                    'watches': len(self.watches), 'entries': num_entries,
+                    'last_scan': self.last_scan}
+
+    def list_dir(self, path):
+        with self.lock:
+            children = self.dirs.get(path)
+            if children is None:
+                raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+            items = [(name, os.path.join(path, name), st) for name, st in sorted(children.items())]
+            return [IndexEntry(name, child, st, child in self.dirs) for name, child, st in items]
+
+    def scan_tree(self, dirname, cursor=None):
+        dirname = os.path.abspath(dirname)
+        return scan_tree(dirname, cursor, list_dir=self.list_dir)
+
+    def summarize(self, dirname):
+        dirname = os.path.abspath(dirname)
+        summary = new_summary()
+        with self.lock:
+            if dirname not in self.dirs:
+                raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), dirname)
+            stack = [dirname]
+            while stack:
+                path = stack.pop()
+                for name, st in self.dirs.get(path, {}).items():
+                    add_to_summary(summary, st.st_mode, st.st_size)
+                    child = os.path.join(path, name)
+                    if child in self.dirs:
+                        stack.append(child)
+        return summary
+
+    def _watch(self, path):
+        if not self.watching:
+            return
+        try:
+            wd = self.inotify.add_watch(path)
+        except OSError as e:
+            if e.errno == errno.ENOSPC:
+                logging.warning('inotify watch limit reached, falling back to periodic rescans')
+                with self.lock:
+                    self._drop_inotify()
+            return
+        with self.lock:
+            # a directory that is watched again (rescan, rename) keeps its wd
+            self.watches[wd] = path
+
+    def _drop_inotify(self):
+        # called with the lock held
+        self.watching = False
+        self.watches = {}
+        self.inotify.close()
+        self.inotify = None
+
+    def _scan(self, top):
+        """ Scan the subtree at top and return its {dir: {name: IndexStat}} map """
+        dirs = {}
+        stack = [top]
+        while stack:
+            path = stack.pop()
+            self._watch(path)
+            children = {}
+            try:
+                with os.scandir(path) as it:
+                    for entry in it:
+                        try:
+                            st = entry.stat()
+                            children[entry.name] = IndexStat(st.st_size, st.st_mtime, st.st_mode)
+                            if entry.is_dir(follow_symlinks=False):
+                                stack.append(entry.path)
+                        except OSError:
+                            continue
+            except OSError:
+                continue
+            dirs[path] = children
+        return dirs
+
+    def rescan(self):
+        start = time.time()
+        dirs = self._scan(self.root)
+        with self.lock:
+            if self.watching:
+                # directories that are gone lost their watch with IN_IGNORED,
+                # these are left over from missed events
+                for wd in [wd for wd, d in self.watches.items() if d not in dirs]:
+                    self.inotify.rm_watch(wd)
+                    del self.watches[wd]
+            self.dirs = dirs
+            self.ready = True
+            self.last_scan = time.time()
+        logging.debug('indexed {} in {:.2f}s'.format(self.root, time.time() - start))
+
+    def _remove_subtree(self, path):
+        prefix = path + os.sep
+        for dirpath in [d for d in self.dirs if d == path or d.startswith(prefix)]:
+            del self.dirs[dirpath]
+        if self.watching:
+            for wd in [wd for wd, d in self.watches.items() if d == path or d.startswith(prefix)]:
+                self.inotify.rm_watch(wd)
+                del self.watches[wd]
+
+    def _refresh(self, path):
+        parent, name = os.path.split(path)
+        try:
+            st = os.stat(path)
+        except OSError:
+            with self.lock:
+                self.dirs.get(parent, {}).pop(name, None)
+                self._remove_subtree(path)
+            return
+        is_new_dir = os.path.isdir(path) and not os.path.islink(path) and path not in self.dirs
+        subtree = self._scan(path) if is_new_dir else {}
+        with self.lock:
+            if parent in self.dirs:
+                self.dirs[parent][name] = IndexStat(st.st_size, st.st_mtime, st.st_mode)
+            self.dirs.update(subtree)
+
+    def _run(self):
+        while not self._stop.is_set():
+            if not self.watching:
+                if self._stop.wait(self.rescan_interval):
+                    break
+                self.rescan()
+                continue
+
+            readable, _, _ = select.select([self.inotify.fd], [], [], 1)
+            if not readable:
+                continue
+            changed = set()
+            overflow = False
+            for wd, mask, name in self.inotify.read_events():
+                if mask & IN_Q_OVERFLOW:
+                    overflow = True
+                    break
+                with self.lock:
+                    if mask & IN_IGNORED:
+                        self.watches.pop(wd, None)
+                        continue
+                    dirpath = self.watches.get(wd)
+                if dirpath is None:
+                    continue
+                changed.add(os.path.join(dirpath, name) if name else dirpath)
+                if mask & DIR_CHANGED:
+                    # the directory's own mtime moves with its entries
+                    changed.add(dirpath)
+            if overflow:
+                logging.warning('inotify queue overflow, rescanning {}'.format(self.root))
+                self.rescan()
+                continue
+            # one stat per path per batch no matter how many events it got
+            for path in changed:
+                if path != self.root:
+                    self._refresh(path)
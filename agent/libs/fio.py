@@ -1,12 +1,17 @@
 from libs.TransferTools import TransferTools
+from libs.iostats import record_fio_output
+from libs.supervisor import get_supervisor
 import subprocess
 import logging
+import tempfile
+import itertools
+import signal
 import sys, os, glob
 
 class fio(TransferTools):   
 
-    running_threads = {}
-    proc_index = 0
+    # runs are supervised keyed by their index, which is returned as cport
+    proc_index = itertools.count()
 
     def __init__(self, **optional_args) -> None:
         return 
@@ -38,21 +43,55 @@ class fio(TransferTools):
             iomode = optional_args['iomode']
 
         os.makedirs(os.path.dirname(dstfile), exist_ok=True)        
+        index = next(fio.proc_index)
+        # results of each run go to their own file and are parsed on poll
+        fd, output = tempfile.mkstemp(prefix='fio-', suffix='.json')
+        os.close(fd)
         
         proc = subprocess.Popen(['fio', '--thread', '--direct=1', '--rw=%s'%iomode,  '--ioengine=sync', '--bs=%sk'%blocksize, '--iodepth=32', 
-        '--name=index_%s'% fio.proc_index, '--filename=%s'%dstfile ], stdout = sys.stdout, stderr = sys.stdout)
-        fio.running_threads[fio.proc_index] = proc
-        fio.proc_index += 1
-        return {'result': True, 'cport' : fio.proc_index-1}
+        '--name=index_%s'% index, '--filename=%s'%dstfile, '--output-format=json+', '--output=%s'%output],
+        stdout = sys.stdout, stderr = sys.stdout)
+        transfer = get_supervisor().add('fio', proc, key=index, output=output)
+        return {'result': True, 'cport' : index, 'transfer_id': transfer.id}
+
+    @staticmethod
+    def find_transfer(index):
+        transfer = get_supervisor().find('fio', key=index)
+        if transfer is None:
+            raise Exception('fio is not running')
+        return transfer
 
     @classmethod
     def free_port(cls, port, **optional_args):
-        threads = fio.running_threads
-        err_thread = threads.pop(port)
-        err_thread.kill()
-        err_thread.kill()
-        err_thread.communicate()
-        pass
+        supervisor = get_supervisor()
+        transfer = fio.find_transfer(port)
+        supervisor.kill(transfer)
+        supervisor.release(transfer)
+        fio.remove_output(transfer.info['output'])
+
+    @staticmethod
+    def remove_output(output):
+        try:
+            os.remove(output)
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def read_output(output):
+        """ Parse and record a finished run's json+ output, None if there is none """
+        try:
+            with open(output) as fh:
+                return record_fio_output('fio', fh.read())
+        except FileNotFoundError:
+            return None
+        finally:
+            fio.remove_output(output)
+
+    @classmethod
+    def get_process(cls, **optional_args):
+        if optional_args.get('node') == 'sender':
+            return None
+        return fio.find_transfer(optional_args.get('cport')).proc
 
     @classmethod
     def poll_progress(cls, **optional_args):
@@ -68,24 +107,24 @@ class fio(TransferTools):
             return 0
         logging.debug('polling fio index {}'.format(optional_args['cport']))
 
-        if len(fio.running_threads) < 1 or optional_args['cport'] not in fio.running_threads:
-            raise Exception('fio is not running')
-
-        proc = fio.running_threads[optional_args['cport']]
-        proc.communicate(timeout=None)
-        del fio.running_threads[optional_args['cport']]
+        supervisor = get_supervisor()
+        transfer = fio.find_transfer(optional_args['cport'])
+        supervisor.wait(transfer)
+        supervisor.release(transfer)
+        stats = fio.read_output(transfer.info['output'])
 
         if optional_args['dstfile'] == None:
-            return proc.returncode, None
+            return transfer.returncode, None, stats
         else:    
-            return proc.returncode, os.path.getsize(optional_args.pop('dstfile'))        
+            return transfer.returncode, os.path.getsize(optional_args.pop('dstfile')), stats
         
     @classmethod
     def cleanup(cls, **optional_args):
         logging.debug('cleaning up fio threads')
-        try:
-            for _, proc in fio.running_threads.items():
-                TransferTools.kill_proc_tree(proc.pid)
-                proc.communicate()                
-        finally:            
-            fio.running_threads = {}
\ No newline at end of file
+        supervisor = get_supervisor()
+        for transfer in supervisor.active('fio'):
+            try:
+                supervisor.kill(transfer, tree=True, sig=signal.SIGTERM)
+            finally:
+                supervisor.release(transfer)
+                fio.remove_output(transfer.info['output'])
\ No newline at end of file
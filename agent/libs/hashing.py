@@ -0,0 +1,254 @@
+import argparse
+import fcntl
+import hashlib
+import os
+import threading
+import time
+import zlib
+from libs.units import parse_size
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+try:
+    import crc32c
+except ImportError:
+    crc32c = None
+
+DEFAULT_CHUNK_SIZE = 4 << 20
+DEFAULT_ALGORITHM = 'md5'
+# domain separation of Merkle tree leaves and inner nodes (as in RFC 6962)
+LEAF_PREFIX = b'\x00'
+NODE_PREFIX = b'\x01'
+
+HASHLIB_ALGORITHMS = ['md5', 'sha1', 'sha256', 'sha512', 'blake2b', 'blake2s']
+XXHASH_ALGORITHMS = ['xxh64', 'xxh3_64', 'xxh3_128', 'xxh128']
+
+class CRCHash:
+    """ hashlib style wrapper around a running crc function """
+
+    def __init__(self, crc_func):
+        self.crc_func = crc_func
+        self.value = 0
+
+    def update(self, data):
+        self.value = self.crc_func(data, self.value)
+
+    def hexdigest(self):
+        return '{:08x}'.format(self.value)
+
+def available_algorithms():
+    algorithms = list(HASHLIB_ALGORITHMS) + ['crc32']
+    if xxhash is not None:
+        algorithms += [i for i in XXHASH_ALGORITHMS if hasattr(xxhash, i)]
+    if crc32c is not None:
+        algorithms.append('crc32c')
+    return algorithms
+
+def new_hasher(algorithm=DEFAULT_ALGORITHM):
+    """ Return an object with update() and hexdigest() for algorithm
+
+    hashlib algorithms are always there, xxhash and crc32c ones only when the
+    xxhash/crc32c packages are installed.
+    """
+    if algorithm in HASHLIB_ALGORITHMS:
+        return hashlib.new(algorithm)
+    elif algorithm == 'crc32':
+        return CRCHash(zlib.crc32)
+    elif algorithm == 'crc32c' and crc32c is not None:
+        return CRCHash(crc32c.crc32c)
+    elif algorithm in XXHASH_ALGORITHMS and xxhash is not None and hasattr(xxhash, algorithm):
+        return getattr(xxhash, algorithm)()
+    raise ValueError('Unsupported hash algorithm {}, available: {}'.format(
+        algorithm, ', '.join(available_algorithms())))
+
+def hash_string(data, algorithm=DEFAULT_ALGORITHM):
+    hasher = new_hasher(algorithm)
+    hasher.update(data.encode('utf8'))
+    return hasher.hexdigest()
+
+_buffers = threading.local()
+
+def get_buffer(chunk_size):
+    """ Return this thread's reusable read buffer of chunk_size bytes """
+    buf = getattr(_buffers, 'buf', None)
+    if buf is None or len(buf) != chunk_size:
+        buf = memoryview(bytearray(chunk_size))
+        _buffers.buf = buf
+    return buf
+
+def hash_file(path, algorithm=DEFAULT_ALGORITHM, chunk_size=DEFAULT_CHUNK_SIZE):
+    """ Hash a file by streaming it through a fixed size buffer
+
+    Memory use is bounded by chunk_size regardless of the file size.
+    """
+    hasher = new_hasher(algorithm)
+    buf = get_buffer(chunk_size)
+    with open(path, 'rb', buffering=0) as fh:
+        while True:
+            n = fh.readinto(buf)
+            if not n:
+                break
+            hasher.update(buf[:n])
+    return hasher.hexdigest()
+
+def hash_range(path, offset, length, algorithm=DEFAULT_ALGORITHM, chunk_size=DEFAULT_CHUNK_SIZE, prefix=b''):
+    """ Hash prefix + length bytes of path starting at offset using positional reads """
+    hasher = new_hasher(algorithm)
+    hasher.update(prefix)
+    buf = get_buffer(chunk_size)
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        end = offset + length
+        while offset < end:
+            n = os.preadv(fd, [buf[:min(chunk_size, end - offset)]], offset)
+            if not n:
+                break
+            hasher.update(buf[:n])
+            offset += n
+    finally:
+        os.close(fd)
+    return hasher.hexdigest()
+
+def tree_ranges(size, tree_chunk):
+    """ Split a file of size bytes into (offset, length) leaves of tree_chunk bytes """
+    if size == 0:
+        return [(0, 0)]
+    return [(offset, min(tree_chunk, size - offset)) for offset in range(0, size, tree_chunk)]
+
+def merkle_root(leaves, algorithm=DEFAULT_ALGORITHM):
+    """ Combine hex leaf digests pairwise, H(0x01 || left || right), up to a single root
+
+    Leaves are expected to be H(0x00 || data) (hash_range with LEAF_PREFIX),
+    so a leaf can never be mistaken for an inner node. A node without a
+    sibling is carried up to the next level unchanged, so a file with a
+    single leaf has that leaf's digest as its root.
+    """
+    level = list(leaves)
+    while len(level) > 1:
+        parents = []
+        for idx in range(0, len(level) - 1, 2):
+            hasher = new_hasher(algorithm)
+            hasher.update(NODE_PREFIX + bytes.fromhex(level[idx]) + bytes.fromhex(level[idx + 1]))
+            parents.append(hasher.hexdigest())
+        if len(level) % 2:
+            parents.append(level[-1])
+        level = parents
+    return level[0]
+
+class StreamHasher(threading.Thread):
+    """ Copy a stream into a file while hashing it, in a background thread
+
+    Used to checksum data as it is received so that verifying a transfer
+    doesn't need a second read of the file. src_fd is typically the read end
+    of a pipe from the receiving process.
+    """
+
+    # grow pipes so the writer isn't woken up for every 64k
+    PIPE_SIZE = 1 << 20
+
+    def __init__(self, src_fd, dstfile, algorithm=DEFAULT_ALGORITHM, chunk_size=DEFAULT_CHUNK_SIZE):
+        super().__init__(name='stream-hasher', daemon=True)
+        self.hasher = new_hasher(algorithm)
+        self.src_fd = src_fd
+        self.dstfile = dstfile
+        self.chunk_size = chunk_size
+        self.size = 0
+        self.digest = None
+        self.error = None
+        if src_fd is not None:
+            self.attach(src_fd)
+
+    def attach(self, src_fd):
+        """ Set the descriptor to read from, for when it only exists later """
+        self.src_fd = src_fd
+        try:
+            fcntl.fcntl(src_fd, getattr(fcntl, 'F_SETPIPE_SZ', 1031), self.PIPE_SIZE)
+        except OSError:
+            pass
+
+    def run(self):
+        buf = get_buffer(self.chunk_size)
+        try:
+            with open(self.dstfile, 'wb', buffering=0) as out:
+                while True:
+                    n = os.readv(self.src_fd, [buf])
+                    if not n:
+                        break
+                    self.hasher.update(buf[:n])
+                    written = 0
+                    while written < n:
+                        written += out.write(buf[written:n])
+                    self.size += n
+            self.digest = self.hasher.hexdigest()
+        except Exception as e:
+            self.error = e
+            # keep draining so the writer doesn't block on a full pipe
+            while os.readv(self.src_fd, [buf]):
+                pass
+
+def benchmark_chunk_sizes(path, chunk_sizes, algorithm=DEFAULT_ALGORITHM, repeat=3):
+    """ Hash path once per chunk size and report the best throughput of each
+
+    The file is read once up front so that every run is served from the same
+    (warm) page cache and only the chunk size differs between runs.
+    """
+    size = os.path.getsize(path)
+    hash_file(path, algorithm, max(chunk_sizes))
+    results = []
+    for chunk_size in chunk_sizes:
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            hash_file(path, algorithm, chunk_size)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results.append({'chunk_size': chunk_size, 'seconds': best,
+                        'MBps': size / best / (1 << 20) if best else None})
+    return results
+
+def benchmark_algorithms(algorithms=None, size=1 << 30, chunk_size=DEFAULT_CHUNK_SIZE):
+    """ Hash size bytes from memory with every algorithm and report GB/s
+
+    No I/O is involved, so the numbers are the per-core ceiling of each hash
+    to compare against the read rate of the disks.
+    """
+    buf = memoryview(os.urandom(chunk_size))
+    results = []
+    for algorithm in algorithms or available_algorithms():
+        hasher = new_hasher(algorithm)
+        done = 0
+        start = time.perf_counter()
+        while done < size:
+            hasher.update(buf)
+            done += chunk_size
+        hasher.hexdigest()
+        elapsed = time.perf_counter() - start
+        results.append({'algorithm': algorithm, 'seconds': elapsed, 'GBps': done / elapsed / (1 << 30)})
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Hashing microbenchmarks')
+    subparsers = parser.add_subparsers(dest='bench', required=True)
+    chunks_parser = subparsers.add_parser('chunks', help='Compare hashing throughput per chunk size')
+    chunks_parser.add_argument("path", help="File to hash", type=str)
+    chunks_parser.add_argument("--algorithm", default=DEFAULT_ALGORITHM, type=str)
+    chunks_parser.add_argument("--chunk-sizes", default='64k,256k,1M,4M,16M,64M', type=str)
+    chunks_parser.add_argument("--repeat", default=3, type=int)
+    algorithms_parser = subparsers.add_parser('algorithms', help='Compare in-memory GB/s per algorithm')
+    algorithms_parser.add_argument("--algorithms", help="Comma separated, defaults to all available", type=str)
+    algorithms_parser.add_argument("--size", default='1G', type=str)
+    args = parser.parse_args()
+
+    if args.bench == 'chunks':
+        chunk_sizes = [parse_size(i) for i in args.chunk_sizes.split(',')]
+        for res in benchmark_chunk_sizes(args.path, chunk_sizes, args.algorithm, args.repeat):
+            # too fast to time, MBps is None
+            rate = '{:10.1f}'.format(res['MBps']) if res['MBps'] is not None else '{:>10}'.format('-')
+            print('{:>12} bytes  {:8.3f} s  {} MB/s'.format(res['chunk_size'], res['seconds'], rate))
+    else:
+        algorithms = args.algorithms.split(',') if args.algorithms else None
+        for res in benchmark_algorithms(algorithms, parse_size(args.size)):
+            print('{:>10}  {:8.3f} s  {:6.2f} GB/s'.format(res['algorithm'], res['seconds'], res['GBps']))
@@ -0,0 +1,158 @@
+import json
+import threading
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily, HistogramMetricFamily
+
+# completion latency percentiles reported per direction, as fio names them
+PERCENTILES = ['50.000000', '90.000000', '99.000000', '99.900000']
+# histogram buckets (seconds) the json+ latency bins are folded into
+LATENCY_BUCKETS = [1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3,
+                   1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+def load_fio_json(text):
+    """ Load fio --output-format=json(+) output, skipping any leading warnings """
+    start = text.find('{')
+    if start < 0:
+        raise ValueError('No JSON found in fio output')
+    return json.loads(text[start:])
+
+def bin_percentile(bins, total, percentile):
+    """ Latency at percentile of a sorted [(latency_ns, count)] list """
+    target = total * percentile / 100
+    seen = 0
+    for latency, count in bins:
+        seen += count
+        if seen >= target:
+            return latency
+    return bins[-1][0] if bins else 0
+
+def parse_fio_json(text, with_bins=False):
+    """ Summarise fio JSON output per I/O direction
+
+    Returns {'read': {...}, 'write': {...}, 'errors': [...]} where each
+    direction has bandwidth in bytes/s, iops and total bytes summed over
+    all jobs, and completion latency (clat_ns) mean, max and percentiles.
+    Directions without any I/O are left out.
+
+    With json+ output the percentiles are computed from the latency bins
+    of all jobs together; otherwise the worst per-job value is used. With
+    with_bins the merged bins are kept as clat_ns['bins'].
+    """
+    data = load_fio_json(text)
+    res = {'errors': []}
+    bins = {}
+    for job in data.get('jobs', []):
+        if job.get('error'):
+            res['errors'].append({'job': job.get('jobname'), 'error': job['error']})
+        for rw in ('read', 'write'):
+            stats = job.get(rw)
+            if not stats or not stats.get('io_bytes'):
+                continue
+            total = res.setdefault(rw, {'bw_bytes': 0, 'iops': 0.0, 'io_bytes': 0,
+                'clat_ns': {'N': 0, 'mean': 0.0, 'max': 0, 'percentile': {}}})
+            total['bw_bytes'] += stats.get('bw_bytes', stats.get('bw', 0) * 1024)
+            total['iops'] += stats.get('iops', 0)
+            total['io_bytes'] += stats['io_bytes']
+
+            clat = stats.get('clat_ns')
+            if not clat or not clat.get('N'):
+                continue
+            merged = total['clat_ns']
+            n = merged['N'] + clat['N']
+            merged['mean'] = (merged['mean'] * merged['N'] + clat['mean'] * clat['N']) / n
+            merged['N'] = n
+            merged['max'] = max(merged['max'], clat['max'])
+            for pct in PERCENTILES:
+                if pct in clat.get('percentile', {}):
+                    merged['percentile'][pct] = max(merged['percentile'].get(pct, 0), clat['percentile'][pct])
+            for latency, count in clat.get('bins', {}).items():
+                rw_bins = bins.setdefault(rw, {})
+                rw_bins[int(latency)] = rw_bins.get(int(latency), 0) + count
+
+    for rw, rw_bins in bins.items():
+        clat = res[rw]['clat_ns']
+        sorted_bins = sorted(rw_bins.items())
+        clat['percentile'] = {pct: bin_percentile(sorted_bins, sum(rw_bins.values()), float(pct))
+                              for pct in PERCENTILES}
+        if with_bins:
+            clat['bins'] = sorted_bins
+    return res
+
+class FioMetrics:
+    """ Prometheus collector for the results of fio runs
+
+    Every finished run is recorded under a source label (the tool or
+    endpoint that ran fio). Bandwidth, iops and latency percentiles are
+    gauges of the last run; bytes and the completion latency histogram
+    accumulate over all runs.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.last = {}
+        self.io_bytes = {}
+        self.histograms = {}
+
+    def record(self, source, stats):
+        """ Record parse_fio_json(..., with_bins=True) output """
+        with self.lock:
+            for rw in ('read', 'write'):
+                if rw not in stats:
+                    continue
+                key = (source, rw)
+                self.last[key] = stats[rw]
+                self.io_bytes[key] = self.io_bytes.get(key, 0) + stats[rw]['io_bytes']
+
+                buckets, total = self.histograms.setdefault(key, ([0] * (len(LATENCY_BUCKETS) + 1), [0.0]))
+                for latency, count in stats[rw]['clat_ns'].get('bins', []):
+                    latency /= 1e9
+                    idx = next((i for i, bound in enumerate(LATENCY_BUCKETS) if latency <= bound), len(LATENCY_BUCKETS))
+                    buckets[idx] += count
+                    total[0] += latency * count
+
+    def collect(self):
+        labels = ['source', 'rw']
+        bandwidth = GaugeMetricFamily('daas_agent_io_bandwidth_bytes', 'Bandwidth of the last fio run in bytes/s', labels=labels)
+        iops = GaugeMetricFamily('daas_agent_io_iops', 'IOPS of the last fio run', labels=labels)
+        percentiles = GaugeMetricFamily('daas_agent_io_clat_percentile_seconds',
+            'Completion latency percentiles of the last fio run', labels=labels + ['percentile'])
+        io_bytes = CounterMetricFamily('daas_agent_io_bytes', 'Bytes transferred by fio runs', labels=labels)
+        histogram = HistogramMetricFamily('daas_agent_io_clat_seconds', 'Completion latency of fio I/O', labels=labels)
+
+        with self.lock:
+            for key, stats in self.last.items():
+                bandwidth.add_metric(key, stats['bw_bytes'])
+                iops.add_metric(key, stats['iops'])
+                for pct, latency in stats['clat_ns']['percentile'].items():
+                    percentiles.add_metric(key + ('{:g}'.format(float(pct)),), latency / 1e9)
+                io_bytes.add_metric(key, self.io_bytes[key])
+            for key, (buckets, total) in self.histograms.items():
+                cumulative = []
+                count = 0
+                for bound, bucket in zip(LATENCY_BUCKETS + [float('inf')], buckets):
+                    count += bucket
+                    cumulative.append(('+Inf' if bound == float('inf') else '{:g}'.format(bound), count))
+                histogram.add_metric(key, cumulative, total[0])
+
+        yield bandwidth
+        yield iops
+        yield percentiles
+        yield io_bytes
+        yield histogram
+
+# shared by every tool that runs fio, registered with the app's registry
+fio_metrics = FioMetrics()
+
+def record_fio_output(source, text):
+    """ Parse fio output, record it in fio_metrics and return the summary without bins
+
+    Returns None if the output holds no fio JSON.
+    """
+    try:
+        stats = parse_fio_json(text, with_bins=True)
+    except ValueError:
+        return None
+    fio_metrics.record(source, stats)
+    for rw in ('read', 'write'):
+        if rw in stats:
+            stats[rw]['clat_ns'].pop('bins', None)
+    return stats
@@ -0,0 +1,156 @@
+import logging
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+# seconds of progress a job's current rate is computed over
+RATE_WINDOW = 10
+
+class RateWindow:
+    """ Rate of a growing counter over the last window seconds """
+
+    def __init__(self, window=RATE_WINDOW):
+        self.window = window
+        self.total = 0
+        self.samples = deque([(time.monotonic(), 0)])
+
+    def add(self, count):
+        self.total += count
+        self.samples.append((time.monotonic(), self.total))
+
+    def rate(self):
+        now = time.monotonic()
+        # the newest sample at least window old is the baseline
+        while len(self.samples) > 1 and self.samples[1][0] <= now - self.window:
+            self.samples.popleft()
+        since, baseline = self.samples[0]
+        return (self.total - baseline) / (now - since) if now > since else 0
+
+class Job:
+    """ A background task with progress counters that can be polled """
+
+    def __init__(self, kind, params=None):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.params = params or {}
+        self.status = 'pending'
+        self.progress = {}
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.future = None
+        self.rates = {}
+        self.lock = threading.Lock()
+
+    def update(self, **counters):
+        with self.lock:
+            self.progress.update(counters)
+
+    def add(self, **counters):
+        with self.lock:
+            for key, value in counters.items():
+                self.progress[key] = self.progress.get(key, 0) + value
+                if key in self.rates:
+                    self.rates[key].add(value)
+
+    def track_rate(self, counter, window=RATE_WINDOW):
+        """ Keep a sliding window rate of what add() adds to counter """
+        with self.lock:
+            self.rates[counter] = RateWindow(window)
+
+    def rate(self, counter):
+        """ Current per second rate of a tracked counter, None if it isn't tracked """
+        with self.lock:
+            window = self.rates.get(counter)
+            return window.rate() if window is not None else None
+
+    def elapsed(self):
+        if self.started is None:
+            return 0
+        return (self.finished or time.time()) - self.started
+
+    def to_dict(self):
+        with self.lock:
+            res = {'id': self.id, 'kind': self.kind, 'status': self.status,
+                   'created': self.created, 'elapsed': self.elapsed()}
+            res.update(self.params)
+            res.update(self.progress)
+        if self.error is not None:
+            res['error'] = self.error
+        if self.result is not None:
+            res['result'] = self.result
+        return res
+
+class JobManager:
+    """ Runs jobs on a thread pool and keeps the last max_finished results """
+
+    def __init__(self, max_workers=4, max_finished=100):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self.max_finished = max_finished
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+
+    def submit(self, kind, func, *args, params=None, **kwargs):
+        """ Run func(*args, job=job, **kwargs) in the background and return the job
+
+        Whatever func returns becomes job.result; an exception marks the job
+        failed with the exception as its error.
+        """
+        job = Job(kind, params)
+        with self.lock:
+            self.jobs[job.id] = job
+            self._prune()
+        job.future = self.executor.submit(self._run, job, func, args, kwargs)
+        return job
+
+    def _run(self, job, func, args, kwargs):
+        if job.status == 'cancelled':
+            return
+        job.status = 'running'
+        job.started = time.time()
+        try:
+            job.result = func(*args, job=job, **kwargs)
+            job.status = 'done'
+        except Exception as e:
+            logging.error('{} job {} failed'.format(job.kind, job.id))
+            logging.debug(traceback.format_exc())
+            job.error = '{}: {}'.format(type(e).__name__, e)
+            job.status = 'failed'
+        finally:
+            job.finished = time.time()
+
+    def _prune(self):
+        finished = [job_id for job_id, job in self.jobs.items()
+                    if job.status in ('done', 'failed', 'cancelled')]
+        for job_id in finished[:max(0, len(finished) - self.max_finished)]:
+            del self.jobs[job_id]
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list(self, kind=None):
+        with self.lock:
+            return [job for job in self.jobs.values() if kind is None or job.kind == kind]
+
+    def remove(self, job_id):
+        """ Cancel a job that has not started yet or forget a finished one
+
+        A running job can't be interrupted and is left alone; returns the job
+        or None if the id is unknown.
+        """
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            if job.status == 'pending' and job.future.cancel():
+                job.status = 'cancelled'
+                job.finished = time.time()
+            if job.status in ('done', 'failed', 'cancelled'):
+                del self.jobs[job_id]
+            return job
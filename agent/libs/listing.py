@@ -0,0 +1,159 @@
+import os
+import stat
+from concurrent.futures import ThreadPoolExecutor
+
+# upper bounds (bytes) of the file size histogram buckets returned by summaries
+SIZE_BUCKETS = [4 << 10, 64 << 10, 1 << 20, 16 << 20, 256 << 20, 1 << 30, 16 << 30, 256 << 30]
+
+def get_type(mode):
+    if stat.S_ISDIR(mode) or stat.S_ISLNK(mode):
+        type = 'dir'
+    else:
+        type = 'file'
+    return type
+
+def _cursor_parts(cursor):
+    if not cursor:
+        return []
+    return [part for part in cursor.strip('/').split('/') if part not in ('', '.')]
+
+def _sorted_entries(path):
+    with os.scandir(path) as it:
+        return sorted(it, key=lambda e: e.name)
+
+def scan_tree(dirname, cursor=None, list_dir=_sorted_entries):
+    """ Walk dirname with os.scandir and yield (relpath, stat_result) pairs
+
+    Entries are produced in a stable depth-first order (names sorted within
+    each directory) so that a relpath previously yielded can be passed back
+    as cursor to resume the walk right after it. Only one directory listing
+    per level of the tree is held in memory at a time.
+
+    The root is opened eagerly so that a missing or unreadable root raises
+    FileNotFoundError/PermissionError before the first entry is consumed.
+    Entries that vanish or become unreadable during the walk are skipped.
+
+    list_dir returns the sorted entries of a directory path; anything that
+    looks like an os.DirEntry (name, path, stat(), is_dir()) will do.
+    """
+    if not os.path.isdir(dirname):
+        # a regular file has no contents, anything else is missing
+        os.stat(dirname)
+        return iter(())
+    root_entries = list_dir(dirname)
+    return _walk(root_entries, _cursor_parts(cursor), list_dir)
+
+def _walk(root_entries, cursor, list_dir):
+    # each stack frame holds (entries, next index, relpath prefix, remaining cursor)
+    stack = [(root_entries, 0, '', cursor)]
+    while stack:
+        entries, idx, prefix, cur = stack.pop()
+        if idx >= len(entries):
+            continue
+        entry = entries[idx]
+        stack.append((entries, idx + 1, prefix, cur))
+
+        emit = True
+        child_cursor = []
+        if cur:
+            if entry.name < cur[0]:
+                continue
+            if entry.name == cur[0]:
+                # already emitted on the previous page, resume inside it
+                emit = False
+                child_cursor = cur[1:]
+            # the cursor has been passed, siblings after this one are all new
+            stack[-1] = (entries, idx + 1, prefix, [])
+
+        relpath = prefix + entry.name
+        try:
+            st = entry.stat()
+        except OSError:
+            continue
+        if emit:
+            yield relpath, st
+
+        try:
+            is_dir = entry.is_dir(follow_symlinks=False)
+        except OSError:
+            is_dir = False
+        if is_dir:
+            try:
+                children = list_dir(entry.path)
+            except OSError:
+                continue
+            stack.append((children, 0, relpath + '/', child_cursor))
+
+def file_info(relpath, stat_res):
+    return {'name': relpath, 'mtime': stat_res.st_mtime,
+            'type': get_type(stat_res.st_mode), 'size': stat_res.st_size}
+
+def new_summary():
+    return {'size': 0, 'dir': 0, 'file': 0, 'histogram': [0] * (len(SIZE_BUCKETS) + 1)}
+
+def add_to_summary(summary, mode, size):
+    ft = get_type(mode)
+    summary[ft] += 1
+    summary['size'] += size
+    if ft == 'file':
+        idx = 0
+        while idx < len(SIZE_BUCKETS) and size > SIZE_BUCKETS[idx]:
+            idx += 1
+        summary['histogram'][idx] += 1
+
+def merge_summary(summary, other):
+    for key in ('size', 'dir', 'file'):
+        summary[key] += other[key]
+    summary['histogram'] = [a + b for a, b in zip(summary['histogram'], other['histogram'])]
+    return summary
+
+def format_summary(summary):
+    """ Turn the histogram into {upper bound: count}, like prometheus le labels """
+    labels = [str(bound) for bound in SIZE_BUCKETS] + ['+Inf']
+    res = dict(summary)
+    res['histogram'] = dict(zip(labels, summary['histogram']))
+    return res
+
+def _summarize_subtree(top):
+    summary = new_summary()
+    stack = [top]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    try:
+                        st = entry.stat()
+                        add_to_summary(summary, st.st_mode, st.st_size)
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                    except OSError:
+                        continue
+        except OSError:
+            continue
+    return summary
+
+def summarize_tree(dirname, workers=None):
+    """ Count files, dirs and bytes under dirname without building entries
+
+    Each top-level subdirectory is walked in its own worker thread; scandir
+    and stat release the GIL so the walks overlap on the filesystem.
+    """
+    if not os.path.isdir(dirname):
+        os.stat(dirname)
+        return new_summary()
+    summary = new_summary()
+    subdirs = []
+    with os.scandir(dirname) as it:
+        for entry in it:
+            try:
+                st = entry.stat()
+                add_to_summary(summary, st.st_mode, st.st_size)
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+            except OSError:
+                continue
+    if subdirs:
+        with ThreadPoolExecutor(max_workers=workers or min(32, (os.cpu_count() or 1) * 4)) as executor:
+            for partial in executor.map(_summarize_subtree, subdirs):
+                merge_summary(summary, partial)
+    return summary
@@ -1,11 +1,13 @@
 from libs.TransferTools import TransferTools
+from libs.supervisor import get_supervisor
 import subprocess
 import logging
+import signal
 import sys, os
 
 class msrsync(TransferTools):   
 
-    running_thread = None
+    # runs are supervised; without a transfer_id the latest run is used
 
     def __init__(self,**optional_args ) -> None:
         return
@@ -30,21 +32,34 @@ class msrsync(TransferTools):
         if 'parallel' in optional_args and type(optional_args['parallel']) == int:
             parallel = optional_args['parallel']        
 
-        cmd = 'msrsync -p {} -P {} {}'.format(parallel, address, dstfile)
+        cmd = ['msrsync', '-p', str(parallel), '-P', address, dstfile]
         logging.debug(cmd)
-        proc = subprocess.Popen('exec ' + cmd, shell=True, stdout = sys.stdout, stderr = sys.stderr)
-        msrsync.running_thread = proc
-        return {'result': True}
+        proc = self.spawn(cmd, stdout = sys.stdout, stderr = sys.stderr)
+        transfer = get_supervisor().add('msrsync', proc)
+        return {'result': True, 'transfer_id': transfer.id}
 
-    @classmethod
-    def poll_progress(cls, **optional_args):        
-        if msrsync.running_thread == None:
+    @staticmethod
+    def find_transfer(transfer_id=None):
+        transfer = get_supervisor().find('msrsync', transfer_id=transfer_id)
+        if transfer is None:
             raise Exception('msrsync is not running')
+        return transfer
+
+    @classmethod
+    def get_process(cls, **optional_args):
+        return msrsync.find_transfer(optional_args.get('transfer_id')).proc
 
-        msrsync.running_thread.communicate(timeout=None)
+    @classmethod
+    def poll_progress(cls, **optional_args):        
+        supervisor = get_supervisor()
+        transfer = msrsync.find_transfer(optional_args.get('transfer_id'))
+        supervisor.wait(transfer)
+        supervisor.release(transfer)
         
     @classmethod
     def cleanup(cls, **optional_args):
-        logging.debug('cleaning up thread {}'.format(msrsync.running_thread.pid))
-        TransferTools.kill_proc_tree(msrsync.running_thread.pid)
-        msrsync.running_thread.communicate()
\ No newline at end of file
+        # stopped runs stay around until they're polled
+        supervisor = get_supervisor()
+        for transfer in supervisor.active('msrsync'):
+            logging.debug('cleaning up thread {}'.format(transfer.proc.pid))
+            supervisor.kill(transfer, tree=True, sig=signal.SIGTERM)
\ No newline at end of file
@@ -0,0 +1,174 @@
+from libs.TransferTools import TransferTools, TransferTimeout
+from libs.telemetry import IntervalMonitor, transfer_monitors
+from libs.ports import PortAllocator, DEFAULT_LEASE_TTL
+from libs.supervisor import get_supervisor
+from libs.stripes import split_ranges
+import subprocess
+import logging
+import sys, os, time
+
+# the engine is run as a script in its own process, see libs/sockcopy.py
+ENGINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sockcopy.py')
+# ports NUTTCP_PORT + 2000 .. + 2998, above the nuttcp data ports
+PORT_OFFSET = 2000
+
+class native(TransferTools):
+    # senders and receivers are supervised as role 'sender'/'receiver' keyed by port
+    ports = None
+
+    def __init__(self, numa_scheme = 1, nuttcp_port=30001, port_lease_ttl=DEFAULT_LEASE_TTL, **optional_args) -> None:
+        super().__init__(numa_scheme = numa_scheme)
+        if native.ports is None:
+            native.reset_ports(nuttcp_port=nuttcp_port)
+        native.ports.ttl = port_lease_ttl
+
+    @classmethod
+    def reset_ports(cls, nuttcp_port):
+        ttl = native.ports.ttl if native.ports is not None else DEFAULT_LEASE_TTL
+        # one port per transfer, all streams connect to it
+        native.ports = PortAllocator(nuttcp_port + PORT_OFFSET, 999, 0, ttl=ttl, on_expire=native.reclaim_port)
+
+    @classmethod
+    def reclaim_port(cls, port):
+        """ Stop an abandoned sender whose port lease expired """
+        supervisor = get_supervisor()
+        transfer = supervisor.find('native', 'sender', port)
+        if transfer is not None:
+            supervisor.kill(transfer)
+            supervisor.release(transfer)
+
+    def run_sender(self, srcfile, **optional_args):
+        placement = self.placement(optional_args)
+        streams = optional_args.get('streams', 1)
+        if type(streams) != int or streams < 1:
+            raise Exception('streams has to be a positive integer')
+
+        port, _ = native.ports.allocate()
+        cmd = [sys.executable, ENGINE, 'send', '--port', str(port)]
+        res = {'cport': port, 'dport': port}
+        if srcfile is not None:
+            res['size'] = os.path.getsize(srcfile)
+            # small files get fewer streams, ranges are at least 1M
+            ranges = split_ranges(res['size'], streams)
+            streams = len(ranges)
+            cmd += ['--file', srcfile, '--ranges', ','.join('{}:{}'.format(*r) for r in ranges)]
+        else:
+            cmd += ['--streams', str(streams)]
+        logging.debug(cmd)
+        try:
+            proc = self.spawn(cmd, **placement, stdout = sys.stdout, stderr = sys.stderr)
+        except Exception:
+            native.ports.release(port)
+            raise
+        transfer = get_supervisor().add('native', proc, role='sender', key=port, srcfile=srcfile)
+        res.update({'streams': streams, 'transfer_id': transfer.id, 'result': True})
+        return res
+
+    def run_receiver(self, address, dstfile, **optional_args):
+        if 'cport' not in optional_args:
+            logging.error('port number not found')
+            raise Exception('Control port not found')
+
+        port = optional_args['cport']
+        # the engine learns the number of streams from the sender
+        cmd = [sys.executable, ENGINE, 'recv', '--address', address, '--port', str(port)]
+        if 'blocksize' in optional_args and type(optional_args['blocksize']) == int:
+            # in KB like nuttcp's -l
+            cmd += ['--bufsize', str(optional_args['blocksize'] << 10)]
+        if dstfile is None:
+            cmd += ['--duration', str(optional_args['duration'])]
+        else:
+            cmd += ['--file', dstfile]
+            if not ('direct' in optional_args and optional_args['direct'] == False):
+                cmd.append('--direct')
+        logging.debug(cmd)
+
+        proc = self.spawn(cmd, **self.placement(optional_args), stdout = sys.stdout, stderr = subprocess.PIPE)
+        # the engine reports like nuttcp -i 1
+        monitor = IntervalMonitor(proc.stderr, sys.stderr)
+        monitor.start()
+        transfer_monitors.add('native', port, monitor)
+        transfer = get_supervisor().add('native', proc, role='receiver', key=port, monitor=monitor)
+        return {'cport': port, 'dport': port, 'transfer_id': transfer.id, 'result': True}
+
+    @staticmethod
+    def stop_receiver(transfer, timeout=None):
+        get_supervisor().wait(transfer, timeout)
+        transfer.info['monitor'].join()
+        transfer.proc.stderr.close()
+        transfer_monitors.finish('native', transfer.key)
+
+    @staticmethod
+    def find_transfer(node, port):
+        if node not in ('sender', 'receiver'):
+            raise Exception('Node has to be either sender or receiver')
+        transfer = get_supervisor().find('native', node, port)
+        if transfer is None:
+            raise Exception('No {} running on port {}'.format(node, port))
+        return transfer
+
+    @classmethod
+    def free_port(cls, port, **optional_args):
+        supervisor = get_supervisor()
+        transfer = native.find_transfer('sender', port)
+        supervisor.kill(transfer)
+        supervisor.release(transfer)
+        native.ports.release(port)
+
+    @classmethod
+    def get_process(cls, **optional_args):
+        transfer = native.find_transfer(optional_args.get('node'), optional_args.get('cport'))
+        if transfer.role == 'sender':
+            native.ports.renew(transfer.key)
+        return transfer.proc
+
+    @classmethod
+    def poll_progress(cls, **optional_args):
+        if not 'cport' in optional_args:
+            logging.error('Control port not found')
+            raise Exception('Control port not found')
+        elif not 'node' in optional_args:
+            logging.error('Node not found')
+            raise Exception('Node not found')
+
+        timeout = optional_args.get('timeout')
+        port = optional_args.pop('cport')
+        supervisor = get_supervisor()
+        transfer = native.find_transfer(optional_args['node'], port)
+
+        if transfer.role == 'sender':
+            native.ports.renew(port)
+            try:
+                supervisor.wait(transfer, timeout)
+            except subprocess.TimeoutExpired:
+                native.free_port(port)
+                logging.error('sender timed out on port %s' % port)
+                raise TransferTimeout('sender timed out on port %s' % port, transfer.info['srcfile'])
+            supervisor.release(transfer)
+            native.ports.release(port)
+            return transfer.returncode
+
+        try:
+            native.stop_receiver(transfer, timeout)
+        except subprocess.TimeoutExpired:
+            supervisor.kill(transfer)
+            native.stop_receiver(transfer)
+            supervisor.release(transfer)
+            logging.error('receiver timed out on port %s' % port)
+            raise Exception('receiver timed out on port %s' % port)
+        supervisor.release(transfer)
+        if optional_args.get('dstfile') == None:
+            return transfer.returncode, None
+        return transfer.returncode, os.path.getsize(optional_args.pop('dstfile'))
+
+    @classmethod
+    def cleanup(cls, **optional_args):
+        supervisor = get_supervisor()
+        for transfer in supervisor.active('native'):
+            supervisor.kill(transfer)
+            if transfer.role == 'receiver':
+                native.stop_receiver(transfer)
+            supervisor.release(transfer)
+
+        transfer_monitors.remove('native')
+        cls.reset_ports(nuttcp_port = optional_args['nuttcp_port'])
@@ -1,28 +1,53 @@
 from libs.TransferTools import TransferTools, TransferTimeout
+from libs.hashing import StreamHasher
+from libs.telemetry import IntervalMonitor, transfer_monitors
+from libs.ports import PortAllocator, DEFAULT_LEASE_TTL
+from libs.supervisor import get_supervisor
+from libs.stripes import RangeCopier, split_ranges
+from libs.packstream import PackWriter, PackReader, DEFAULT_READ_WORKERS
+from libs.listing import scan_tree
 import subprocess
+import uuid
 import logging
 import sys, os, time
+import stat
 
 class nuttcp(TransferTools):
-    running_svr_threads = {}
-    running_cli_threads = {}
-    # cports = list(range(nuttcp_port, nuttcp_port+ 999))
-    # dports = list(range(nuttcp_port + 1000, nuttcp_port + 1999))
-    cports = []
-    dports = []    
+    # senders and receivers are supervised as role 'sender'/'receiver' keyed by cport,
+    # the stripes of a striped transfer share a parent transfer id
+    # control ports nuttcp_port .. +998, data ports nuttcp_port + 1000 .. +1998
+    ports = None
     
-    def __init__(self, numa_scheme = 1, nuttcp_port=30001) -> None:        
+    def __init__(self, numa_scheme = 1, nuttcp_port=30001, port_lease_ttl=DEFAULT_LEASE_TTL, **optional_args) -> None:        
         super().__init__(numa_scheme = numa_scheme)
-        if nuttcp.cports == []:
-            self.reset_ports(nuttcp_port=nuttcp_port)
+        if nuttcp.ports is None:
+            nuttcp.reset_ports(nuttcp_port=nuttcp_port)
+        nuttcp.ports.ttl = port_lease_ttl
 
-    def reset_ports(self, nuttcp_port):
-        nuttcp.cports = list(range(nuttcp_port, nuttcp_port+ 999))
-        nuttcp.dports = list(range(nuttcp_port + 1000, nuttcp_port + 1999))
+    @classmethod
+    def reset_ports(cls, nuttcp_port):
+        ttl = nuttcp.ports.ttl if nuttcp.ports is not None else DEFAULT_LEASE_TTL
+        nuttcp.ports = PortAllocator(nuttcp_port, 999, 1000, ttl=ttl, on_expire=nuttcp.reclaim_port)
+
+    @classmethod
+    def reclaim_port(cls, cport):
+        """ Stop an abandoned sender whose port lease expired """
+        supervisor = get_supervisor()
+        transfer = supervisor.find('nuttcp', 'sender', cport)
+        if transfer is not None:
+            supervisor.kill(transfer)
+            supervisor.release(transfer)
 
     def run_sender(self, srcfile, **optional_args):
-        cport = nuttcp.cports.pop()
-        dport = nuttcp.dports.pop()
+        placement = self.placement(optional_args)
+        stripes = optional_args.get('stripes', 1)
+        if type(stripes) != int or stripes < 1:
+            raise Exception('stripes has to be a positive integer')
+        if srcfile is not None and os.path.isdir(srcfile):
+            return self.run_pack_sender(srcfile, placement, **optional_args)
+        if srcfile is not None and stripes > 1:
+            return self.run_striped_sender(srcfile, placement, **optional_args)
+        cport, dport = nuttcp.ports.allocate()
         logging.debug('running nuttcp server on cport {} file {} dport {}'.format(cport, srcfile, dport))
         logging.debug('args {}'.format(optional_args))
         
@@ -33,13 +58,16 @@ class nuttcp(TransferTools):
             else:
                 blocksize = 8192
 
-            cmd = 'nuttcp -S -1 -P {} -p {} -l{}k --nofork '.format(cport, dport, blocksize)
+            cmd = ['nuttcp', '-S', '-1', '-P', str(cport), '-p', str(dport), '-l{}k'.format(blocksize), '--nofork']
             logging.debug(cmd)
-            proc = subprocess.Popen('exec ' + cmd, shell=True, stdout = sys.stdout, stderr = sys.stderr)
-            nuttcp.running_svr_threads[cport] = [proc, dport, srcfile]
-            if 'numa_node' in optional_args:
-                super().bind_proc_to_numa(proc, optional_args['numa_node'])
-            return {'cport' : cport, 'dport': dport, 'result': True}
+            try:
+                proc = self.spawn(cmd, **placement,
+                                  stdout = sys.stdout, stderr = sys.stderr)
+            except Exception:
+                nuttcp.ports.release(cport)
+                raise
+            transfer = get_supervisor().add('nuttcp', proc, role='sender', key=cport, dport=dport, srcfile=srcfile)
+            return {'cport' : cport, 'dport': dport, 'transfer_id': transfer.id, 'result': True}
 
         else:
             filemode = ' -sdz'
@@ -54,16 +82,176 @@ class nuttcp(TransferTools):
             else:
                 blocksize = 8192
 
-            cmd = 'nuttcp -S -1 -P {} -p {}{} -l{}k --nofork < {}'.format(cport, dport, filemode, blocksize, srcfile)
-            logging.debug(cmd)
-            proc = subprocess.Popen('exec ' + cmd, shell=True, stdout = sys.stdout, stderr = sys.stderr)
-            nuttcp.running_svr_threads[cport] = [proc, dport, srcfile]
-            if 'numa_node' in optional_args:
-                super().bind_proc_to_numa(proc, optional_args['numa_node'])
-            return {'cport' : cport, 'dport': dport, 'size' : os.path.getsize(srcfile), 'result': True}
+            cmd = ['nuttcp', '-S', '-1', '-P', str(cport), '-p', str(dport), filemode.strip(), '-l{}k'.format(blocksize), '--nofork']
+            logging.debug('{} < {}'.format(cmd, srcfile))
+            # the file is opened here and handed over as stdin, no shell involved
+            try:
+                with open(srcfile, 'rb') as src:
+                    proc = self.spawn(cmd, **placement,
+                                      stdin = src, stdout = sys.stdout, stderr = sys.stderr)
+            except Exception:
+                nuttcp.ports.release(cport)
+                raise
+            transfer = get_supervisor().add('nuttcp', proc, role='sender', key=cport, dport=dport, srcfile=srcfile)
+            return {'cport' : cport, 'dport': dport, 'size' : os.path.getsize(srcfile), 'transfer_id': transfer.id, 'result': True}
+
+    @staticmethod
+    def stripe_filemode(optional_args):
+        # stripes go through a pipe, O_DIRECT doesn't apply there
+        if 'zerocopy' in optional_args and optional_args['zerocopy'] == False:
+            return '-s'
+        return '-sz'
+
+    def run_striped_sender(self, srcfile, placement, **optional_args):
+        """ Serve srcfile as byte ranges, one nuttcp sender (and port pair) each
+
+        Every range is spliced from the file into the sender's stdin. The
+        stripes share one parent transfer id; the response lists their
+        ports and ranges for run_receiver.
+        """
+        blocksize = optional_args['blocksize'] if type(optional_args.get('blocksize')) == int else 8192
+        size = os.path.getsize(srcfile)
+        parent = uuid.uuid4().hex
+        supervisor = get_supervisor()
+        ranges = []
+        try:
+            for offset, length in split_ranges(size, optional_args['stripes']):
+                cport, dport = nuttcp.ports.allocate()
+                ranges.append({'cport': cport, 'dport': dport, 'offset': offset, 'length': length})
+                cmd = ['nuttcp', '-S', '-1', '-P', str(cport), '-p', str(dport), nuttcp.stripe_filemode(optional_args),
+                       '-l{}k'.format(blocksize), '--nofork']
+                logging.debug('{} < {}[{}:+{}]'.format(cmd, srcfile, offset, length))
+                pipe_r, pipe_w = os.pipe()
+                try:
+                    proc = self.spawn(cmd, **placement, stdin = pipe_r, stdout = sys.stdout, stderr = sys.stderr)
+                except Exception:
+                    os.close(pipe_w)
+                    raise
+                finally:
+                    os.close(pipe_r)
+                copier = RangeCopier(os.open(srcfile, os.O_RDONLY), pipe_w, length, src_offset=offset)
+                copier.start()
+                supervisor.add('nuttcp', proc, role='sender', key=cport, parent=parent, dport=dport,
+                               srcfile=srcfile, copier=copier)
+        except Exception:
+            for stripe in ranges:
+                transfer = supervisor.find('nuttcp', 'sender', stripe['cport'])
+                if transfer is not None:
+                    supervisor.kill(transfer)
+                    supervisor.release(transfer)
+                nuttcp.ports.release(stripe['cport'])
+            raise
+        return {'cport': ranges[0]['cport'], 'dport': ranges[0]['dport'], 'size': size, 'stripes': ranges,
+                'transfer_id': parent, 'result': True}
+
+    def run_pack_sender(self, srcdir, placement, **optional_args):
+        """ Send the tree under srcdir as one tar stream through one nuttcp session
+
+        'parallel' files are read ahead at a time. The receiver unpacks the
+        stream as it arrives, see run_pack_receiver.
+        """
+        blocksize = optional_args['blocksize'] if type(optional_args.get('blocksize')) == int else 8192
+        parallel = optional_args['parallel'] if type(optional_args.get('parallel')) == int else DEFAULT_READ_WORKERS
+        entries = list(scan_tree(srcdir))
+        size = sum(st.st_size for _, st in entries if stat.S_ISREG(st.st_mode))
+        files = sum(1 for _, st in entries if stat.S_ISREG(st.st_mode))
+        cport, dport = nuttcp.ports.allocate()
+        cmd = ['nuttcp', '-S', '-1', '-P', str(cport), '-p', str(dport), nuttcp.stripe_filemode(optional_args),
+               '-l{}k'.format(blocksize), '--nofork']
+        logging.debug('{} < tar of {} ({} files)'.format(cmd, srcdir, files))
+        pipe_r, pipe_w = os.pipe()
+        try:
+            proc = self.spawn(cmd, **placement, stdin = pipe_r, stdout = sys.stdout, stderr = sys.stderr)
+        except Exception:
+            os.close(pipe_w)
+            nuttcp.ports.release(cport)
+            raise
+        finally:
+            os.close(pipe_r)
+        packer = PackWriter(srcdir, entries, pipe_w, workers=parallel)
+        packer.start()
+        transfer = get_supervisor().add('nuttcp', proc, role='sender', key=cport, dport=dport,
+                                        srcfile=srcdir, copier=packer)
+        return {'cport': cport, 'dport': dport, 'size': size, 'files': files, 'pack': True,
+                'transfer_id': transfer.id, 'result': True}
+
+    def run_pack_receiver(self, address, dstdir, **optional_args):
+        """ Unpack the tar stream of run_pack_sender into dstdir """
+        blocksize = optional_args['blocksize'] if type(optional_args.get('blocksize')) == int else 8192
+        cport, dport = optional_args['cport'], optional_args['dport']
+        os.makedirs(dstdir, exist_ok=True)
+        cmd = ['nuttcp', '-r', '-i', '1', '-P', str(cport), '-p', str(dport), nuttcp.stripe_filemode(optional_args),
+               '-l{}k'.format(blocksize), '--nofork', address]
+        logging.debug('{} > untar into {}'.format(cmd, dstdir))
+        pipe_r, pipe_w = os.pipe()
+        try:
+            proc = self.spawn(cmd, **self.placement(optional_args), stdout = pipe_w, stderr = subprocess.PIPE)
+        except Exception:
+            os.close(pipe_r)
+            raise
+        finally:
+            os.close(pipe_w)
+        unpacker = PackReader(pipe_r, dstdir)
+        unpacker.start()
+        monitor = IntervalMonitor(proc.stderr, sys.stderr)
+        monitor.start()
+        transfer_monitors.add('nuttcp', cport, monitor)
+        transfer = get_supervisor().add('nuttcp', proc, role='receiver', key=cport, dport=dport,
+                                        stream_hasher=None, monitor=monitor, copier=unpacker)
+        return {'cport': cport, 'dport': dport, 'transfer_id': transfer.id, 'result': True}
+
+    def run_striped_receiver(self, address, dstfile, **optional_args):
+        """ Receive the stripes of run_striped_sender into dstfile with pwrite
+
+        Each stripe's nuttcp writes into a pipe that is spliced into dstfile
+        at the stripe's offset, so the stripes fill the file in parallel.
+        """
+        blocksize = optional_args['blocksize'] if type(optional_args.get('blocksize')) == int else 8192
+        placement = self.placement(optional_args)
+        parent = uuid.uuid4().hex
+        supervisor = get_supervisor()
+        with open(dstfile, 'wb') as dst:
+            if 'size' in optional_args:
+                os.ftruncate(dst.fileno(), optional_args['size'])
+        started = []
+        try:
+            for stripe in optional_args['stripes']:
+                cport, dport = stripe['cport'], stripe['dport']
+                cmd = ['nuttcp', '-r', '-i', '1', '-P', str(cport), '-p', str(dport), nuttcp.stripe_filemode(optional_args),
+                       '-l{}k'.format(blocksize), '--nofork', address]
+                logging.debug('{} > {}[{}:+{}]'.format(cmd, dstfile, stripe['offset'], stripe['length']))
+                pipe_r, pipe_w = os.pipe()
+                try:
+                    proc = self.spawn(cmd, **placement, stdout = pipe_w, stderr = subprocess.PIPE)
+                except Exception:
+                    os.close(pipe_r)
+                    raise
+                finally:
+                    os.close(pipe_w)
+                copier = RangeCopier(pipe_r, os.open(dstfile, os.O_WRONLY), stripe['length'], dst_offset=stripe['offset'])
+                copier.start()
+                monitor = IntervalMonitor(proc.stderr, sys.stderr)
+                monitor.start()
+                transfer_monitors.add('nuttcp', cport, monitor)
+                started.append(supervisor.add('nuttcp', proc, role='receiver', key=cport, parent=parent, dport=dport,
+                                              stream_hasher=None, monitor=monitor, copier=copier))
+        except Exception:
+            for transfer in started:
+                supervisor.kill(transfer)
+                nuttcp.stop_receiver(transfer)
+                supervisor.release(transfer)
+                transfer_monitors.remove('nuttcp', transfer.key)
+            raise
+        first = optional_args['stripes'][0]
+        return {'cport': first['cport'], 'dport': first['dport'], 'transfer_id': parent, 'result': True}
 
     def run_receiver(self, address, dstfile, **optional_args):
         
+        if dstfile is not None and optional_args.get('pack'):
+            return self.run_pack_receiver(address, dstfile, **optional_args)
+        if dstfile is not None and optional_args.get('stripes'):
+            return self.run_striped_receiver(address, dstfile, **optional_args)
+
         if 'cport' not in optional_args:
             logging.error('cport number not found')
             raise Exception('Control port not found')
@@ -85,11 +273,14 @@ class nuttcp(TransferTools):
             dport = optional_args['dport']
             logging.debug('running nuttcp mem-to-mem client on cport {} dport {}'.format(cport, dport))
             logging.debug('args {}'.format(optional_args))
-            cmd = 'nuttcp -r -i 1 -P {} -p {} -l{}k -T {} --nofork {} '.format(cport, dport, blocksize, duration, address)
+            cmd = ['nuttcp', '-r', '-i', '1', '-P', str(cport), '-p', str(dport), '-l{}k'.format(blocksize),
+                   '-T', str(duration), '--nofork', address]
 
         else:
             filemode = ' -sdz'
-            if 'direct' in optional_args and optional_args['direct'] == False:
+            # with an inline checksum nuttcp writes into a pipe, O_DIRECT
+            # doesn't apply there
+            if ('direct' in optional_args and optional_args['direct'] == False) or optional_args.get('checksum'):
                 filemode = filemode.replace('d', '')
 
             if 'zerocopy' in optional_args and optional_args['zerocopy'] == False:
@@ -104,23 +295,81 @@ class nuttcp(TransferTools):
             dport = optional_args['dport']
             logging.debug('running nuttcp client on cport {} file {} dport {}'.format(cport, dstfile, dport))
             logging.debug('args {}'.format(optional_args))
-            cmd = 'nuttcp -r -i 1 -P {} -p {}{} -l{}k --nofork {} > {}'.format(cport, dport, filemode, blocksize, address, dstfile)
+            cmd = ['nuttcp', '-r', '-i', '1', '-P', str(cport), '-p', str(dport), filemode.strip(),
+                   '-l{}k'.format(blocksize), '--nofork', address]
+
+        stream_hasher = None
         logging.debug(cmd)
-        proc = subprocess.Popen('exec ' + cmd, shell=True, stdout = sys.stdout, stderr = sys.stderr)
-        if 'numa_node' in optional_args:
-            super().bind_proc_to_numa(proc, optional_args['numa_node'])
-        nuttcp.running_cli_threads[cport] = [proc, dport]
-        return {'cport' : cport, 'dport': dport, 'result': True}
+        placement = self.placement(optional_args)
+        # the -i 1 reports go to stdout, or to stderr when stdout carries the file
+        if dstfile is None:
+            proc = self.spawn(cmd, **placement, stdout = subprocess.PIPE, stderr = sys.stderr)
+            monitor = IntervalMonitor(proc.stdout, sys.stdout)
+        elif optional_args.get('checksum'):
+            # hash the stream on its way to dstfile instead of reading the file again later
+            algorithm = optional_args['checksum'] if isinstance(optional_args['checksum'], str) else 'md5'
+            stream_hasher = StreamHasher(None, dstfile, algorithm)
+            proc = self.spawn(cmd, **placement, stdout = subprocess.PIPE, stderr = subprocess.PIPE, bufsize=0)
+            stream_hasher.attach(proc.stdout.fileno())
+            stream_hasher.start()
+            monitor = IntervalMonitor(proc.stderr, sys.stderr)
+        else:
+            with open(dstfile, 'wb') as dst:
+                proc = self.spawn(cmd, **placement, stdout = dst, stderr = subprocess.PIPE)
+            monitor = IntervalMonitor(proc.stderr, sys.stderr)
+        monitor.start()
+        transfer_monitors.add('nuttcp', cport, monitor)
+        transfer = get_supervisor().add('nuttcp', proc, role='receiver', key=cport, dport=dport,
+            stream_hasher=stream_hasher, monitor=monitor)
+        return {'cport' : cport, 'dport': dport, 'transfer_id': transfer.id, 'result': True}
+
+    @staticmethod
+    def stop_receiver(transfer, timeout=None):
+        """ Wait for a receiver and the threads reading its pipes """
+        get_supervisor().wait(transfer, timeout)
+        transfer.info['monitor'].join()
+        if transfer.info['stream_hasher'] is not None:
+            transfer.info['stream_hasher'].join()
+        if transfer.info.get('copier') is not None:
+            transfer.info['copier'].join()
+        for stream in (transfer.proc.stdout, transfer.proc.stderr):
+            if stream is not None:
+                stream.close()
+        transfer_monitors.finish('nuttcp', transfer.key)
+
+    @staticmethod
+    def find_transfer(node, cport):
+        if node not in ('sender', 'receiver'):
+            raise Exception('Node has to be either sender or receiver')
+        transfer = get_supervisor().find('nuttcp', node, cport)
+        if transfer is None:
+            raise Exception('No {} running on port {}'.format(node, cport))
+        return transfer
+
+    @staticmethod
+    def stripes_of(transfer):
+        """ All unreleased stripes of transfer's parent, or just transfer """
+        if transfer.parent is None:
+            return [transfer]
+        return get_supervisor().children(transfer.parent, released=False)
 
     @classmethod
     def free_port(cls, port, **optional_args):
-        threads = nuttcp.running_svr_threads
-        err_thread = threads.pop(port)
-        err_thread[0].kill()
-        err_thread[0].kill()
-        err_thread[0].communicate()
-        nuttcp.cports.append(port)
-        nuttcp.dports.append(err_thread[1])
+        supervisor = get_supervisor()
+        for transfer in nuttcp.stripes_of(nuttcp.find_transfer('sender', port)):
+            supervisor.kill(transfer)
+            supervisor.release(transfer)
+            nuttcp.ports.release(transfer.key)
+
+    @classmethod
+    def get_process(cls, **optional_args):
+        stripes = nuttcp.stripes_of(nuttcp.find_transfer(optional_args.get('node'), optional_args.get('cport')))
+        for transfer in stripes:
+            if transfer.role == 'sender':
+                nuttcp.ports.renew(transfer.key)
+        # a striped transfer is running as long as any of its stripes is
+        running = [transfer for transfer in stripes if transfer.running()]
+        return (running or stripes)[0].proc
 
     @classmethod
     def poll_progress(cls, **optional_args):
@@ -138,37 +387,52 @@ class nuttcp(TransferTools):
             
         cport = optional_args.pop('cport')        
         
+        supervisor = get_supervisor()
+        if optional_args['node'] in ('sender', 'receiver'):
+            transfer = nuttcp.find_transfer(optional_args['node'], cport)
+            if transfer.parent is not None:
+                return nuttcp.poll_stripes(transfer, timeout)
+
         if optional_args['node'] == 'sender':
-            threads = nuttcp.running_svr_threads
-            # logging.debug('threads: ' + str(threads))            
-            proc = threads[cport][0]
+            transfer = nuttcp.find_transfer('sender', cport)
+            nuttcp.ports.renew(cport)
             try:
-                proc.communicate(timeout=timeout)
-                completed_thread = threads.pop(cport)
-                nuttcp.cports.append(cport)
-                nuttcp.dports.append(completed_thread[1])
-                return proc.returncode
+                supervisor.wait(transfer, timeout)
+                supervisor.release(transfer)
+                nuttcp.ports.release(cport)
+                if transfer.info.get('copier') is not None:
+                    transfer.info['copier'].join()
+                    if transfer.info['copier'].error is not None:
+                        raise transfer.info['copier'].error
+                return transfer.returncode
             except subprocess.TimeoutExpired:
-                filepath = threads[cport][2]
+                filepath = transfer.info['srcfile']
                 nuttcp.free_port(cport)
                 logging.error('sender timed out on port %s' % cport)
                 raise TransferTimeout('sender timed out on port %s' % cport, filepath)
         elif optional_args['node'] == 'receiver':
-            threads = nuttcp.running_cli_threads
-            # logging.debug('threads: ' + str(threads))
+            transfer = nuttcp.find_transfer('receiver', cport)
+            stream_hasher = transfer.info['stream_hasher']
             try:                
-                proc = nuttcp.running_cli_threads[cport][0]
-                proc.communicate(timeout=timeout)
-                threads.pop(cport)
+                nuttcp.stop_receiver(transfer, timeout)
+                supervisor.release(transfer)
                 if optional_args['dstfile'] == None:
-                    return proc.returncode, None
+                    return transfer.returncode, None
+                elif transfer.info.get('copier') is not None:
+                    # a packed tree: the bytes of the files unpacked
+                    if transfer.info['copier'].error is not None:
+                        raise transfer.info['copier'].error
+                    return transfer.returncode, transfer.info['copier'].size
+                elif stream_hasher is not None:
+                    if stream_hasher.error is not None:
+                        raise stream_hasher.error
+                    return transfer.returncode, stream_hasher.size, stream_hasher.digest
                 else:    
-                    return proc.returncode, os.path.getsize(optional_args.pop('dstfile'))
+                    return transfer.returncode, os.path.getsize(optional_args.pop('dstfile'))
             except subprocess.TimeoutExpired:
-                err_thread = threads.pop(cport)
-                err_thread[0].kill()
-                err_thread[0].kill()
-                err_thread[0].communicate()                
+                supervisor.kill(transfer)
+                nuttcp.stop_receiver(transfer)
+                supervisor.release(transfer)
                 logging.error('receiver timed out on port %s' % cport)
                 raise Exception('receiver timed out on port %s' % cport)
             
@@ -177,21 +441,57 @@ class nuttcp(TransferTools):
             raise Exception('Node has to be either sender or receiver')        
 
     @classmethod
-    def cleanup(cls, **optional_args):
-        for i,j in nuttcp.running_svr_threads.items():
-            j[0].kill()
-            j[0].kill()
-            j[0].communicate()
-        
-        nuttcp.running_svr_threads = {}
+    def poll_stripes(cls, transfer, timeout=None):
+        """ Wait for every stripe of a striped transfer and aggregate them
 
-        for i,j in nuttcp.running_cli_threads.items():
-            j[0].kill()
-            j[0].kill()
-            j[0].communicate()
+        Senders return the first non-zero returncode (or 0), receivers
+        (returncode, bytes written by all stripes).
+        """
+        supervisor = get_supervisor()
+        stripes = nuttcp.stripes_of(transfer)
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        remaining = lambda: max(0, deadline - time.monotonic()) if deadline is not None else None
+        try:
+            for stripe in stripes:
+                if stripe.role == 'sender':
+                    nuttcp.ports.renew(stripe.key)
+                    supervisor.wait(stripe, remaining())
+                else:
+                    nuttcp.stop_receiver(stripe, remaining())
+        except subprocess.TimeoutExpired:
+            for stripe in stripes:
+                supervisor.kill(stripe)
+                if stripe.role == 'receiver':
+                    nuttcp.stop_receiver(stripe)
+                else:
+                    nuttcp.ports.release(stripe.key)
+                supervisor.release(stripe)
+            logging.error('striped {} timed out on port {}'.format(transfer.role, transfer.key))
+            if transfer.role == 'sender':
+                raise TransferTimeout('sender timed out on port %s' % transfer.key, transfer.info['srcfile'])
+            raise Exception('receiver timed out on port %s' % transfer.key)
 
-        nuttcp.running_cli_threads = {}
-        cls.reset_ports(cls, nuttcp_port = optional_args['nuttcp_port'])
+        for stripe in stripes:
+            supervisor.release(stripe)
+            if stripe.role == 'sender':
+                nuttcp.ports.release(stripe.key)
+        for stripe in stripes:
+            stripe.info['copier'].join()
+            if stripe.info['copier'].error is not None:
+                raise stripe.info['copier'].error
+        returncode = next((stripe.returncode for stripe in stripes if stripe.returncode), 0)
+        if transfer.role == 'sender':
+            return returncode
+        return returncode, sum(stripe.info['copier'].size for stripe in stripes)
+
+    @classmethod
+    def cleanup(cls, **optional_args):
+        supervisor = get_supervisor()
+        for transfer in supervisor.active('nuttcp'):
+            supervisor.kill(transfer)
+            if transfer.role == 'receiver':
+                nuttcp.stop_receiver(transfer)
+            supervisor.release(transfer)
 
-        # nuttcp.cports = list(range(nuttcp_port, nuttcp_port+ 999))
-        # nuttcp.dports = list(range(nuttcp_port + 1000, nuttcp_port + 1999))
\ No newline at end of file
+        transfer_monitors.remove('nuttcp')
+        cls.reset_ports(nuttcp_port = optional_args['nuttcp_port'])
\ No newline at end of file
@@ -0,0 +1,155 @@
+import logging
+import os
+import stat
+import tarfile
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# files up to this size are read ahead in parallel, bigger ones are streamed
+SMALL_FILE = 1 << 20
+DEFAULT_READ_WORKERS = 8
+# small files read ahead of the one being written, per worker
+READ_AHEAD = 8
+STREAM_BUFFER = 1 << 20
+# the 'data' extraction filter only exists in recent Pythons (3.12, 3.11.4)
+EXTRACT_ARGS = {'filter': 'data'} if hasattr(tarfile, 'data_filter') else {}
+
+def _tarinfo(relpath, st):
+    info = tarfile.TarInfo(relpath)
+    info.mode = stat.S_IMODE(st.st_mode)
+    info.mtime = st.st_mtime
+    info.uid, info.gid = st.st_uid, st.st_gid
+    if stat.S_ISDIR(st.st_mode):
+        info.type = tarfile.DIRTYPE
+    elif stat.S_ISREG(st.st_mode):
+        info.size = st.st_size
+    else:
+        return None
+    return info
+
+def _read_small(path):
+    with open(path, 'rb') as fh:
+        return fh.read()
+
+class PackWriter(threading.Thread):
+    """ Write a tree as one tar stream into fd, for a single transfer session
+
+    entries are (relpath, stat_result) pairs as produced by scan_tree.
+    Files up to SMALL_FILE are read by a pool of workers ahead of the
+    writer so that per-file open/read latency overlaps with sending;
+    bigger files are streamed in order. Entries that vanish meanwhile are
+    skipped. size and files count what went into the stream.
+    """
+
+    def __init__(self, root, entries, fd, workers=DEFAULT_READ_WORKERS):
+        super().__init__(name='pack-writer', daemon=True)
+        self.root = root
+        self.entries = entries
+        self.fd = fd
+        self.workers = workers
+        self.size = 0
+        self.files = 0
+        self.error = None
+
+    def _add(self, tar, info, data):
+        path = os.path.join(self.root, info.name)
+        try:
+            if data is not None:
+                data = data.result()
+                info.size = len(data)
+                tar.addfile(info, _BytesReader(data))
+            elif info.isreg():
+                with open(path, 'rb') as fh:
+                    info.size = os.fstat(fh.fileno()).st_size
+                    tar.addfile(info, fh)
+            else:
+                tar.addfile(info)
+        except (FileNotFoundError, PermissionError) as e:
+            logging.warning('skipping {}: {}'.format(path, e))
+            return
+        if info.isreg():
+            self.size += info.size
+            self.files += 1
+
+    def run(self):
+        try:
+            with os.fdopen(self.fd, 'wb', buffering=STREAM_BUFFER) as out, \
+                    tarfile.open(fileobj=out, mode='w|', format=tarfile.PAX_FORMAT) as tar, \
+                    ThreadPoolExecutor(max_workers=self.workers) as pool:
+                pending = deque()
+                for relpath, st in self.entries:
+                    info = _tarinfo(relpath, st)
+                    if info is None:
+                        continue
+                    data = None
+                    if info.isreg() and info.size <= SMALL_FILE:
+                        data = pool.submit(_read_small, os.path.join(self.root, relpath))
+                    pending.append((info, data))
+                    while len(pending) > self.workers * READ_AHEAD:
+                        self._add(tar, *pending.popleft())
+                while pending:
+                    self._add(tar, *pending.popleft())
+        except Exception as e:
+            # closing the pipe ends the transfer short, the receiver sees a truncated stream
+            self.error = e
+
+class _BytesReader:
+    """ Minimal file object over bytes for tarfile.addfile """
+
+    def __init__(self, data):
+        self.view = memoryview(data)
+        self.pos = 0
+
+    def read(self, size=-1):
+        end = len(self.view) if size < 0 else min(len(self.view), self.pos + size)
+        chunk = self.view[self.pos:end]
+        self.pos = end
+        return chunk
+
+def _check_member(member, dstdir):
+    # what the 'data' filter does for older Pythons, minus the mode cleanup;
+    # checked with the filter too, which would extract absolute names below dstdir
+    if member.islnk() or member.issym():
+        target = os.path.join(os.path.dirname(member.name), member.linkname) if member.issym() else member.linkname
+        paths = (member.name, target)
+    else:
+        paths = (member.name,)
+    root = os.path.realpath(dstdir)
+    for path in paths:
+        if os.path.isabs(path) or not os.path.realpath(os.path.join(root, path)).startswith(root + os.sep):
+            raise tarfile.TarError('{} would be extracted outside {}'.format(member.name, dstdir))
+    if not (member.isreg() or member.isdir() or member.issym() or member.islnk()):
+        raise tarfile.TarError('{} is not a file, directory or link'.format(member.name))
+
+class PackReader(threading.Thread):
+    """ Unpack a tar stream from fd into dstdir as it arrives
+
+    Members that would land outside dstdir (absolute paths, '..', links
+    pointing out) are refused. size and files count the regular files
+    written.
+    """
+
+    def __init__(self, fd, dstdir):
+        super().__init__(name='pack-reader', daemon=True)
+        self.fd = fd
+        self.dstdir = dstdir
+        self.size = 0
+        self.files = 0
+        self.error = None
+
+    def run(self):
+        with os.fdopen(self.fd, 'rb', buffering=STREAM_BUFFER) as src:
+            try:
+                with tarfile.open(fileobj=src, mode='r|') as tar:
+                    for member in tar:
+                        _check_member(member, self.dstdir)
+                        tar.extract(member, self.dstdir, **EXTRACT_ARGS)
+                        if member.isreg():
+                            self.size += member.size
+                            self.files += 1
+            except Exception as e:
+                self.error = e
+                # keep draining so the writer doesn't block on a full pipe
+                while src.read(STREAM_BUFFER):
+                    pass
@@ -0,0 +1,118 @@
+import logging
+import socket
+import threading
+import time
+
+# leases that are not renewed (by polling the transfer) for this long are
+# considered abandoned and reclaimed
+DEFAULT_LEASE_TTL = 86400
+
+def port_is_free(port, address=''):
+    """ Bind test: True if nothing else holds port on address """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        # ports in TIME_WAIT are fine, nuttcp sets SO_REUSEADDR as well
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            sock.bind((address, port))
+        except OSError:
+            return False
+    return True
+
+class PortAllocator:
+    """ Thread-safe allocator of (control port, data port) pairs
+
+    Pair i is (base + i, base + dport_offset + i). Pairs in use are kept in
+    a bitmap and every pair is handed out with a lease of ttl seconds that
+    renew() extends. Expired leases are reclaimed on the next allocate() or
+    stats() call: on_expire(cport) is called so the owner can stop whatever
+    still uses the pair, then the pair is freed.
+    """
+
+    def __init__(self, base, count, dport_offset, ttl=DEFAULT_LEASE_TTL, on_expire=None, address=''):
+        self.base = base
+        self.count = count
+        self.dport_offset = dport_offset
+        self.ttl = ttl
+        self.on_expire = on_expire
+        self.address = address
+        self.bitmap = bytearray((count + 7) // 8)
+        # cport -> lease expiry (time.monotonic())
+        self.leases = {}
+        self.cursor = 0
+        self.lock = threading.Lock()
+        self.reclaimed = 0
+        self.conflicts = 0
+
+    def _used(self, idx):
+        return self.bitmap[idx >> 3] & (1 << (idx & 7))
+
+    def _set(self, idx, used):
+        if used:
+            self.bitmap[idx >> 3] |= 1 << (idx & 7)
+        else:
+            self.bitmap[idx >> 3] &= ~(1 << (idx & 7)) & 0xff
+
+    def allocate(self):
+        """ Lease a free pair and return (cport, dport)
+
+        Pairs are handed out round robin so a released pair isn't reused at
+        once, and a pair is only handed out if both ports pass a bind test.
+        """
+        self.reclaim()
+        with self.lock:
+            for step in range(self.count):
+                idx = (self.cursor + step) % self.count
+                if self._used(idx):
+                    continue
+                cport, dport = self.base + idx, self.base + self.dport_offset + idx
+                if not (port_is_free(cport, self.address) and port_is_free(dport, self.address)):
+                    self.conflicts += 1
+                    logging.debug('port pair {}/{} is held by another process'.format(cport, dport))
+                    continue
+                self._set(idx, True)
+                self.leases[cport] = time.monotonic() + self.ttl
+                self.cursor = (idx + 1) % self.count
+                return cport, dport
+        raise Exception('No free port pair in {}-{}'.format(self.base, self.base + self.count - 1))
+
+    def release(self, cport):
+        with self.lock:
+            if self.leases.pop(cport, None) is not None:
+                self._set(cport - self.base, False)
+
+    def renew(self, cport):
+        with self.lock:
+            if cport in self.leases:
+                self.leases[cport] = time.monotonic() + self.ttl
+
+    def dport(self, cport):
+        return cport + self.dport_offset
+
+    def reclaim(self):
+        """ Free every pair whose lease expired and return their cports """
+        now = time.monotonic()
+        with self.lock:
+            expired = [cport for cport, expires in self.leases.items() if expires <= now]
+        for cport in expired:
+            logging.warning('lease of port {} expired, reclaiming it'.format(cport))
+            if self.on_expire is not None:
+                try:
+                    self.on_expire(cport)
+                except Exception as e:
+                    logging.error('failed to stop transfer on reclaimed port {}: {}'.format(cport, e))
+            self.release(cport)
+        with self.lock:
+            self.reclaimed += len(expired)
+        return expired
+
+    def stats(self):
+        self.reclaim()
+        now = time.monotonic()
+        with self.lock:
+            leased = len(self.leases)
+            return {'cports': [self.base, self.base + self.count - 1],
+                    'dports': [self.base + self.dport_offset, self.base + self.dport_offset + self.count - 1],
+                    'total': self.count, 'leased': leased, 'free': self.count - leased,
+                    'ttl': self.ttl, 'reclaimed': self.reclaimed, 'bind_conflicts': self.conflicts,
+                    'leases': [{'cport': cport, 'dport': self.dport(cport), 'expires_in': expires - now}
+                               for cport, expires in sorted(self.leases.items())]}
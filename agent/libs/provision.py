@@ -0,0 +1,199 @@
+import logging
+import mmap
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from libs.units import parse_size
+
+MODES = ['fio', 'fallocate', 'sparse', 'pattern', 'random']
+# files written with pattern/random are split into segments of this size so
+# that one large file is written by several threads
+SEGMENT_SIZE = 64 << 20
+BLOCK_SIZE = 1 << 20
+ALIGNMENT = 4096
+
+_buffers = threading.local()
+
+def get_block(mode, block_size=BLOCK_SIZE):
+    """ Return this thread's page aligned write buffer filled for mode
+
+    mmap'd memory is page aligned, which is what O_DIRECT needs. The random
+    buffer is filled once per thread and reused for every block.
+    """
+    key = (mode, block_size)
+    buf = getattr(_buffers, 'buf', None)
+    if buf is None or _buffers.key != key:
+        buf = mmap.mmap(-1, block_size)
+        if mode == 'random':
+            buf[:] = os.urandom(block_size)
+        else:
+            buf[:] = bytes(range(256)) * (block_size // 256) + bytes(range(block_size % 256))
+        _buffers.buf = buf
+        _buffers.key = key
+    return buf
+
+def has_contents(path, size, mode):
+    """ True if path already is a size bytes file of the kind mode creates
+
+    Any file of the right size will do for sparse. fallocate needs every
+    block allocated. pattern and random need written data: a file with
+    holes or that starts with a zero block (sparse or fallocated) is
+    written again. On compressing filesystems pattern files can look
+    sparse and are rewritten every time.
+    """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return False
+    if st.st_size != size:
+        return False
+    if mode == 'sparse':
+        return True
+    if st.st_blocks * 512 < size:
+        return False
+    if mode == 'fallocate' or not size:
+        return True
+    with open(path, 'rb') as fh:
+        return any(fh.read(ALIGNMENT))
+
+def partial_path(path):
+    """ Name pattern/random files are written under until they are complete """
+    dirname, name = os.path.split(path)
+    return os.path.join(dirname, '.{}.provisioning'.format(name))
+
+def fallocate_file(path, size):
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        if size:
+            os.posix_fallocate(fd, 0, size)
+        os.ftruncate(fd, size)
+    finally:
+        os.close(fd)
+
+def sparse_file(path, size):
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        os.ftruncate(fd, size)
+    finally:
+        os.close(fd)
+
+def open_direct(path):
+    """ Open path for writing with O_DIRECT, or buffered where that's unsupported (e.g. tmpfs) """
+    flags = os.O_WRONLY | os.O_CREAT
+    try:
+        return os.open(path, flags | getattr(os, 'O_DIRECT', 0), 0o644), True
+    except OSError:
+        logging.debug('O_DIRECT not supported for {}, using buffered writes'.format(path))
+        return os.open(path, flags, 0o644), False
+
+def write_segment(path, mode, offset, length, progress=None, block_size=BLOCK_SIZE):
+    """ Write length bytes of mode data at offset, returns bytes written """
+    buf = get_block(mode, block_size)
+    fd, direct = open_direct(path)
+    tail_fd = None
+    written = 0
+    try:
+        while written < length:
+            n = min(block_size, length - written)
+            target = fd
+            if direct and n % ALIGNMENT:
+                # the unaligned tail of the file can't go through O_DIRECT
+                if tail_fd is None:
+                    tail_fd = os.open(path, os.O_WRONLY)
+                target = tail_fd
+            n = os.pwrite(target, memoryview(buf)[:n], offset + written)
+            written += n
+            if progress is not None:
+                progress(n)
+    finally:
+        os.close(fd)
+        if tail_fd is not None:
+            os.close(tail_fd)
+    return written
+
+class Provisioner:
+    """ Creates files without fio: fallocate, sparse, pattern or random data """
+
+    def __init__(self, workers=None):
+        self.executor = ThreadPoolExecutor(max_workers=workers or min(32, (os.cpu_count() or 1) * 2),
+                                           thread_name_prefix='provision')
+
+    def create_files(self, specs, progress=None):
+        """ Create {path: (size, mode)} files and return {path: result}
+
+        Files that already exist with the requested size and contents (see
+        has_contents) are skipped. pattern and random files are written
+        under partial_path and renamed once complete, so a failed write
+        never leaves a full size file behind. progress, if given, is called
+        with (files done, bytes written, bytes skipped); files that already
+        exist, are fallocated or sparse count as skipped with their full
+        size as no data is written for them.
+        """
+        results = {}
+        futures = []
+        for path, (size, mode) in specs.items():
+            if mode not in MODES[1:]:
+                raise ValueError('Unsupported provisioning mode {}'.format(mode))
+            if has_contents(path, size, mode):
+                results[path] = {'mode': mode, 'size': size, 'skipped': True}
+                if progress is not None:
+                    progress(1, 0, size)
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            results[path] = {'mode': mode, 'size': size, 'skipped': False}
+            if mode == 'fallocate':
+                fallocate_file(path, size)
+            elif mode == 'sparse':
+                sparse_file(path, size)
+            else:
+                futures.append((path, self._write_file(path, size, mode, progress)))
+                continue
+            if progress is not None:
+                progress(1, 0, size)
+
+        error = None
+        for path, segments in futures:
+            try:
+                for segment in segments:
+                    segment.result()
+                os.rename(partial_path(path), path)
+            except Exception as e:
+                # the other segments of the file have to finish before it goes
+                wait(segments)
+                os.remove(partial_path(path))
+                error = error or e
+                continue
+            if progress is not None:
+                progress(1, 0)
+        if error is not None:
+            raise error
+        return results
+
+    def _write_file(self, path, size, mode, progress):
+        path = partial_path(path)
+        # sized up front so the segments can be written in any order
+        sparse_file(path, size)
+        bytes_progress = None
+        if progress is not None:
+            bytes_progress = lambda n: progress(0, n)
+        return [self.executor.submit(write_segment, path, mode, offset,
+                                     min(SEGMENT_SIZE, size - offset), bytes_progress)
+                for offset in range(0, size, SEGMENT_SIZE)]
+
+def parse_spec(spec):
+    """ Return (size in bytes or None, mode) of a /create_file/ file spec
+
+    fio understands more size formats than parse_size, so for fio files a
+    size that can't be parsed is passed through and only the skip check is
+    lost.
+    """
+    mode = spec.get('mode', 'fio')
+    if mode not in MODES:
+        raise ValueError('mode has to be one of {}'.format(', '.join(MODES)))
+    try:
+        size = parse_size(spec['size'])
+    except ValueError:
+        if mode != 'fio':
+            raise
+        size = None
+    return size, mode
@@ -0,0 +1,127 @@
+import logging
+import os
+import select
+import threading
+
+# how often the fallback reaper checks its children without pidfds
+FALLBACK_INTERVAL = 0.1
+
+def has_exited(proc):
+    """ True once proc exited, without reaping it """
+    if proc.returncode is not None:
+        return True
+    try:
+        return os.waitid(os.P_PID, proc.pid, os.WEXITED | os.WNOHANG | os.WNOWAIT) is not None
+    except ChildProcessError:
+        # reaped by someone else
+        return True
+
+class Reaper(threading.Thread):
+    """ One thread that notices child exits and wakes whoever waits on them
+
+    watch(proc) returns a threading.Event that is set once proc has exited
+    (and been reaped, so proc.returncode is set). Exits are noticed through
+    pidfds where the kernel has them (Linux 5.3+), otherwise by polling
+    every child each FALLBACK_INTERVAL.
+
+    Children are reaped with wait4, so on_exit callbacks get (proc, rusage)
+    with the child's resource usage (rusage is None if something else reaped
+    it first). Watched processes should only be waited for through the
+    returned event.
+    """
+
+    def __init__(self):
+        super().__init__(daemon=True, name='reaper')
+        self.lock = threading.Lock()
+        # pid -> (proc, event, pidfd or None, on_exit callbacks)
+        self.watched = {}
+        self.use_pidfd = hasattr(os, 'pidfd_open')
+        self.poller = select.poll()
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        os.set_blocking(self.wakeup_w, False)
+        self.poller.register(self.wakeup_r, select.POLLIN)
+        self.fds = {}
+
+    def watch(self, proc, on_exit=None):
+        with self.lock:
+            if proc.pid in self.watched:
+                if on_exit is not None:
+                    self.watched[proc.pid][3].append(on_exit)
+                return self.watched[proc.pid][1]
+            event = threading.Event()
+            if proc.poll() is not None:
+                if on_exit is not None:
+                    on_exit(proc, None)
+                event.set()
+                return event
+            pidfd = None
+            if self.use_pidfd:
+                try:
+                    pidfd = os.pidfd_open(proc.pid)
+                except OSError as e:
+                    logging.debug('pidfd_open failed ({}), polling pid {}'.format(e, proc.pid))
+            self.watched[proc.pid] = (proc, event, pidfd, [on_exit] if on_exit is not None else [])
+            if pidfd is not None:
+                self.fds[pidfd] = proc.pid
+                self.poller.register(pidfd, select.POLLIN)
+        self._wakeup()
+        return event
+
+    def _wakeup(self):
+        try:
+            os.write(self.wakeup_w, b'x')
+        except BlockingIOError:
+            pass
+
+    def _reap(self, pid):
+        proc, event, pidfd, callbacks = self.watched.pop(pid)
+        if pidfd is not None:
+            self.poller.unregister(pidfd)
+            del self.fds[pidfd]
+            os.close(pidfd)
+        rusage = None
+        if proc.returncode is None:
+            try:
+                reaped, status, rusage = os.wait4(pid, os.WNOHANG)
+                if reaped == pid:
+                    # Popen won't wait again once returncode is set
+                    proc.returncode = os.waitstatus_to_exitcode(status)
+                else:
+                    rusage = None
+            except ChildProcessError:
+                pass
+        proc.poll()
+        for on_exit in callbacks:
+            try:
+                on_exit(proc, rusage)
+            except Exception as e:
+                logging.error('exit callback for pid {} failed: {}'.format(pid, e))
+        event.set()
+
+    def run(self):
+        while True:
+            with self.lock:
+                polling = [pid for pid, (_, _, pidfd, _) in self.watched.items() if pidfd is None]
+            ready = self.poller.poll(FALLBACK_INTERVAL * 1000 if polling else None)
+            with self.lock:
+                for fd, _ in ready:
+                    if fd == self.wakeup_r:
+                        os.read(self.wakeup_r, 4096)
+                    elif fd in self.fds:
+                        # a readable pidfd means the process exited
+                        self._reap(self.fds[fd])
+                for pid in polling:
+                    if pid in self.watched and has_exited(self.watched[pid][0]):
+                        self._reap(pid)
+
+_reaper = None
+_reaper_lock = threading.Lock()
+
+def get_reaper():
+    """ Return the process wide reaper, starting it on first use """
+    global _reaper
+    with _reaper_lock:
+        if _reaper is None:
+            _reaper = Reaper()
+            _reaper.start()
+        return _reaper
@@ -0,0 +1,262 @@
+""" Socket copy engine of the native transfer tool
+
+Runs as its own process, started by libs.native (only the standard library
+is used so it runs as a plain script):
+
+    sockcopy.py send --port P --file F --ranges OFFSET:LENGTH[,...]
+    sockcopy.py send --port P --streams N
+    sockcopy.py recv --address A --port P [--file F]
+                     [--direct] [--duration S] [--bufsize B]
+
+The sender accepts one connection per range on P and serves that range
+of F with sendfile(2); without F it sends zeros on N connections until
+the receiver hangs up. Every connection starts with a header carrying
+the number of streams, so the receiver opens as many as the sender
+serves. The receiver reads each connection with recv_into into a page
+aligned buffer and pwrites it at the range's offset, optionally with
+O_DIRECT. Both print nuttcp style interval reports (once a second) and a
+summary to stderr.
+"""
+import argparse
+import mmap
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+
+# offset, length and total size of the range that follows, number of streams
+HEADER = struct.Struct('!QQQI')
+# length of a mem-to-mem stream
+UNBOUNDED = (1 << 64) - 1
+DIRECT_ALIGN = 4096
+SENDFILE_CHUNK = 1 << 24
+DEFAULT_BUFSIZE = 1 << 20
+CONNECT_TIMEOUT = 10
+# once the first stream is up the others have this long to connect
+ACCEPT_TIMEOUT = 30
+
+def parse_ranges(ranges):
+    """ 'offset:length,...' as given by libs.native into [(offset, length)] """
+    return [tuple(int(i) for i in part.split(':')) for part in ranges.split(',')]
+
+class Meter(threading.Thread):
+    """ Counts bytes moved and reports them like nuttcp -i 1 """
+
+    def __init__(self, out=sys.stderr):
+        super().__init__(daemon=True)
+        self.out = out
+        self.lock = threading.Lock()
+        self.bytes = 0
+        self.started = time.monotonic()
+        self.done = threading.Event()
+
+    def add(self, count):
+        with self.lock:
+            self.bytes += count
+
+    def _line(self, count, seconds):
+        mb = count / 1e6
+        return '{:12.4f} MB / {:6.2f} sec = {:10.4f} Mbps'.format(mb, seconds, mb * 8 / seconds if seconds else 0)
+
+    def run(self):
+        last, last_time = 0, self.started
+        while not self.done.wait(1):
+            now = time.monotonic()
+            with self.lock:
+                count = self.bytes
+            self.out.write(self._line(count - last, now - last_time) + '     0 retrans\n')
+            self.out.flush()
+            last, last_time = count, now
+
+    def finish(self):
+        self.done.set()
+        elapsed = time.monotonic() - self.started
+        cpu = os.times()
+        busy = 100 * (cpu.user + cpu.system) / elapsed if elapsed else 0
+        self.out.write(self._line(self.bytes, elapsed) + ' {:.0f} %TX {:.0f} %RX 0 retrans\n'.format(busy, busy))
+        self.out.flush()
+
+def recv_exactly(conn, size):
+    data = b''
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('connection closed during the header')
+        data += chunk
+    return data
+
+def send_range(conn, fd, offset, length, total, streams, meter):
+    with conn:
+        conn.sendall(HEADER.pack(offset, length, total, streams))
+        if fd is None:
+            zeros = bytes(DEFAULT_BUFSIZE)
+            try:
+                while True:
+                    meter.add(conn.send(zeros))
+            except (BrokenPipeError, ConnectionResetError):
+                # the receiver hangs up once its duration is over
+                return
+        sent = 0
+        while sent < length:
+            n = os.sendfile(conn.fileno(), fd, offset + sent, min(SENDFILE_CHUNK, length - sent))
+            if not n:
+                raise IOError('file ended {} bytes into a {} byte range'.format(sent, length))
+            sent += n
+            meter.add(n)
+
+def send(port, path=None, ranges=None, streams=1):
+    fd = os.open(path, os.O_RDONLY) if path else None
+    size = os.fstat(fd).st_size if fd is not None else UNBOUNDED
+    if fd is None:
+        ranges = [(0, UNBOUNDED)] * streams
+    meter = Meter()
+    errors = []
+
+    def serve(conn, offset, length):
+        try:
+            send_range(conn, fd, offset, length, size, len(ranges), meter)
+        except Exception as e:
+            errors.append(e)
+
+    with socket.create_server(('', port), backlog=len(ranges)) as listener:
+        meter.start()
+        threads = []
+        for offset, length in ranges:
+            try:
+                conn, _ = listener.accept()
+            except socket.timeout:
+                errors.append(IOError('only {} of {} streams connected'.format(len(threads), len(ranges))))
+                break
+            listener.settimeout(ACCEPT_TIMEOUT)
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            thread = threading.Thread(target=serve, args=(conn, offset, length))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+    meter.finish()
+    for e in errors:
+        print('sockcopy: {}'.format(e), file=sys.stderr)
+    return 1 if errors else 0
+
+def open_output(path, direct):
+    """ Open path for pwrite, with O_DIRECT where the filesystem takes it """
+    flags = os.O_WRONLY | os.O_CREAT
+    if direct:
+        try:
+            return os.open(path, flags | os.O_DIRECT, 0o644), True
+        except OSError as e:
+            print('sockcopy: O_DIRECT not available for {} ({}), writing buffered'.format(path, e), file=sys.stderr)
+    return os.open(path, flags, 0o644), False
+
+def write_all(fd, view, offset):
+    written = 0
+    while written < len(view):
+        written += os.pwrite(fd, view[written:], offset + written)
+
+def recv_stream(conn, header, path, direct, bufsize, deadline, meter):
+    """ Receive one range into path, returns (total size, bytes received) """
+    with conn:
+        offset, length, total, _ = header
+        # anonymous maps are page aligned, as O_DIRECT wants
+        buf = mmap.mmap(-1, bufsize)
+        view = memoryview(buf)
+        fd, direct = open_output(path, direct) if path else (None, False)
+        received = fill = 0
+        try:
+            while received < length:
+                if deadline is not None and time.monotonic() >= deadline:
+                    break
+                n = conn.recv_into(view[fill:], min(bufsize - fill, length - received))
+                if not n:
+                    break
+                fill += n
+                received += n
+                meter.add(n)
+                if fill == bufsize:
+                    if fd is not None:
+                        write_all(fd, view[:fill], offset + received - fill)
+                    fill = 0
+            if fill and fd is not None:
+                # O_DIRECT writes whole blocks, the file is truncated to size afterwards
+                padded = -(-fill // DIRECT_ALIGN) * DIRECT_ALIGN if direct else fill
+                write_all(fd, view[:padded], offset + received - fill)
+        finally:
+            if fd is not None:
+                os.close(fd)
+            view.release()
+            buf.close()
+        if deadline is None and received != length:
+            raise IOError('received {} of {} bytes at offset {}'.format(received, length, offset))
+        return total, received
+
+def connect(address, port):
+    # the sender may still be starting up
+    give_up = time.monotonic() + CONNECT_TIMEOUT
+    while True:
+        try:
+            conn = socket.create_connection((address, port))
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            return conn
+        except ConnectionRefusedError:
+            if time.monotonic() >= give_up:
+                raise
+            time.sleep(0.05)
+
+def recv(address, port, path=None, direct=False, duration=None, bufsize=DEFAULT_BUFSIZE):
+    if direct:
+        bufsize = -(-bufsize // DIRECT_ALIGN) * DIRECT_ALIGN
+    meter = Meter()
+    # a duration only applies to mem-to-mem, files are received in full
+    deadline = time.monotonic() + duration if duration and not path else None
+    results, errors = [], []
+
+    def receive(conn, header=None):
+        try:
+            if header is None:
+                header = HEADER.unpack(recv_exactly(conn, HEADER.size))
+            results.append(recv_stream(conn, header, path, direct, bufsize, deadline, meter))
+        except Exception as e:
+            errors.append(e)
+
+    # the first stream says how many the sender serves
+    first = connect(address, port)
+    header = HEADER.unpack(recv_exactly(first, HEADER.size))
+    conns = [connect(address, port) for _ in range(header[3] - 1)]
+    meter.start()
+    threads = [threading.Thread(target=receive, args=(first, header))]
+    threads += [threading.Thread(target=receive, args=(conn,)) for conn in conns]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    meter.finish()
+    if path and results and not errors:
+        os.truncate(path, results[0][0])
+    for e in errors:
+        print('sockcopy: {}'.format(e), file=sys.stderr)
+    return 1 if errors else 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='socket copy engine of the native transfer tool')
+    parser.add_argument('mode', choices=['send', 'recv'])
+    parser.add_argument('--port', type=int, required=True)
+    parser.add_argument('--address')
+    parser.add_argument('--file')
+    parser.add_argument('--ranges', help='offset:length,... of --file, one stream each')
+    parser.add_argument('--streams', type=int, default=1, help='streams of zeros without --file')
+    parser.add_argument('--direct', action='store_true')
+    parser.add_argument('--duration', type=float)
+    parser.add_argument('--bufsize', type=int, default=DEFAULT_BUFSIZE)
+    args = parser.parse_args(argv)
+    if args.mode == 'send':
+        if args.file and not args.ranges:
+            parser.error('send --file needs --ranges')
+        ranges = parse_ranges(args.ranges) if args.file else None
+        return send(args.port, args.file, ranges, args.streams)
+    return recv(args.address, args.port, args.file, args.direct, args.duration, args.bufsize)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,55 @@
+import ctypes
+import logging
+import os
+import platform
+import subprocess
+
+# set_mempolicy(2) modes
+MPOL_DEFAULT = 0
+MPOL_PREFERRED = 1
+MPOL_BIND = 2
+MPOL_INTERLEAVE = 3
+MEM_POLICIES = {'preferred': MPOL_PREFERRED, 'bind': MPOL_BIND, 'interleave': MPOL_INTERLEAVE}
+
+_SYS_SET_MEMPOLICY = {'x86_64': 238, 'aarch64': 237, 'ppc64le': 261}.get(platform.machine())
+_libc = ctypes.CDLL(None, use_errno=True)
+
+def set_mempolicy(mode, nodes=()):
+    """ Set the calling thread's NUMA memory policy, False where unsupported """
+    if _SYS_SET_MEMPOLICY is None:
+        return False
+    maxnode = max(nodes) + 2 if nodes else 0
+    mask = (ctypes.c_ulong * ((maxnode + 63) // 64 or 1))()
+    for node in nodes:
+        mask[node // 64] |= 1 << (node % 64)
+    if _libc.syscall(_SYS_SET_MEMPOLICY, mode, mask if nodes else None, maxnode) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, 'set_mempolicy: {}'.format(os.strerror(err)))
+    return True
+
+def spawn(args, cpus=None, mem_policy=None, mem_nodes=(), **popen_args):
+    """ Start args (a list, no shell) already bound to cpus and mem_policy
+
+    Linux applies sched_setaffinity(0) and set_mempolicy to the calling
+    thread only, and a child inherits both from the thread that forks it.
+    So both are set on this thread around Popen and restored afterwards:
+    the child runs on the intended cores from its first instruction, with
+    no preexec_fn and no window where it runs unbound. Other agent threads
+    are not affected.
+    """
+    saved_cpus = None
+    policy_set = False
+    try:
+        if cpus:
+            saved_cpus = os.sched_getaffinity(0)
+            os.sched_setaffinity(0, cpus)
+        if mem_policy is not None and mem_nodes:
+            policy_set = set_mempolicy(MEM_POLICIES[mem_policy], mem_nodes)
+            if not policy_set:
+                logging.debug('set_mempolicy is not supported on {}'.format(platform.machine()))
+        return subprocess.Popen(args, **popen_args)
+    finally:
+        if saved_cpus is not None:
+            os.sched_setaffinity(0, saved_cpus)
+        if policy_set:
+            set_mempolicy(MPOL_DEFAULT)
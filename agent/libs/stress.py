@@ -1,11 +1,15 @@
 from libs.TransferTools import TransferTools
+from libs.iostats import record_fio_output
+from libs.supervisor import get_supervisor
 import subprocess
 import logging
+import signal
+import tempfile
 import sys, os
 
 class stress(TransferTools):   
 
-    running_thread = None
+    # runs are supervised; without a transfer_id the latest run is used
 
     def __init__(self, **optional_args) -> None: return                
 
@@ -32,7 +36,10 @@ class stress(TransferTools):
         fsize = optional_args['size']
 
         os.makedirs(os.path.dirname(dstfile), exist_ok=True)
-        with open('bench.fio', 'w') as fh:            
+        # every run has its own job and output file so several can run at once
+        fd, job_file = tempfile.mkstemp(prefix='bench-', suffix='.fio')
+        output = job_file[:-len('.fio')] + '.json'
+        with os.fdopen(fd, 'w') as fh:            
             fh.writelines('[global]\nname=fio-seq-write\nrw=write\nbs=1m\ndirect=1\nioengine=sync\niodepth=16'
             '\ngroup_reporting=1\ntime_based\nfilename={}\nsize={}\n\n'.format(dstfile, fsize))
             prev_time = 0        
@@ -43,22 +50,50 @@ class stress(TransferTools):
                     fh.writelines('[{0}]\nruntime={1}\nstartdelay={2}\nrate={3}\n\n'.format(i, duration,prev_time,speed ))                    
                 prev_time = prev_time + duration
         
-        proc = subprocess.Popen(['fio', 'bench.fio'], stdout = sys.stdout, stderr = sys.stdout)
-        stress.running_thread = proc
-        return {'result': True}
+        proc = subprocess.Popen(['fio', '--output-format=json+', '--output=%s'%output, job_file],
+            stdout = sys.stdout, stderr = sys.stdout)
+        transfer = get_supervisor().add('stress', proc, job_file=job_file, output=output)
+        return {'result': True, 'transfer_id': transfer.id}
 
-    @classmethod
-    def poll_progress(cls, **optional_args):        
-        if stress.running_thread == None:
+    @staticmethod
+    def find_transfer(transfer_id=None):
+        transfer = get_supervisor().find('stress', transfer_id=transfer_id)
+        if transfer is None:
             raise Exception('stress is not running')
+        return transfer
+
+    @staticmethod
+    def remove_files(transfer):
+        for fn in (transfer.info['job_file'], transfer.info['output']):
+            if os.path.exists(fn):
+                os.remove(fn)
+
+    @classmethod
+    def get_process(cls, **optional_args):
+        return stress.find_transfer(optional_args.get('transfer_id')).proc
 
-        stress.running_thread.communicate(timeout=None)        
+    @classmethod
+    def poll_progress(cls, **optional_args):        
+        supervisor = get_supervisor()
+        transfer = stress.find_transfer(optional_args.get('transfer_id'))
+        supervisor.wait(transfer)
+        supervisor.release(transfer)
+        try:
+            with open(transfer.info['output']) as fh:
+                return record_fio_output('stress', fh.read())
+        except FileNotFoundError:
+            return None
+        finally:
+            stress.remove_files(transfer)
         
     @classmethod
     def cleanup(cls, **optional_args):
-        logging.debug('cleaning up thread {}'.format(stress.running_thread.pid))
-        TransferTools.kill_proc_tree(stress.running_thread.pid)
-        stress.running_thread.communicate()
-        os.remove('bench.fio')
-        stress.running_thread = None
+        supervisor = get_supervisor()
+        for transfer in supervisor.active('stress'):
+            logging.debug('cleaning up thread {}'.format(transfer.proc.pid))
+            try:
+                supervisor.kill(transfer, tree=True, sig=signal.SIGTERM)
+            finally:
+                supervisor.release(transfer)
+                stress.remove_files(transfer)
         
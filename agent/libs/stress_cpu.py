@@ -1,11 +1,13 @@
 from libs.TransferTools import TransferTools
+from libs.supervisor import get_supervisor
 import subprocess
 import logging
+import signal
 import sys, os
 
 class stress_cpu(TransferTools):   
 
-    sysbench_running_thread = None
+    # runs are supervised; without a transfer_id the latest run is used
 
     def __init__(self, **optional_args) -> None:
         return
@@ -38,24 +40,36 @@ class stress_cpu(TransferTools):
                 duration = seq[i][j+1] - seq[i][j]
                 cmd += 'sysbench --threads={0} --time={1} cpu run;'.format(threads, duration)                
     
-        proc = subprocess.Popen(cmd, stdout = subprocess.PIPE, stderr = subprocess.PIPE, shell=True)
-        stress_cpu.sysbench_running_thread = proc
-        return {'result': True}
+        # nothing reads a pipe while the supervisor waits, so log the output instead
+        proc = subprocess.Popen(cmd, stdout = sys.stdout, stderr = sys.stderr, shell=True)
+        transfer = get_supervisor().add('stress_cpu', proc)
+        return {'result': True, 'transfer_id': transfer.id}
 
-    @classmethod
-    def poll_progress(cls, **optional_args):
-        if stress_cpu.sysbench_running_thread == None:
+    @staticmethod
+    def find_transfer(transfer_id=None):
+        transfer = get_supervisor().find('stress_cpu', transfer_id=transfer_id)
+        if transfer is None:
             raise Exception('stress_cpu is not running')
+        return transfer
+
+    @classmethod
+    def get_process(cls, **optional_args):
+        return stress_cpu.find_transfer(optional_args.get('transfer_id')).proc
 
-        stress_cpu.sysbench_running_thread.communicate(timeout=None)
+    @classmethod
+    def poll_progress(cls, **optional_args):
+        supervisor = get_supervisor()
+        transfer = stress_cpu.find_transfer(optional_args.get('transfer_id'))
+        supervisor.wait(transfer)
+        supervisor.release(transfer)
         
     @classmethod
     def cleanup(cls, **optional_args):
-        logging.debug('cleaning up thread {}'.format(stress_cpu.sysbench_running_thread.pid))
-        try:
-            TransferTools.kill_proc_tree(stress_cpu.sysbench_running_thread.pid)
-            stress_cpu.sysbench_running_thread.communicate()
-        finally:
-            if os.path.exists('bench.fio'): os.remove('bench.fio')
-            stress_cpu.sysbench_running_thread = None
-        
\ No newline at end of file
+        supervisor = get_supervisor()
+        for transfer in supervisor.active('stress_cpu'):
+            logging.debug('cleaning up thread {}'.format(transfer.proc.pid))
+            try:
+                supervisor.kill(transfer, tree=True, sig=signal.SIGTERM)
+            finally:
+                supervisor.release(transfer)
+        if os.path.exists('bench.fio'): os.remove('bench.fio')
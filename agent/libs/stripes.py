@@ -0,0 +1,76 @@
+import fcntl
+import os
+import threading
+
+# stripes start at multiples of this so O_DIRECT readers/writers stay aligned
+STRIPE_ALIGN = 1 << 20
+# bytes moved per splice call
+SPLICE_SIZE = 1 << 20
+
+def split_ranges(size, count, align=STRIPE_ALIGN):
+    """ Split size bytes into at most count aligned (offset, length) ranges """
+    step = -(-size // max(count, 1))
+    step = max(align, -(-step // align) * align)
+    return [(offset, min(step, size - offset)) for offset in range(0, size, step)] or [(0, 0)]
+
+class RangeCopier(threading.Thread):
+    """ Move a byte range between a file and a pipe in a background thread
+
+    With src_offset the range is read from the file src_fd into the pipe
+    dst_fd (sender side of a stripe), with dst_offset the pipe src_fd is
+    written into the file dst_fd at that offset (receiver side). Data moves
+    with splice(2) so it isn't copied through user space; os.pread/pwrite
+    are used where splice is missing. fds are closed once the range is done.
+    """
+
+    PIPE_SIZE = 1 << 20
+
+    def __init__(self, src_fd, dst_fd, length, src_offset=None, dst_offset=None):
+        super().__init__(name='range-copier', daemon=True)
+        self.src_fd = src_fd
+        self.dst_fd = dst_fd
+        self.length = length
+        self.src_offset = src_offset
+        self.dst_offset = dst_offset
+        self.size = 0
+        self.error = None
+        pipe_fd = dst_fd if src_offset is not None else src_fd
+        try:
+            fcntl.fcntl(pipe_fd, getattr(fcntl, 'F_SETPIPE_SZ', 1031), self.PIPE_SIZE)
+        except OSError:
+            pass
+
+    def _copy(self, count):
+        src_offset = self.src_offset + self.size if self.src_offset is not None else None
+        dst_offset = self.dst_offset + self.size if self.dst_offset is not None else None
+        if hasattr(os, 'splice'):
+            return os.splice(self.src_fd, self.dst_fd, count, offset_src=src_offset, offset_dst=dst_offset)
+        data = os.pread(self.src_fd, count, src_offset) if src_offset is not None else os.read(self.src_fd, count)
+        written = 0
+        while written < len(data):
+            if dst_offset is not None:
+                written += os.pwrite(self.dst_fd, data[written:], dst_offset + written)
+            else:
+                written += os.write(self.dst_fd, data[written:])
+        return len(data)
+
+    def run(self):
+        try:
+            while self.size < self.length:
+                n = self._copy(min(SPLICE_SIZE, self.length - self.size))
+                if not n:
+                    break
+                self.size += n
+            if self.size < self.length:
+                raise Exception('stripe ended after {} of {} bytes'.format(self.size, self.length))
+            if self.dst_offset is not None and os.read(self.src_fd, SPLICE_SIZE):
+                raise Exception('stripe received more than {} bytes'.format(self.length))
+        except Exception as e:
+            self.error = e
+            if self.dst_offset is not None:
+                # keep draining so the writer doesn't block on a full pipe
+                while os.read(self.src_fd, SPLICE_SIZE):
+                    pass
+        finally:
+            os.close(self.src_fd)
+            os.close(self.dst_fd)
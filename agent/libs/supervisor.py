@@ -0,0 +1,206 @@
+import logging
+import signal
+import subprocess
+import threading
+import time
+import uuid
+from collections import OrderedDict
+import psutil
+from libs.reaper import get_reaper
+
+# how often the usage of running transfers is sampled
+SAMPLE_INTERVAL = 1.0
+
+class Transfer:
+    """ A transfer tool process and what it used """
+
+    def __init__(self, tool, proc, role, key, info, parent=None):
+        self.id = uuid.uuid4().hex
+        self.parent = parent
+        self.tool = tool
+        self.proc = proc
+        self.role = role
+        self.key = key
+        self.info = info
+        self.started = time.time()
+        self.finished = None
+        self.released = False
+        self.usage = {'max_rss': 0}
+        self.exited = None
+
+    @property
+    def returncode(self):
+        return self.proc.returncode
+
+    def running(self):
+        return not self.exited.is_set()
+
+    def to_dict(self):
+        return {'id': self.id, 'parent': self.parent, 'tool': self.tool, 'role': self.role, 'key': self.key, 'pid': self.proc.pid,
+                'status': 'running' if self.running() else 'exited', 'returncode': self.returncode,
+                'started': self.started, 'elapsed': (self.finished or time.time()) - self.started,
+                'usage': dict(self.usage)}
+
+class Supervisor:
+    """ Registry of every transfer tool process
+
+    Each process gets a transfer id. Children are reaped centrally by the
+    reaper thread. While they run, psutil samples their CPU time, RSS and
+    context switches; once they exit the wait4 rusage replaces the samples
+    with exact totals. Tools look their processes up by (tool, role, key)
+    instead of keeping their own tables, so a tool can run any number of
+    instances.
+    """
+
+    def __init__(self, max_finished=1000):
+        self.lock = threading.Lock()
+        self.transfers = OrderedDict()
+        self.max_finished = max_finished
+        self.sampler = None
+
+    def add(self, tool, proc, role='receiver', key=None, parent=None, **info):
+        """ Supervise proc and return its Transfer; info is kept for the tool
+
+        Transfers made of several processes (stripes) share a parent id.
+        """
+        transfer = Transfer(tool, proc, role, key, info, parent)
+        # watch before publishing, lookups expect transfer.exited to be set
+        transfer.exited = get_reaper().watch(proc, on_exit=lambda _, rusage: self._exited(transfer, rusage))
+        with self.lock:
+            # a new transfer on the same key replaces the old one
+            for old in self.transfers.values():
+                if (old.tool, old.role, old.key) == (tool, role, key) and key is not None:
+                    old.released = True
+            self.transfers[transfer.id] = transfer
+            self._prune()
+            if self.sampler is None:
+                self.sampler = threading.Thread(target=self._sample, daemon=True, name='supervisor')
+                self.sampler.start()
+        return transfer
+
+    def _exited(self, transfer, rusage):
+        transfer.finished = time.time()
+        if rusage is not None:
+            transfer.usage.update({'cpu_user': rusage.ru_utime, 'cpu_system': rusage.ru_stime,
+                                   'ctx_voluntary': rusage.ru_nvcsw, 'ctx_involuntary': rusage.ru_nivcsw,
+                                   # ru_maxrss is in KiB
+                                   'max_rss': max(transfer.usage['max_rss'], rusage.ru_maxrss * 1024)})
+        logging.debug('{} {} {} exited after {:.1f}s, usage {}'.format(transfer.tool, transfer.role,
+            transfer.key, transfer.finished - transfer.started, transfer.usage))
+
+    def _read_usage(self, transfer):
+        try:
+            proc = psutil.Process(transfer.proc.pid)
+            with proc.oneshot():
+                cpu = proc.cpu_times()
+                ctx = proc.num_ctx_switches()
+                rss = proc.memory_info().rss
+        except psutil.Error:
+            return
+        transfer.usage.update({'cpu_user': cpu.user + cpu.children_user, 'cpu_system': cpu.system + cpu.children_system,
+                               'ctx_voluntary': ctx.voluntary, 'ctx_involuntary': ctx.involuntary,
+                               'max_rss': max(transfer.usage['max_rss'], rss)})
+
+    def _sample(self):
+        while True:
+            time.sleep(SAMPLE_INTERVAL)
+            for transfer in self.active():
+                if transfer.finished is None:
+                    self._read_usage(transfer)
+
+    def _prune(self):
+        finished = [transfer_id for transfer_id, transfer in self.transfers.items()
+                    if transfer.released and not transfer.running()]
+        for transfer_id in finished[:max(0, len(finished) - self.max_finished)]:
+            del self.transfers[transfer_id]
+
+    def get(self, transfer_id):
+        with self.lock:
+            return self.transfers.get(transfer_id)
+
+    def find(self, tool, role=None, key=None, transfer_id=None):
+        """ Return the matching transfer that hasn't been released
+
+        Without key or transfer_id the most recent transfer of tool (and
+        role) is returned; None if there is none.
+        """
+        with self.lock:
+            if transfer_id is not None:
+                transfer = self.transfers.get(transfer_id)
+                return transfer if transfer is not None and not transfer.released else None
+            for transfer in reversed(self.transfers.values()):
+                if transfer.released or transfer.tool != tool:
+                    continue
+                if role is not None and transfer.role != role:
+                    continue
+                if key is not None and transfer.key != key:
+                    continue
+                return transfer
+        return None
+
+    def find_proc(self, proc):
+        with self.lock:
+            for transfer in reversed(self.transfers.values()):
+                if transfer.proc is proc:
+                    return transfer
+        return None
+
+    def active(self, tool=None, role=None):
+        with self.lock:
+            return [transfer for transfer in self.transfers.values() if not transfer.released
+                    and (tool is None or transfer.tool == tool) and (role is None or transfer.role == role)]
+
+    def list(self, tool=None):
+        with self.lock:
+            return [transfer for transfer in self.transfers.values() if tool is None or transfer.tool == tool]
+
+    def children(self, parent, released=True):
+        """ Transfers of parent in the order they were added """
+        with self.lock:
+            return [transfer for transfer in self.transfers.values()
+                    if transfer.parent == parent and (released or not transfer.released)]
+
+    def release(self, transfer):
+        """ Forget transfer for lookups; its record stays in list() for a while """
+        transfer.released = True
+
+    def wait(self, transfer, timeout=None):
+        """ Wait for transfer to exit and return its returncode
+
+        Raises subprocess.TimeoutExpired like Popen.wait.
+        """
+        if not transfer.exited.wait(timeout):
+            raise subprocess.TimeoutExpired(transfer.proc.args, timeout)
+        # the reaper may have lost a race with another waiter
+        return transfer.proc.wait()
+
+    def kill(self, transfer, tree=False, sig=signal.SIGKILL):
+        """ Signal transfer (and its children with tree) and wait for it """
+        if transfer.running():
+            targets = []
+            if tree:
+                try:
+                    targets = psutil.Process(transfer.proc.pid).children(recursive=True)
+                except psutil.Error:
+                    pass
+            for child in targets:
+                try:
+                    child.send_signal(sig)
+                except psutil.Error:
+                    pass
+            try:
+                transfer.proc.send_signal(sig)
+            except ProcessLookupError:
+                pass
+        return self.wait(transfer)
+
+_supervisor = None
+_supervisor_lock = threading.Lock()
+
+def get_supervisor():
+    """ Return the process wide supervisor, creating it on first use """
+    global _supervisor
+    with _supervisor_lock:
+        if _supervisor is None:
+            _supervisor = Supervisor()
+        return _supervisor
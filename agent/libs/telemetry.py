@@ -0,0 +1,127 @@
+import re
+import threading
+import time
+from collections import deque
+from prometheus_client.core import GaugeMetricFamily
+
+# one sample per second, keep the last hour of every transfer
+HISTORY = 3600
+# seconds the reports of a finished transfer stay available
+RETENTION = 600
+
+# nuttcp -i interval report, e.g.
+#   118.2500 MB /   1.00 sec =  991.9390 Mbps     0 retrans
+# the final summary has the same start but also carries %TX/%RX
+INTERVAL_RE = re.compile(r'^\s*(?P<mb>[\d.]+) MB /\s*(?P<sec>[\d.]+) sec =\s*(?P<mbps>[\d.]+) Mbps'
+                         r'(?:.*?(?P<retrans>\d+) retrans)?')
+
+def parse_interval(line):
+    """ Return (MB, Mbps, retrans, is_summary) of a nuttcp report line or None """
+    match = INTERVAL_RE.match(line)
+    if match is None:
+        return None
+    retrans = match.group('retrans')
+    return (float(match.group('mb')), float(match.group('mbps')),
+            int(retrans) if retrans is not None else None, '%TX' in line)
+
+class IntervalMonitor(threading.Thread):
+    """ Reads a transfer's report stream and keeps its interval samples
+
+    Every line is passed on to echo (so the reports still show up in the
+    agent's log) and interval reports are kept in a ring buffer of
+    (timestamp, MB, Mbps, retrans). The final summary line is kept apart.
+    """
+
+    def __init__(self, stream, echo=None, history=HISTORY):
+        super().__init__(daemon=True)
+        self.stream = stream
+        self.echo = echo
+        self.samples = deque(maxlen=history)
+        self.summary = None
+        self.started_at = time.time()
+
+    def run(self):
+        for line in self.stream:
+            if isinstance(line, bytes):
+                line = line.decode(errors='replace')
+            if self.echo is not None:
+                self.echo.write(line)
+            report = parse_interval(line)
+            if report is None:
+                continue
+            mb, mbps, retrans, is_summary = report
+            if is_summary:
+                self.summary = {'MB': mb, 'Mbps': mbps, 'retrans': retrans}
+            else:
+                self.samples.append((time.time(), mb, mbps, retrans))
+
+    def latest(self):
+        try:
+            return self.samples[-1]
+        except IndexError:
+            return None
+
+    def to_dict(self, since=None):
+        samples = list(self.samples)
+        if since is not None:
+            samples = [sample for sample in samples if sample[0] > since]
+        return {'running': self.is_alive(), 'started': self.started_at, 'summary': self.summary,
+                'intervals': [{'time': ts, 'MB': mb, 'Mbps': mbps, 'retrans': retrans}
+                              for ts, mb, mbps, retrans in samples]}
+
+class ThroughputCollector:
+    """ Prometheus collector for the last interval of every running transfer
+
+    Monitors of transfers that were collected with finish() are dropped
+    retention seconds later, on the next add() or scrape.
+    """
+
+    def __init__(self, retention=RETENTION):
+        self.lock = threading.Lock()
+        self.monitors = {}
+        self.retention = retention
+        # key -> time.monotonic() of finish()
+        self.finished = {}
+
+    def _expire(self):
+        now = time.monotonic()
+        for key in [key for key, finished in self.finished.items() if finished + self.retention <= now]:
+            del self.finished[key]
+            self.monitors.pop(key, None)
+
+    def add(self, tool, cport, monitor):
+        with self.lock:
+            self._expire()
+            self.monitors[(tool, str(cport))] = monitor
+            self.finished.pop((tool, str(cport)), None)
+
+    def get(self, tool, cport):
+        with self.lock:
+            return self.monitors.get((tool, str(cport)))
+
+    def finish(self, tool, cport):
+        """ The transfer's result was collected, expire its monitor """
+        with self.lock:
+            if (tool, str(cport)) in self.monitors:
+                self.finished[(tool, str(cport))] = time.monotonic()
+
+    def remove(self, tool, cport=None):
+        """ Forget the monitor of one transfer, or of every transfer of tool """
+        with self.lock:
+            for key in [key for key in self.monitors if key[0] == tool and (cport is None or key[1] == str(cport))]:
+                del self.monitors[key]
+                self.finished.pop(key, None)
+
+    def collect(self):
+        gauge = GaugeMetricFamily('daas_agent_transfer_throughput_mbps',
+            'Throughput of the last reported interval of running transfers', labels=['tool', 'cport'])
+        with self.lock:
+            self._expire()
+            for key, monitor in self.monitors.items():
+                latest = monitor.latest()
+                if monitor.is_alive() and latest is not None:
+                    gauge.add_metric(key, latest[2])
+        yield gauge
+
+# shared by every tool that reports intervals, registered with the app's registry
+transfer_monitors = ThroughputCollector()
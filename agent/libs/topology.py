@@ -0,0 +1,104 @@
+import glob
+import logging
+import os
+import socket
+import psutil
+
+# sysfs mount point, the tests point it at a fake tree
+SYSFS = '/sys'
+
+def read_numa_node(path):
+    """ numa node from a sysfs numa_node file, None if unknown (-1) """
+    try:
+        with open(path) as fh:
+            node = int(fh.read().strip())
+    except (OSError, ValueError):
+        return None
+    return node if node >= 0 else None
+
+def device_numa_node(device):
+    """ numa node of a sysfs device, taken from the closest parent that has one """
+    device = os.path.realpath(device)
+    while device.startswith(os.path.join(SYSFS, 'devices') + os.sep):
+        if os.path.exists(os.path.join(device, 'numa_node')):
+            return read_numa_node(os.path.join(device, 'numa_node'))
+        device = os.path.dirname(device)
+    return None
+
+def interface_numa_nodes(interface):
+    """ numa nodes of the NICs behind interface (bonds and vlans are followed) """
+    path = os.path.join(SYSFS, 'class', 'net', interface)
+    lower = glob.glob(os.path.join(path, 'lower_*'))
+    if lower:
+        nodes = set()
+        for link in lower:
+            nodes |= interface_numa_nodes(os.path.basename(link)[len('lower_'):])
+        return nodes
+    node = device_numa_node(os.path.join(path, 'device'))
+    return {node} if node is not None else set()
+
+def block_numa_nodes(block):
+    """ numa nodes of the disks behind a /sys/block or /sys/dev/block entry
+
+    Partitions resolve to their disk and device mapper / md devices to the
+    disks in their slaves directory.
+    """
+    block = os.path.realpath(block)
+    if os.path.exists(os.path.join(block, 'partition')):
+        block = os.path.dirname(block)
+    slaves = glob.glob(os.path.join(block, 'slaves', '*'))
+    if slaves:
+        nodes = set()
+        for slave in slaves:
+            nodes |= block_numa_nodes(slave)
+        return nodes
+    node = device_numa_node(os.path.join(block, 'device'))
+    return {node} if node is not None else set()
+
+def path_numa_nodes(path):
+    """ numa nodes of the disks holding path (or its closest existing parent) """
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    dev = os.stat(path).st_dev
+    return block_numa_nodes(os.path.join(SYSFS, 'dev', 'block', '{}:{}'.format(os.major(dev), os.minor(dev))))
+
+def interface_for_address(address):
+    """ Local interface the kernel routes address through, None if unknown """
+    try:
+        family = socket.getaddrinfo(address, None)[0][0]
+        with socket.socket(family, socket.SOCK_DGRAM) as sock:
+            # connecting a UDP socket only picks the route, nothing is sent
+            sock.connect((address, 9))
+            local = sock.getsockname()[0]
+    except OSError:
+        return None
+    for name, snics in psutil.net_if_addrs().items():
+        if local in [snic.address.split('%')[0] for snic in snics]:
+            return name
+    return None
+
+def auto_numa_node(interface=None, path=None):
+    """ numa node for a transfer between interface and the disk under path
+
+    The NIC's node wins if NIC and disk are on different nodes: the network
+    side runs at the higher rate and suffers more from remote memory. None
+    if neither can be placed on a single node.
+    """
+    nic_nodes = interface_numa_nodes(interface) if interface else set()
+    disk_nodes = path_numa_nodes(path) if path else set()
+    if len(nic_nodes) == 1:
+        node = next(iter(nic_nodes))
+        if disk_nodes and disk_nodes != nic_nodes:
+            logging.debug('{} is on numa node {}, {} on {}; using {}'.format(interface, node, path, sorted(disk_nodes), node))
+        return node
+    if len(disk_nodes) == 1:
+        return next(iter(disk_nodes))
+    return None
+
+def topology():
+    """ numa nodes of the network interfaces and NVMe disks """
+    interfaces = {name: sorted(interface_numa_nodes(name)) for name in sorted(os.listdir(os.path.join(SYSFS, 'class', 'net')))}
+    disks = {os.path.basename(block): sorted(block_numa_nodes(block))
+             for block in sorted(glob.glob(os.path.join(SYSFS, 'block', 'nvme*')))}
+    return {'interfaces': interfaces, 'nvme': disks}
@@ -0,0 +1,12 @@
+import re
+
+SIZE_SUFFIXES = {'': 1, 'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30, 't': 1 << 40, 'p': 1 << 50}
+
+def parse_size(size):
+    """ Convert a fio style size ('64k', '100M', '1G', 4096) into bytes """
+    if isinstance(size, int):
+        return size
+    match = re.fullmatch(r'\s*(\d+)\s*([kmgtp]?)(i?b)?\s*', str(size), re.IGNORECASE)
+    if not match:
+        raise ValueError('Invalid size {}'.format(size))
+    return int(match.group(1)) * SIZE_SUFFIXES[match.group(2).lower()]
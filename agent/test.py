@@ -3,8 +3,32 @@ from flask_testing import TestCase
 import os
 import app
 import unittest
+import unittest.mock
 import tempfile
 import time
+import errno
+import hashlib
+import io
+import socket
+import json
+import tarfile
+import threading
+import subprocess
+from libs.file_index import FileIndex, Inotify
+from libs.hashing import hash_file, get_buffer, benchmark_chunk_sizes
+from libs.units import parse_size
+from libs.iostats import parse_fio_json, bin_percentile
+from libs.checksum_pool import ChecksumScheduler, make_batches
+from libs.jobs import Job
+from libs import topology
+from libs.stripes import RangeCopier
+from libs.packstream import PackReader
+from libs.supervisor import Supervisor, get_supervisor
+from libs.cores import CoreAllocator
+from libs.ports import PortAllocator
+from libs.reaper import get_reaper
+from libs.telemetry import transfer_monitors, ThroughputCollector, IntervalMonitor
+from concurrent.futures.process import BrokenProcessPool
 
 def create_temp_file(tmpdir):
     with open(os.path.join(tmpdir, 'hello_world'), 'w') as fp:
@@ -48,6 +72,100 @@ class AgentTest(TestCase):
         assert result is not None
         assert len(result) == 3        
 
+    def test_listfile_paginated(self):
+        data = ['test2', 'test3']
+        self.client.post('/create_dir/', json=data)
+
+        response = self.client.get('/files/?limit=2')
+        result = response.get_json()
+        assert [f['name'] for f in result['files']] == ['hello_world', 'test2']
+        assert result['next_cursor'] == 'test2'
+
+        response = self.client.get('/files/?limit=2&cursor=test2')
+        result = response.get_json()
+        assert [f['name'] for f in result['files']] == ['test3']
+        assert result['next_cursor'] is None
+
+        response = self.client.get('/files/?format=ndjson')
+        lines = response.data.decode().splitlines()
+        assert len(lines) == 3
+
+    def test_listfile_summary(self):
+        data = ['test2']
+        self.client.post('/create_dir/', json=data)
+
+        response = self.client.get('/files/?summary=1')
+        result = response.get_json()
+        assert result['file'] == 1
+        assert result['dir'] == 1
+        assert result['histogram']['4096'] == 1
+
+        response = self.client.get('/files/not_there?summary=1')
+        assert response.status_code == 404
+
+        response = self.client.get('/files/?summary=true')
+        assert response.get_json()['file'] == 1
+
+        response = self.client.get('/files/?summary=maybe')
+        assert response.status_code == 400
+
+    def wait_for(self, check, timeout=5):
+        deadline = time.time() + timeout
+        while not check():
+            if time.time() > deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def test_file_index(self):
+        root = self.tmpdirname.name
+        index = FileIndex(root)
+        index.start()
+        try:
+            assert index.stats()['watching']
+            names = lambda path=root: [e.name for e in index.list_dir(path)]
+            assert names() == ['hello_world']
+
+            os.mkdir(os.path.join(root, 'sub'))
+            create_temp_file(os.path.join(root, 'sub'))
+            assert self.wait_for(lambda: 'sub' in names() and names(os.path.join(root, 'sub')) == ['hello_world'])
+
+            os.rename(os.path.join(root, 'sub'), os.path.join(root, 'moved'))
+            assert self.wait_for(lambda: names() == ['hello_world', 'moved'])
+            assert names(os.path.join(root, 'moved')) == ['hello_world']
+            with self.assertRaises(FileNotFoundError):
+                index.list_dir(os.path.join(root, 'sub'))
+
+            os.remove(os.path.join(root, 'moved', 'hello_world'))
+            assert self.wait_for(lambda: names(os.path.join(root, 'moved')) == [])
+            # the directory's own mtime follows its entries
+            moved = os.path.join(root, 'moved')
+            assert self.wait_for(lambda: index.dirs[root]['moved'].st_mtime == os.stat(moved).st_mtime)
+            assert index.stats()['watches'] == 2
+        finally:
+            index.stop()
+
+    def test_file_index_watch_limit(self):
+        root = self.tmpdirname.name
+        os.mkdir(os.path.join(root, 'sub'))
+
+        def no_space(inotify, path, mask=None):
+            raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC), path)
+
+        index = FileIndex(root, rescan_interval=0.1)
+        with unittest.mock.patch.object(Inotify, 'add_watch', no_space):
+            index.start()
+        try:
+            stats = index.stats()
+            assert not stats['watching'] and stats['watches'] == 0
+            assert stats['ready'] and stats['entries'] == 2
+
+            create_temp_file(os.path.join(root, 'sub'))
+            names = lambda: [e.name for e in index.list_dir(os.path.join(root, 'sub'))]
+            assert self.wait_for(lambda: names() == ['hello_world'])
+        finally:
+            index.stop()
+
     def test_create_file(self):
         data = {
             'hello_world' : {                
@@ -61,6 +179,126 @@ class AgentTest(TestCase):
         result = response.get_json()
         assert result == 0 
 
+    def test_create_file_detail(self):
+        data = {
+            'hello_world' : {
+                'size' : '10M'
+            },
+            'disk0/hello_world2' : {
+                'size' : '10M'
+            }
+        }
+        response = self.client.post('/create_file/?detail=1', json=data)
+        result = response.get_json()
+        assert result['returncode'] == 0
+        assert sum(shard['files'] for shard in result['shards']) == 2
+        assert sum(shard['io_bytes'] for shard in result['shards']) == 20971520
+        assert all(shard['errors'] == [] for shard in result['shards'])
+
+    def test_create_file_modes(self):
+        data = {
+            'fast/fallocated' : {'size' : '10M', 'mode' : 'fallocate'},
+            'fast/sparse' : {'size' : '1G', 'mode' : 'sparse'},
+            'fast/pattern' : {'size' : '1M', 'mode' : 'pattern'},
+            'fast/random' : {'size' : '1M', 'mode' : 'random'}
+        }
+        response = self.client.post('/create_file/', json=data)
+        assert response.get_json() == 0
+        assert os.path.getsize(os.path.join(self.tmpdirname.name, 'fast/sparse')) == 1073741824
+        assert os.path.getsize(os.path.join(self.tmpdirname.name, 'fast/random')) == 1048576
+
+        response = self.client.post('/create_file/?detail=true', json=data)
+        result = response.get_json()
+        assert result['skipped'] == 4
+
+        response = self.client.post('/create_file/?detail=maybe', json=data)
+        assert response.status_code == 400
+
+        data = {'fast/bad' : {'size' : '1M', 'mode' : 'something'}}
+        response = self.client.post('/create_file/', json=data)
+        assert response.status_code == 400
+
+    def test_create_file_rewrite(self):
+        path = os.path.join(self.tmpdirname.name, 'fast/pattern')
+        data = {'fast/pattern' : {'size' : '1M', 'mode' : 'sparse'}}
+        self.client.post('/create_file/', json=data)
+
+        # a sparse file of the right size has no pattern data yet
+        data['fast/pattern']['mode'] = 'pattern'
+        response = self.client.post('/create_file/?detail=1', json=data)
+        assert response.get_json()['skipped'] == 0
+        with open(path, 'rb') as fh:
+            assert fh.read(256) == bytes(range(256))
+        response = self.client.post('/create_file/?detail=1', json=data)
+        assert response.get_json()['skipped'] == 1
+
+        # a failed write leaves neither the file nor its partial copy
+        os.remove(path)
+        with unittest.mock.patch('libs.provision.write_segment', side_effect=OSError(28, 'No space left on device')):
+            with self.assertRaises(OSError):
+                app.get_provisioner().create_files({path: (1 << 20, 'random')})
+        assert os.listdir(os.path.dirname(path)) == []
+
+    def test_create_file_fio_rewrite(self):
+        path = os.path.join(self.tmpdirname.name, 'fast/fio')
+        self.client.post('/create_file/', json={'fast/fio' : {'size' : '1M', 'mode' : 'sparse'}})
+
+        # same size, but fio has never written the data
+        fio_specs, native_specs, skipped = app.parse_file_specs({'fast/fio' : {'size' : '1M'}})
+        assert fio_specs == {path: '1M'}
+        assert skipped == {}
+
+        os.remove(path)
+        self.client.post('/create_file/', json={'fast/fio' : {'size' : '1M', 'mode' : 'random'}})
+        fio_specs, native_specs, skipped = app.parse_file_specs({'fast/fio' : {'size' : '1M'}})
+        assert fio_specs == {}
+        assert skipped == {path: 1048576}
+
+    def test_create_file_job(self):
+        data = {
+            'job/pattern' : {'size' : '3M', 'mode' : 'pattern'},
+            'job/sparse' : {'size' : '1M', 'mode' : 'sparse'}
+        }
+        response = self.client.post('/create_file_job/', json=data)
+        job_id = response.get_json()['id']
+
+        for _ in range(50):
+            response = self.client.get('/create_file_job/{}'.format(job_id))
+            result = response.get_json()
+            if result['status'] not in ('pending', 'running'):
+                break
+            time.sleep(0.1)
+        assert result['status'] == 'done'
+        assert result['returncode'] == 0
+        assert result['files_done'] == 2
+        assert result['bytes_total'] == 4194304
+        # the sparse file is not written
+        assert result['bytes_written'] == 3145728
+        assert result['bytes_skipped'] == 1048576
+        assert result['eta_seconds'] is None
+
+        response = self.client.delete('/create_file_job/{}'.format(job_id))
+        assert response.status_code == 200
+        response = self.client.get('/create_file_job/{}'.format(job_id))
+        assert response.status_code == 404
+
+        data = {'job/bad' : {'size' : '1M', 'mode' : 'something'}}
+        response = self.client.post('/create_file_job/', json=data)
+        assert response.status_code == 400
+
+    def test_job_rate(self):
+        job = Job('test')
+        assert job.rate('bytes_written') is None
+        with unittest.mock.patch('libs.jobs.time.monotonic', return_value=100.0):
+            job.track_rate('bytes_written', window=10)
+        for now, count in ((102.0, 100), (108.0, 100), (115.0, 600)):
+            with unittest.mock.patch('libs.jobs.time.monotonic', return_value=now):
+                job.add(bytes_written=count)
+        with unittest.mock.patch('libs.jobs.time.monotonic', return_value=116.0):
+            # counted from the newest sample before the window (102 s)
+            assert job.rate('bytes_written') == 700 / 14
+        assert job.to_dict()['bytes_written'] == 800
+
     def test_delete_file(self):
         response = self.client.delete('file/hello_world')        
         assert response.status_code == 200
@@ -92,6 +330,163 @@ class AgentTest(TestCase):
         response = self.client.delete('/file/*')
         result = response.get_json()
 
+    def test_hash_file(self):
+        path = os.path.join(self.tmpdirname.name, 'hello_world')
+        expected = hashlib.md5(b'Hello world!').hexdigest()
+        for chunk_size in (1, 5, 12, 4096):
+            assert hash_file(path, chunk_size=chunk_size) == expected
+        # the read buffer is reused per thread as long as the size stays
+        assert get_buffer(4096) is get_buffer(4096)
+        assert len(get_buffer(5)) == 5
+        assert hash_file(path, 'sha256', 5) == hashlib.sha256(b'Hello world!').hexdigest()
+
+        results = benchmark_chunk_sizes(path, [4, 4096], repeat=1)
+        assert [res['chunk_size'] for res in results] == [4, 4096]
+
+    def test_parse_size(self):
+        assert parse_size(4096) == 4096
+        assert parse_size('4096') == 4096
+        assert parse_size('64k') == 64 << 10
+        assert parse_size('1M') == 1 << 20
+        assert parse_size('2GiB') == 2 << 30
+        assert parse_size(' 1t ') == 1 << 40
+        for size in ('', '1.5G', '1X', '-1k', 'M'):
+            with self.assertRaises(ValueError):
+                parse_size(size)
+
+    def test_make_batches(self):
+        files = [('a', 10), ('b', 300), ('c', 50), ('d', 60), ('e', 1)]
+        # big files alone, the rest largest first up to batch_bytes
+        assert make_batches(files, batch_bytes=100) == [['b'], ['d', 'c'], ['a', 'e']]
+        assert make_batches(files, batch_bytes=1000, max_files=2) == [['b', 'd'], ['c', 'a'], ['e']]
+        assert make_batches([]) == []
+
+    def test_checksum_scheduler(self):
+        paths = []
+        for idx in range(5):
+            path = os.path.join(self.tmpdirname.name, 'file{}'.format(idx))
+            with open(path, 'wb') as fh:
+                fh.write(os.urandom(1000 * idx))
+            paths.append((path, 1000 * idx))
+        expected = {path: hash_file(path) for path, _ in paths}
+
+        scheduler = ChecksumScheduler(workers=2, batch_bytes=2000)
+        try:
+            scheduler.warm()
+            done = []
+            assert scheduler.hash_files(paths, callback=lambda files, size: done.append((files, size))) == expected
+            assert sum(files for files, _ in done) == 5
+            assert sum(size for _, size in done) == 10000
+
+            # a dead worker breaks the pool, the next request gets a new one
+            pool = scheduler.pool
+            with self.assertRaises(BrokenProcessPool):
+                pool.submit(os._exit, 1).result()
+            assert scheduler.hash_files(paths) == expected
+            assert scheduler.pool is not pool
+        finally:
+            scheduler.shutdown()
+
+    def test_checksum(self):
+        os.makedirs(os.path.join(self.tmpdirname.name, 'sums'))
+        create_temp_file(os.path.join(self.tmpdirname.name, 'sums'))
+
+        response = self.client.get('/checksum/sums')
+        result = response.get_json()
+        assert result == {'checksum': '86fb269d190d2c85f6e0468ceca42a20', 'num_files': 1, 'algorithm': 'md5'}
+
+        response = self.client.get('/checksum/sums?algorithm=blake2b')
+        result = response.get_json()
+        assert result['algorithm'] == 'blake2b'
+        assert len(result['checksum']) == 128
+
+        response = self.client.get('/checksum/sums?mode=tree&tree_chunk=4&chunks=1')
+        result = response.get_json()
+        assert result['mode'] == 'tree'
+        assert [c['offset'] for c in result['chunks']['hello_world']] == [0, 4, 8]
+        # H(0x01 || H(0x01 || H(0x00 || 'Hell') || H(0x00 || 'o wo')) || H(0x00 || 'rld!'))
+        assert result['checksum'] == 'ae966a7fc6673ca1a34046d7f5fa6510'
+        assert result['chunks']['hello_world'][2]['digest'] == hashlib.md5(b'\x00rld!').hexdigest()
+
+        response = self.client.get('/checksum/sums?mode=tree&tree_chunk=4&chunks=true')
+        assert len(response.get_json()['chunks']['hello_world']) == 3
+        response = self.client.get('/checksum/sums?mode=tree&tree_chunk=4&chunks=all')
+        assert response.status_code == 400
+
+        response = self.client.get('/checksum/sums?algorithm=nothing')
+        assert response.status_code == 400
+
+    def test_checksum_cache(self):
+        os.makedirs(os.path.join(self.tmpdirname.name, 'sums'))
+        create_temp_file(os.path.join(self.tmpdirname.name, 'sums'))
+        with tempfile.TemporaryDirectory() as state_dir:
+            app.app.config['CHECKSUM_CACHE'] = True
+            app.app.config['STATE_DIR'] = state_dir
+            app.checksum_cache = None
+            try:
+                response = self.client.get('/checksum/sums')
+                first = response.get_json()['checksum']
+                cache = app.get_checksum_cache()
+                assert cache.path == os.path.join(state_dir, 'checksums.sqlite')
+                assert cache.stats()['misses'] == 1 and cache.stats()['hits'] == 0
+
+                # unchanged file
+                response = self.client.get('/checksum/sums')
+                assert response.get_json()['checksum'] == first
+                assert cache.stats()['hits'] == 1
+
+                # same size, new mtime
+                path = os.path.join(self.tmpdirname.name, 'sums', 'hello_world')
+                st = os.stat(path)
+                os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+                response = self.client.get('/checksum/sums')
+                assert response.get_json()['checksum'] == first
+                assert cache.stats()['misses'] == 2
+
+                # new size
+                with open(path, 'a') as fh:
+                    fh.write('!')
+                response = self.client.get('/checksum/sums')
+                assert response.get_json()['checksum'] == hashlib.md5(b'Hello world!!').hexdigest()
+                assert cache.stats() == {'path': cache.path, 'hits': 1, 'misses': 3}
+
+                response = self.client.get('/metrics')
+                data = response.data.decode()
+                assert float(get_prom_metric('daas_agent_checksum_cache_hits_total', data, 2)) >= 1
+                assert float(get_prom_metric('daas_agent_checksum_cache_misses_total', data, 2)) >= 3
+            finally:
+                if app.checksum_cache:
+                    app.checksum_cache.close()
+                app.checksum_cache = None
+                app.app.config['CHECKSUM_CACHE'] = False
+                del app.app.config['STATE_DIR']
+
+    def test_checksum_job(self):
+        os.makedirs(os.path.join(self.tmpdirname.name, 'sums'))
+        create_temp_file(os.path.join(self.tmpdirname.name, 'sums'))
+
+        response = self.client.post('/checksum_job/', json={'path': 'sums'})
+        job_id = response.get_json()['id']
+
+        for _ in range(50):
+            response = self.client.get('/checksum_job/{}'.format(job_id))
+            result = response.get_json()
+            if result['status'] not in ('pending', 'running'):
+                break
+            time.sleep(0.1)
+        assert result['status'] == 'done'
+        assert result['checksum'] == '86fb269d190d2c85f6e0468ceca42a20'
+        assert result['files_done'] == 1
+        assert result['bytes_hashed'] == 12
+
+        response = self.client.delete('/checksum_job/{}'.format(job_id))
+        assert response.status_code == 200
+        response = self.client.get('/checksum_job/{}'.format(job_id))
+        assert response.status_code == 404
+
+        response = self.client.post('/checksum_job/', json={'path': 'not_there'})
+        assert response.status_code == 404
+
     def test_get_tools(self):
         response = self.client.get('/tools')
         result = response.get_json()
@@ -161,6 +556,39 @@ class AgentTest(TestCase):
         transfer_counter = get_prom_metric('daas_agent_num_transfers 0.0', data)
         assert transfer_counter == '0.0'
 
+    def test_sendfile_nuttcp_checksum(self):
+        data = {
+            'file' : 'hello_world',
+            'direct' : False,
+            'blocksize' : 1
+        }
+        response = self.client.post('/sender/nuttcp', json=data)
+        result = response.get_json()
+        assert result.pop('result') == True
+
+        result['file'] = 'hello_world2'
+        result['address'] = '127.0.0.1'
+        result['blocksize'] = 1
+        result['checksum'] = 'md5'
+
+        response = self.client.post('/receiver/nuttcp', json=result)
+        result = response.get_json()
+        assert result.pop('result') == True
+
+        data = {
+            'node' : 'receiver',
+            'cport' : result.pop('cport'),
+            'dstfile' : 'hello_world2'
+        }
+
+        response = self.client.get('/nuttcp/poll', json=data)
+        result = response.get_json()
+        assert result == [0, 12, '86fb269d190d2c85f6e0468ceca42a20']
+
+        data['node'] = 'sender'
+        response = self.client.get('/nuttcp/poll', json=data)
+        assert response.get_json() == 0
+
     def test_sendfile_nuttcp_memtomem(self):
         data = {            
             'file' : None,                    
@@ -191,12 +619,28 @@ class AgentTest(TestCase):
             'dstfile' : None
         }
 
+        response = self.client.get('/nuttcp/poll', json=dict(data, mode='status'))
+        assert response.get_json() == {'status': 'running'}
+
+        response = self.client.get('/nuttcp/poll', json=dict(data, mode='wait', wait=0.1))
+        assert response.status_code == 202
+        assert response.get_json() == {'status': 'running'}
+
         response = self.client.get('/nuttcp/poll', json=data)
-        result = response.get_json()        
+        result = response.get_json()
         assert result == [0, None]
 
+        response = self.client.get('/nuttcp/progress/{}'.format(cport))
+        result = response.get_json()
+        assert result['running'] == False
+        assert len(result['intervals']) > 0
+        assert result['intervals'][0]['Mbps'] > 0
+
+        response = self.client.get('/nuttcp/progress/1')
+        assert response.status_code == 404
+
         data['node'] = 'sender'
-        response = self.client.get('/nuttcp/poll', json=data)
+        response = self.client.get('/nuttcp/poll', json=dict(data, mode='wait'))
         result = response.get_json()        
         assert result == 0
 
@@ -263,8 +707,49 @@ class AgentTest(TestCase):
         assert result.pop('result') == True        
         
         cport = result['cport']
+        response = self.client.get('/ports')
+        result = response.get_json()
+        assert cport in [lease['cport'] for lease in result['leases']]
+        leased = result['leased']
+
         response = self.client.get('/free_port/nuttcp/{}'.format(cport))
-        result = response.get_json()        
+        result = response.get_json()
+
+        response = self.client.get('/ports')
+        result = response.get_json()
+        assert result['leased'] == leased - 1
+        assert result['free'] == result['total'] - result['leased']
+
+    def test_sender_spawn_failure(self):
+        leased = self.client.get('/ports').get_json()['leased']
+        data = [{'file' : 'hello_world', 'direct' : False}, {'file' : None}]
+        with unittest.mock.patch('libs.nuttcp.nuttcp.spawn', side_effect=OSError(2, 'No such file or directory')):
+            response = self.client.post('/sender/nuttcp/batch', json=data)
+        assert [item['result'] for item in response.get_json()] == [False, False]
+        # the port pairs went back to the pool
+        assert self.client.get('/ports').get_json()['leased'] == leased
+
+    def test_cores(self):
+        data = {
+            'file' : 'hello_world',
+            'direct' : False,
+            'numa_scheme' : 3,
+            'numa_node' : 0
+        }
+        response = self.client.post('/sender/nuttcp', json=data)
+        result = response.get_json()
+        assert result.pop('result') == True
+        cport = result['cport']
+
+        response = self.client.get('/cores')
+        result = response.get_json()
+        assert len(result['nodes']['0']['assigned']) == 1
+
+        # the core is back in the pool once the sender is reaped
+        response = self.client.get('/free_port/nuttcp/{}'.format(cport))
+        response = self.client.get('/cores')
+        result = response.get_json()
+        assert result['nodes']['0']['assigned'] == {}
 
     def test_msrsync_cleanup(self):
 
@@ -364,12 +849,407 @@ class AgentTest(TestCase):
         
         assert response.status_code == 200
 
+    def test_sendfile_nuttcp_striped(self):
+        data = {
+            'striped' : {
+                'size' : '10M',
+                'mode' : 'random'
+            }
+        }
+        self.client.post('/create_file/', json=data)
+
+        data = {
+            'file' : 'striped',
+            'stripes' : 4
+        }
+        response = self.client.post('/sender/nuttcp', json=data)
+        result = response.get_json()
+        assert result.pop('result') == True
+        assert len(result['stripes']) == 4
+        sender_id = result['transfer_id']
+
+        result['file'] = 'striped2'
+        result['address'] = '127.0.0.1'
+        response = self.client.post('/receiver/nuttcp', json=result)
+        result = response.get_json()
+        assert result.pop('result') == True
+
+        data = {
+            'node' : 'receiver',
+            'cport' : result['cport'],
+            'dstfile' : 'striped2'
+        }
+        response = self.client.get('/nuttcp/poll', json=data)
+        assert response.get_json() == [0, 10485760]
+
+        data['node'] = 'sender'
+        response = self.client.get('/nuttcp/poll', json=data)
+        assert response.get_json() == 0
+
+        response = self.client.get('/transfers/{}'.format(sender_id))
+        result = response.get_json()
+        assert result['status'] == 'exited'
+        assert len(result['stripes']) == 4
+
+        with open(os.path.join(self.tmpdirname.name, 'striped'), 'rb') as src, \
+                open(os.path.join(self.tmpdirname.name, 'striped2'), 'rb') as dst:
+            assert src.read() == dst.read()
+
+    def test_range_copier_short(self):
+        pipe_r, pipe_w = os.pipe()
+        os.write(pipe_w, b'x' * 10)
+        os.close(pipe_w)
+        fd = os.open(os.path.join(self.tmpdirname.name, 'short'), os.O_WRONLY | os.O_CREAT)
+        copier = RangeCopier(pipe_r, fd, 20, dst_offset=0)
+        copier.start()
+        copier.join()
+        # a truncated stripe is an error, not a short success
+        assert copier.size == 10
+        assert copier.error is not None
+
+    def test_parse_fio_json(self):
+        with open(os.path.join(os.path.dirname(__file__), 'fixtures', 'fio-write.json')) as fh:
+            text = fh.read()
+        # fio prints warnings ahead of the JSON
+        res = parse_fio_json('note: both iodepth >= 1 and synchronous I/O engine are selected\n' + text, with_bins=True)
+        assert 'read' not in res
+        assert res['errors'] == []
+        write = res['write']
+        assert write['io_bytes'] == 8388608
+        assert write['bw_bytes'] == 3145728
+        assert write['clat_ns']['N'] == 8
+        assert write['clat_ns']['mean'] == 4375
+        assert write['clat_ns']['max'] == 8000
+        # from the bins of both jobs: 1000 x1, 2000 x3, 4000 x1, 8000 x3
+        assert write['clat_ns']['bins'] == [(1000, 1), (2000, 3), (4000, 1), (8000, 3)]
+        assert write['clat_ns']['percentile'] == {'50.000000': 2000, '90.000000': 8000,
+                                                  '99.000000': 8000, '99.900000': 8000}
+
+        # plain json output: the worst job's percentile
+        data = json.loads(text)
+        for job in data['jobs']:
+            del job['write']['clat_ns']['bins']
+        res = parse_fio_json(json.dumps(data))
+        assert res['write']['clat_ns']['percentile']['50.000000'] == 8000
+        assert 'bins' not in res['write']['clat_ns']
+
+        with self.assertRaises(ValueError):
+            parse_fio_json('fio: failed to open file')
+
+    def test_bin_percentile(self):
+        bins = [(1000, 1), (1500, 0), (2000, 1)]
+        # a percentile that ends exactly on a bin is that bin
+        assert bin_percentile(bins, 2, 50) == 1000
+        assert bin_percentile(bins, 2, 50.1) == 2000
+        assert bin_percentile(bins, 2, 100) == 2000
+        assert bin_percentile([], 0, 99) == 0
+
+    def test_core_allocator(self):
+        nodes = {0: [0, 1, 2, 3], 1: [4, 5, 6, 7]}
+        # two cores per node with two threads each
+        siblings = lambda cpu: {cpu, cpu ^ 2}
+        with unittest.mock.patch('libs.cores.thread_siblings', siblings), \
+             unittest.mock.patch('libs.cores.os.sched_getaffinity', return_value=set(range(8))):
+            cores = CoreAllocator(node_to_cpus=nodes.get, avoid_siblings=True)
+            first = cores.allocate(0, 2, owner=100)
+            assert first == {0, 1}
+            # no whole core left, a sibling is better than sharing the node
+            assert cores.allocate(0, 1, owner=200) == {2}
+            assert cores.oversubscribed == 0
+
+            assert cores.allocate(0, 2, owner=300) == {0, 1, 2, 3}
+            assert cores.oversubscribed == 1
+            assert cores.allocate(1, 2, owner=400) == {4, 5}
+
+            # only the owner gives cores back
+            cores.release(first, owner=200)
+            assert cores.stats()['nodes'][0]['free'] == [3]
+            cores.release(first, owner=100)
+            assert cores.stats()['nodes'][0]['free'] == [0, 1, 3]
+            # 0 shares its core with 2, which is still in use
+            assert cores.allocate(0, 1, owner=500) == {1}
+
+    def test_port_allocator(self):
+        ports = PortAllocator(47001, 3, 100, address='127.0.0.1')
+        pairs = [ports.allocate() for _ in range(3)]
+        assert pairs == [(47001, 47101), (47002, 47102), (47003, 47103)]
+        with self.assertRaises(Exception):
+            ports.allocate()
+        ports.release(47002)
+        assert ports.allocate() == (47002, 47102)
+
+        # a port held by another socket is skipped
+        ports = PortAllocator(47001, 3, 100, address='127.0.0.1')
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            sock.bind(('127.0.0.1', 47001))
+            sock.listen()
+            assert ports.allocate() == (47002, 47102)
+        assert ports.conflicts == 1
+
+        # an expired lease is reclaimed and its owner told
+        expired = []
+        ports = PortAllocator(47001, 3, 100, ttl=0, on_expire=expired.append, address='127.0.0.1')
+        cport, _ = ports.allocate()
+        stats = ports.stats()
+        assert expired == [cport]
+        assert stats['leased'] == 0
+        assert stats['reclaimed'] == 1
+
+    def test_supervisor_add(self):
+        supervisor = Supervisor()
+        reaper = get_reaper()
+        seen = []
+        def watch(proc, on_exit=None):
+            # nothing can look the transfer up before it can be waited for
+            seen.append(supervisor.find('test', 'sender', 1))
+            return reaper.watch(proc, on_exit=on_exit)
+
+        proc = subprocess.Popen(['sleep', '10'])
+        with unittest.mock.patch('libs.supervisor.get_reaper') as fake:
+            fake.return_value.watch = watch
+            transfer = supervisor.add('test', proc, role='sender', key=1)
+        assert seen == [None]
+        assert supervisor.find('test', 'sender', 1).running()
+        supervisor.kill(transfer)
+        assert not transfer.running()
+
+    def test_monitor_retention(self):
+        collector = ThroughputCollector(retention=60)
+        monitor = IntervalMonitor(io.BytesIO(b'  1.0000 MB /   1.00 sec =    8.3886 Mbps     0 retrans\n'))
+        monitor.start()
+        monitor.join()
+        collector.add('nuttcp', 1, monitor)
+        collector.add('nuttcp', 2, monitor)
+
+        # a finished transfer can still be looked up for a while
+        collector.finish('nuttcp', 1)
+        list(collector.collect())
+        assert collector.get('nuttcp', 1) is monitor
+
+        collector.retention = 0
+        list(collector.collect())
+        assert collector.get('nuttcp', 1) is None
+        assert collector.get('nuttcp', 2) is monitor
+
+    def test_nuttcp_striped_receiver_cleanup(self):
+        tool = app.new_tool('nuttcp', {})
+        spawn = tool.spawn
+        def spawn_once(*args, **kwargs):
+            if get_supervisor().find('nuttcp', 'receiver', 40001) is not None:
+                raise OSError('no more processes')
+            return spawn(*args, **kwargs)
+
+        stripes = [{'cport': 40001, 'dport': 40002, 'offset': 0, 'length': 1 << 20},
+                   {'cport': 40003, 'dport': 40004, 'offset': 1 << 20, 'length': 1 << 20}]
+        with unittest.mock.patch.object(tool, 'spawn', spawn_once):
+            with self.assertRaises(OSError):
+                tool.run_receiver('127.0.0.1', os.path.join(self.tmpdirname.name, 'striped'),
+                                  stripes=stripes, size=2 << 20)
+        # the stripe that did start is stopped and forgotten
+        assert get_supervisor().find('nuttcp', 'receiver', 40001) is None
+        assert transfer_monitors.get('nuttcp', 40001) is None
+
+    def test_pack_reader_outside(self):
+        base = os.path.join(self.tmpdirname.name, 'unpack')
+        dstdir = os.path.join(base, 'dst')
+        os.makedirs(dstdir)
+
+        def member(name, data=b'', link=None):
+            info = tarfile.TarInfo(name)
+            if link is not None:
+                info.type, info.linkname = tarfile.SYMTYPE, link
+            info.size = len(data)
+            return info, data
+
+        cases = {
+            'dotdot': [member('ok', b'ok'), member('../escape', b'evil')],
+            'absolute': [member(os.path.join(base, 'absolute'), b'evil')],
+            'symlink': [member('link', link='..'), member('link/escape', b'evil')],
+            'absolute symlink': [member('link', link=base)],
+        }
+        for extract_args in ({'filter': 'data'}, {}):
+            for name, members in cases.items():
+                with self.subTest(name, extract_args=extract_args):
+                    stream = io.BytesIO()
+                    with tarfile.open(fileobj=stream, mode='w') as tar:
+                        for info, data in members:
+                            tar.addfile(info, io.BytesIO(data))
+                    pipe_r, pipe_w = os.pipe()
+                    writer = threading.Thread(target=lambda: (os.write(pipe_w, stream.getvalue()), os.close(pipe_w)))
+                    writer.start()
+                    with unittest.mock.patch('libs.packstream.EXTRACT_ARGS', extract_args):
+                        reader = PackReader(pipe_r, dstdir)
+                        reader.start()
+                        reader.join()
+                    writer.join()
+                    assert reader.error is not None
+                    assert os.listdir(base) == ['dst']
+                    assert not os.path.lexists(os.path.join(dstdir, 'link'))
+
+    def test_sendfile_nuttcp_pack(self):
+        data = {'tree/file{}'.format(i) : {'size' : '4K', 'mode' : 'random'} for i in range(100)}
+        data['tree/sub/big'] = {'size' : '10M', 'mode' : 'random'}
+        self.client.post('/create_file/', json=data)
+
+        data = {
+            'file' : 'tree',
+            'parallel' : 4
+        }
+        response = self.client.post('/sender/nuttcp', json=data)
+        result = response.get_json()
+        assert result.pop('result') == True
+        assert result['pack'] == True
+        assert result['files'] == 101
+
+        result['file'] = 'tree2'
+        result['address'] = '127.0.0.1'
+        response = self.client.post('/receiver/nuttcp', json=result)
+        result = response.get_json()
+        assert result.pop('result') == True
+
+        data = {
+            'node' : 'receiver',
+            'cport' : result['cport'],
+            'dstfile' : 'tree2'
+        }
+        response = self.client.get('/nuttcp/poll', json=data)
+        assert response.get_json() == [0, 100 * 4096 + 10485760]
+
+        data['node'] = 'sender'
+        response = self.client.get('/nuttcp/poll', json=data)
+        assert response.get_json() == 0
+        assert os.path.getsize(os.path.join(self.tmpdirname.name, 'tree2/sub/big')) == 10485760
+
+    def test_batch(self):
+        data = [
+            {'file' : 'hello_world', 'direct' : False, 'blocksize' : 1},
+            {'file' : 'not_there'}
+        ]
+        response = self.client.post('/sender/nuttcp/batch', json=data)
+        result = response.get_json()
+        assert result[0].pop('result') == True
+        assert result[1] == {'result' : False, 'message' : 'file is not found', 'code' : 404}
+
+        sender = result[0]
+        sender['file'] = 'hello_world2'
+        sender['address'] = '127.0.0.1'
+        sender['direct'] = False
+        data = [sender, {'file' : None, 'address' : '127.0.0.1'}]
+        response = self.client.post('/receiver/nuttcp/batch', json=data)
+        result = response.get_json()
+        assert result[0]['result'] == True
+        assert result[1]['code'] == 404
+
+        data = [
+            {'node' : 'receiver', 'cport' : result[0]['cport'], 'dstfile' : 'hello_world2', 'mode' : 'block'},
+            {'node' : 'sender', 'cport' : result[0]['cport'], 'mode' : 'block'},
+            {'node' : 'something', 'cport' : result[0]['cport']}
+        ]
+        response = self.client.post('/nuttcp/poll/batch', json=data)
+        result = response.get_json()
+        assert result[0] == {'code' : 200, 'result' : [0, 12]}
+        assert result[1] == {'code' : 200, 'result' : 0}
+        assert result[2]['code'] == 400
+
+        response = self.client.post('/sender/nuttcp/batch', json={'file' : 'hello_world'})
+        assert response.status_code == 400
+
+        # a batch shares one tool instance per numa_scheme
+        instances = {}
+        tool_obj = app.new_tool('nuttcp', {}, instances)
+        assert app.new_tool('nuttcp', {'file' : 'x'}, instances) is tool_obj
+        bound = app.new_tool('nuttcp', {'numa_scheme' : 2}, instances)
+        assert bound is not tool_obj
+        assert app.new_tool('nuttcp', {'numa_scheme' : 2}, instances) is bound
+
+    def test_sendfile_native(self):
+        data = {
+            'big' : {
+                'size' : '10M',
+                'mode' : 'random'
+            }
+        }
+        self.client.post('/create_file/', json=data)
+
+        data = {
+            'file' : 'big',
+            'streams' : 4
+        }
+        response = self.client.post('/sender/native', json=data)
+        result = response.get_json()
+        assert result.pop('result') == True
+        assert result['streams'] == 4
+
+        # the receiver learns the number of streams from the sender
+        del result['streams']
+        result['file'] = 'big2'
+        result['address'] = '127.0.0.1'
+        result['direct'] = False
+        response = self.client.post('/receiver/native', json=result)
+        result = response.get_json()
+        assert result.pop('result') == True
+
+        data = {
+            'node' : 'receiver',
+            'cport' : result['cport'],
+            'dstfile' : 'big2'
+        }
+        response = self.client.get('/native/poll', json=data)
+        assert response.get_json() == [0, 10485760]
+
+        data['node'] = 'sender'
+        response = self.client.get('/native/poll', json=data)
+        assert response.get_json() == 0
+
+        with open(os.path.join(self.tmpdirname.name, 'big'), 'rb') as src, \
+                open(os.path.join(self.tmpdirname.name, 'big2'), 'rb') as dst:
+            assert src.read() == dst.read()
+
+    def test_native_memtomem(self):
+        data = {
+            'file' : None,
+            'streams' : 2
+        }
+        response = self.client.post('/sender/native', json=data)
+        result = response.get_json()
+        assert result.pop('result') == True
+
+        result['file'] = None
+        result['address'] = '127.0.0.1'
+        result['duration'] = 2
+        response = self.client.post('/receiver/native', json=result)
+        result = response.get_json()
+        assert result.pop('result') == True
+        cport = result['cport']
+
+        data = {
+            'node' : 'receiver',
+            'cport' : cport,
+            'dstfile' : None
+        }
+        response = self.client.get('/native/poll', json=data)
+        assert response.get_json() == [0, None]
+
+        response = self.client.get('/native/progress/{}'.format(cport))
+        assert response.get_json()['summary']['MB'] > 0
+
+        data['node'] = 'sender'
+        response = self.client.get('/native/poll', json=data)
+        assert response.get_json() == 0
+
+        data = {'file' : 'hello_world'}
+        response = self.client.post('/sender/native', json=data)
+        cport = response.get_json()['cport']
+        response = self.client.get('/free_port/native/{}'.format(cport))
+        assert response.status_code == 200
+
     def test_sendfile_nuttcp_numa(self):
         data = {            
             'file' : 'hello_world',            
             'direct' : False,
             'numa_scheme' : 2,
-            'numa_node' : 0
+            'numa_node' : 0,
+            'mem_policy' : 'preferred'
         }        
         response = self.client.post('/sender/nuttcp', json=data)
         result = response.get_json()
@@ -510,6 +1390,11 @@ class AgentTest(TestCase):
         assert response.status_code == 200
         assert result[0] == 0
         assert result[1] == 10485760
+        assert result[2]['read']['io_bytes'] == 10485760
+        assert '50.000000' in result[2]['read']['clat_ns']['percentile']
+
+        response = self.client.get('/metrics')
+        assert b'daas_agent_io_clat_seconds_bucket' in response.data
 
         result2['node'] = 'receiver'
         result2['dstfile'] = 'disk0/fiotest2'
@@ -550,15 +1435,110 @@ class AgentTest(TestCase):
 
         result['node'] = 'receiver'
         result['dstfile'] = 'hello_world2'
-        response = self.client.get('/dd/poll', json=result)        
+        response = self.client.get('/dd/poll', json=result)
         assert response.status_code == 200
 
-        response = self.client.get('/cleanup/dd')        
+        response = self.client.get('/transfers/{}'.format(result['transfer_id']))
+        transfer = response.get_json()
+        assert transfer['status'] == 'exited'
+        assert transfer['returncode'] == 0
+        assert 'cpu_user' in transfer['usage']
+
+        response = self.client.get('/transfers?tool=dd')
+        assert result['transfer_id'] in [t['id'] for t in response.get_json()]
+
+        response = self.client.get('/cleanup/dd')
         assert response.status_code == 200
         
         response = self.client.get('/dd/poll', json=result)
         assert response.status_code == 400
 
+    def test_numa_auto(self):
+        response = self.client.get('/topology')
+        result = response.get_json()
+        assert 'lo' in result['interfaces']
+
+        data = {
+            'file' : 'hello_world3',
+            'address' : 'localhost',
+            'srcfile' : os.path.join(self.tmpdirname.name, 'hello_world'),
+            'direct' : False,
+            'numa_node' : 'auto'
+        }
+        response = self.client.post('/receiver/dd', json=data)
+        result = response.get_json()
+        assert result.pop('result') == True
+
+        result['node'] = 'receiver'
+        result['dstfile'] = 'hello_world3'
+        response = self.client.get('/dd/poll', json=result)
+        assert response.status_code == 200
+
+    def make_sysfs(self, root):
+        """ Fake sysfs: nic0/nvme1n1 on node 0, nic1/nvme0n1 on node 1 """
+        def mkdir(*path):
+            os.makedirs(os.path.join(root, *path), exist_ok=True)
+            return os.path.join(root, *path)
+        def link(target, *path):
+            path = os.path.join(root, *path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.symlink(target, path)
+
+        pci = {0: mkdir('devices/pci0000:00/0000:00:01.0'), 1: mkdir('devices/pci0000:80/0000:80:01.0')}
+        for node, dev in pci.items():
+            with open(os.path.join(dev, 'numa_node'), 'w') as fh:
+                fh.write('{}\n'.format(node))
+        for nic, node in (('nic0', 0), ('nic1', 1), ('nic2', 0)):
+            link(pci[node], 'class/net', nic, 'device')
+        # bonds list their ports as lower_<name>
+        link('../nic0', 'class/net/bond0/lower_nic0')
+        link('../nic2', 'class/net/bond0/lower_nic2')
+        link('../nic0', 'class/net/bond1/lower_nic0')
+        link('../nic1', 'class/net/bond1/lower_nic1')
+        mkdir('class/net/lo')
+
+        disks = {}
+        for disk, node in (('nvme0n1', 1), ('nvme1n1', 0)):
+            ctrl = mkdir(pci[node], 'nvme', disk[:5])
+            disks[disk] = mkdir(ctrl, disk)
+            link(ctrl, os.path.relpath(disks[disk], root), 'device')
+            link(disks[disk], 'block', disk)
+        part = mkdir(disks['nvme0n1'], 'nvme0n1p1')
+        open(os.path.join(part, 'partition'), 'w').close()
+        dm = mkdir('devices/virtual/block/dm-0')
+        link(part, 'devices/virtual/block/dm-0/slaves/nvme0n1p1')
+        link(disks['nvme1n1'], 'devices/virtual/block/dm-0/slaves/nvme1n1')
+        return part, dm
+
+    def test_numa_topology(self):
+        root = os.path.realpath(self.tmpdirname.name)
+        part, dm = self.make_sysfs(os.path.join(root, 'sys'))
+        # the FILE_LOC device lives on the partition
+        st = os.stat(root)
+        os.makedirs(os.path.join(root, 'sys/dev/block'))
+        os.symlink(part, os.path.join(root, 'sys/dev/block/{}:{}'.format(os.major(st.st_dev), os.minor(st.st_dev))))
+
+        with unittest.mock.patch('libs.topology.SYSFS', os.path.join(root, 'sys')):
+            assert topology.interface_numa_nodes('nic1') == {1}
+            assert topology.interface_numa_nodes('bond0') == {0}
+            assert topology.interface_numa_nodes('bond1') == {0, 1}
+            assert topology.interface_numa_nodes('lo') == set()
+            assert topology.block_numa_nodes(part) == {1}
+            assert topology.block_numa_nodes(dm) == {0, 1}
+            assert topology.path_numa_nodes(os.path.join(root, 'not_yet', 'file')) == {1}
+
+            # the NIC wins over the disk
+            assert topology.auto_numa_node('nic0', root) == 0
+            assert topology.auto_numa_node('bond0', root) == 0
+            # NIC on both nodes, the disk decides
+            assert topology.auto_numa_node('bond1', root) == 1
+            assert topology.auto_numa_node(None, root) == 1
+            assert topology.auto_numa_node('lo', None) is None
+
+            result = topology.topology()
+            assert result['interfaces']['bond1'] == [0, 1]
+            assert result['nvme'] == {'nvme0n1': [1], 'nvme1n1': [0]}
+
     # def test_stress_cpu(self):        
     #     data = {            
     #         'cpu' : {